@@ -0,0 +1,289 @@
+# MIT License
+#
+# Copyright (c) 2023-2024 National Centre for Earth Observation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import io
+import json
+import os
+import zlib
+import struct
+import logging
+import collections
+import concurrent.futures
+
+from .bigplot import BigPlot
+
+
+def png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def riff_chunk(fourcc, data):
+    # RIFF chunks are padded to an even length
+    return fourcc + struct.pack("<I", len(data)) + data + (b"\0" if len(data) % 2 else b"")
+
+
+# the longest frame duration, in milliseconds, which both formats can store (WebP stores it in 3 bytes)
+MAX_FRAME_DURATION = 2**24 - 1
+
+
+def get_apng_delay(frame_duration):
+    # get the numerator and denominator, each stored in 2 bytes, of an APNG frame delay given in milliseconds
+    # coarser denominators are used for durations which do not fit in the numerator as milliseconds
+    for delay_den in [1000, 100, 10, 1]:
+        delay_num = round(frame_duration * delay_den / 1000)
+        if delay_num <= 0xFFFF:
+            return (delay_num, delay_den)
+    return (0xFFFF, 1)
+
+
+class APNGWriter:
+    """
+    Write frames to an animated PNG file as they are added, without keeping earlier frames in memory
+
+    Each frame is compressed by PIL as a PNG image, whose image data is then copied into the animation.
+
+    Arguments:
+        f: file opened for writing in binary mode
+        frame_count: the number of frames which will be added
+        frame_duration: the duration of each frame in milliseconds
+        loop: number of times to play the animation, 0 to play it forever
+    """
+
+    def __init__(self, f, frame_count, frame_duration, loop=0):
+        self.f = f
+        self.frame_count = frame_count
+        self.frame_duration = frame_duration
+        self.loop = loop
+        self.sequence_number = 0
+        self.size = None
+
+    def add(self, image):
+        buf = io.BytesIO()
+        image.convert("RGBA").save(buf, format="PNG")
+        png = buf.getvalue()
+        ihdr = None
+        idats = []
+        pos = 8
+        while pos < len(png):
+            (length,) = struct.unpack(">I", png[pos:pos+4])
+            chunk_type = png[pos+4:pos+8]
+            data = png[pos+8:pos+8+length]
+            if chunk_type == b"IHDR":
+                ihdr = data
+            elif chunk_type == b"IDAT":
+                idats.append(data)
+            pos += 12 + length
+
+        if self.size is None:
+            self.size = image.size
+            self.f.write(b"\x89PNG\r\n\x1a\n")
+            self.f.write(png_chunk(b"IHDR", ihdr))
+            self.f.write(png_chunk(b"acTL", struct.pack(">II", self.frame_count, self.loop)))
+        elif image.size != self.size:
+            raise Exception(f"Frame size {image.size} does not match the size of the first frame {self.size}")
+
+        (width, height) = self.size
+        # frames replace the previous frame, rather than being blended over it
+        (delay_num, delay_den) = get_apng_delay(self.frame_duration)
+        self.f.write(png_chunk(b"fcTL", struct.pack(">IIIIIHHBB", self.sequence_number, width, height, 0, 0,
+                                                    delay_num, delay_den, 0, 0)))
+        self.sequence_number += 1
+        for data in idats:
+            if self.sequence_number == 1:
+                # the first frame is also the default image, shown by viewers which do not support animation
+                self.f.write(png_chunk(b"IDAT", data))
+            else:
+                self.f.write(png_chunk(b"fdAT", struct.pack(">I", self.sequence_number) + data))
+                self.sequence_number += 1
+
+    def close(self):
+        self.f.write(png_chunk(b"IEND", b""))
+
+
+class WebPWriter:
+    """
+    Write frames to an animated WebP file as they are added, without keeping earlier frames in memory
+
+    Each frame is compressed by PIL as a lossless WebP image, whose image data is then copied into the animation.
+    The file must be seekable, as the size of the file is written into its header when it is closed.
+
+    Arguments:
+        f: file opened for writing in binary mode
+        frame_count: the number of frames which will be added (not needed by the WebP format)
+        frame_duration: the duration of each frame in milliseconds
+        loop: number of times to play the animation, 0 to play it forever
+    """
+
+    def __init__(self, f, frame_count, frame_duration, loop=0):
+        self.f = f
+        self.frame_duration = frame_duration
+        self.loop = loop
+        self.size = None
+
+    def add(self, image):
+        buf = io.BytesIO()
+        image.convert("RGBA").save(buf, format="WEBP", lossless=True)
+        webp = buf.getvalue()
+        frame_data = b""
+        pos = 12
+        while pos < len(webp):
+            fourcc = webp[pos:pos+4]
+            (length,) = struct.unpack("<I", webp[pos+4:pos+8])
+            end = pos + 8 + length + (length % 2)
+            if fourcc != b"VP8X":
+                frame_data += webp[pos:end]
+            pos = end
+
+        if self.size is None:
+            self.size = image.size
+            (width, height) = self.size
+            self.f.write(b"RIFF\0\0\0\0WEBP")
+            # flags: alpha and animation
+            self.f.write(riff_chunk(b"VP8X", struct.pack("<I", 0x12) + (width - 1).to_bytes(3, "little")
+                                    + (height - 1).to_bytes(3, "little")))
+            self.f.write(riff_chunk(b"ANIM", struct.pack("<IH", 0, self.loop)))
+        elif image.size != self.size:
+            raise Exception(f"Frame size {image.size} does not match the size of the first frame {self.size}")
+
+        (width, height) = self.size
+        # frames replace the previous frame, rather than being blended over it
+        header = (0).to_bytes(3, "little") + (0).to_bytes(3, "little") + (width - 1).to_bytes(3, "little") \
+            + (height - 1).to_bytes(3, "little") + self.frame_duration.to_bytes(3, "little") + bytes([0x02])
+        self.f.write(riff_chunk(b"ANMF", header + frame_data))
+
+    def close(self):
+        size = self.f.tell()
+        self.f.seek(4)
+        self.f.write(struct.pack("<I", size - 8))
+        self.f.seek(size)
+
+
+class Animation:
+    """
+    Plot each position along a dimension of a data array with BigPlot, and write the plots as the frames of an
+    animated PNG or WebP file
+
+    All frames share the colour map, legend and font of the first frame.  Frames are rendered in parallel threads
+    and written in order as they complete, so that only a few frames are held in memory at once.
+
+    Arguments:
+        data_array: the data array to plot
+        dimension: the name of the dimension to animate
+        output_path: path of the output file, ending in .png for an animated PNG or .webp for an animated WebP
+        frame_duration: the duration of each frame in milliseconds, up to MAX_FRAME_DURATION
+        workers: the number of frames to render in parallel
+        bigplot_args: other keyword arguments to pass to BigPlot, the selectors and iselectors are applied before
+                      the frames are selected
+    """
+
+    logger = logging.getLogger("Animation")
+
+    def __init__(self, data_array, dimension, output_path, frame_duration=500, workers=4, **bigplot_args):
+        if not (0 <= frame_duration <= MAX_FRAME_DURATION):
+            raise Exception(f"Frame duration {frame_duration} should be between 0 and {MAX_FRAME_DURATION} milliseconds")
+        self.data_array = data_array
+        self.dimension = dimension
+        self.output_path = output_path
+        self.frame_duration = frame_duration
+        self.workers = workers
+        self.bigplot_args = bigplot_args
+
+    def run(self):
+        """
+        Render the frames and write the animation
+
+        Returns:
+            True if the animation was written, False otherwise
+        """
+        if self.output_path.endswith(".png"):
+            writer_class = APNGWriter
+        elif self.output_path.endswith(".webp"):
+            writer_class = WebPWriter
+        else:
+            self.logger.error("Unsupported output file format for animations, currently only png and webp are supported")
+            return False
+
+        bigplot_args = dict(self.bigplot_args)
+        da = self.data_array
+        selectors = bigplot_args.pop("selectors", {})
+        iselectors = bigplot_args.pop("iselectors", {})
+        if selectors:
+            da = da.sel(**selectors)
+        if iselectors:
+            da = da.isel(**iselectors)
+
+        if bigplot_args.get("overview_key") is not None:
+            # frames select positions within the selection, so the selection also identifies their overviews
+            bigplot_args["overview_key"] = json.dumps([bigplot_args["overview_key"], str(selectors), str(iselectors)])
+
+        if self.dimension not in da.dims:
+            self.logger.error(f"Unable to animate, {self.dimension} is not a dimension of {da.dims}")
+            return False
+
+        frame_count = da.sizes[self.dimension]
+        subtexts = bigplot_args.pop("subtexts", [])
+        plan = bigplot_args.pop("plan", None)
+
+        def create_bigplot(index, plan):
+            subtext = f"{self.dimension}: {da[self.dimension].values[index]}" \
+                if self.dimension in da.coords else f"{self.dimension}: {index}"
+            return BigPlot(data_array=da, iselectors={self.dimension: index}, subtexts=subtexts + [subtext],
+                           output_path=self.output_path, plan=plan, **bigplot_args)
+
+        # create the first frame's plot to prepare the plan shared by all frames
+        first = create_bigplot(0, plan)
+        plan = first.plan
+
+        written = False
+        try:
+            with open(self.output_path, "wb") as f, \
+                    concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                writer = writer_class(f, frame_count, self.frame_duration)
+                # render a few frames ahead of the frame being written
+                pending = collections.deque()
+                next_index = 1
+                for index in range(frame_count):
+                    if index == 0:
+                        # render the first frame in this thread, so that numba starts its parallel threading layer
+                        # here rather than in a worker thread (which can stop the process from exiting)
+                        image = first.render()
+                    else:
+                        while next_index < frame_count and len(pending) < 2 * self.workers:
+                            pending.append(executor.submit(create_bigplot(next_index, plan).render))
+                            next_index += 1
+                        image = pending.popleft().result()
+                    if image is None:
+                        self.logger.error(f"Unable to render frame {index}")
+                        for future in pending:
+                            future.cancel()
+                        return False
+                    writer.add(image)
+                writer.close()
+                written = True
+        finally:
+            if not written and os.path.exists(self.output_path):
+                # do not leave an incomplete animation
+                os.remove(self.output_path)
+
+        self.logger.info(f"Written {self.output_path} with {frame_count} frames")
+        return True
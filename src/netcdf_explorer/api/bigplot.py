@@ -23,10 +23,18 @@ import os
 import datashader as dsh
 import datashader.transfer_functions as tf
 from datashader import reductions as rd
+from datashader import resampling
+from datashader import utils as ds_utils
 import logging
 import json
 import math
-from PIL import Image, ImageFont, ImageDraw
+import functools
+import copy
+import concurrent.futures
+from dataclasses import dataclass, field
+from PIL import Image, ImageFont, ImageDraw, ImageColor
+
+from .reprojection_cache import ReprojectionCache
 
 class CMap:
 
@@ -52,10 +60,157 @@ class CMap:
         return self.colors
 
 
+@functools.lru_cache(maxsize=None)
+def load_font(font_path, size):
+    # fonts are cached, as they are reused for every plot when plotting many inputs
+    return ImageFont.truetype(font_path, size=size)
+
+
+@functools.lru_cache(maxsize=None)
+def load_cmap(cmap_name):
+    # load the colours of a colour map as a tuple of (r,g,b) values in the range 0-1
+    cmap_path = os.path.join(os.path.split(__file__)[0], "..", "misc", "cmaps", cmap_name + ".json")
+    with open(cmap_path) as f:
+        return tuple(tuple(rgb) for rgb in json.loads(f.read()))
+
+
+def format_coordinate(value):
+    # format a coordinate value for a label, showing dates without a time of midnight
+    if np.issubdtype(np.asarray(value).dtype, np.datetime64):
+        text = np.datetime_as_string(value, unit="s")
+        return text[:-len("T00:00:00")] if text.endswith("T00:00:00") else text.replace("T", " ")
+    return str(value)
+
+
+def decimate(da, x_dim, y_dim, plot_width, plot_height):
+    """
+    Select every Nth row and column of a data array, where N is the number of input pixels per plot pixel
+
+    The rows and columns nearest the centre of each block of N by N input pixels are selected.  When the data array
+    is read lazily from a file, only the selected rows and columns are read.
+
+    Arguments:
+        da: the data array
+        x_dim: name of the x dimension
+        y_dim: name of the y dimension
+        plot_width: width of the plot, in pixels
+        plot_height: height of the plot, in pixels
+
+    Returns:
+        the decimated data array, or the input data array if it is not larger than the plot
+    """
+    stride = min(da.sizes[x_dim] // max(1, plot_width), da.sizes[y_dim] // max(1, plot_height))
+    if stride < 2:
+        return da
+    return da.isel(**{x_dim: slice(stride // 2, None, stride), y_dim: slice(stride // 2, None, stride)})
+
+
+def create_legend_image(cmap_colors, vmin, vmax, lwidth, lheight):
+    ldata = xr.DataArray(np.zeros((lheight, lwidth)), dims=("y", "x"))
+    ldata["x"] = xr.DataArray(np.arange(0, lwidth), dims=("x",))
+    ldata["y"] = xr.DataArray(np.arange(0, lheight), dims=("y",))
+
+    for i in range(0, lwidth):
+        v = vmin + i * (vmax - vmin) / lwidth
+        ldata[:, i] = v
+
+    lcvs = dsh.Canvas(plot_width=lwidth, plot_height=lheight,
+                      x_range=(0, lwidth),
+                      y_range=(0, lheight))
+
+    lagg = lcvs.raster(ldata, agg=rd.first, interpolate='linear')
+
+    lshaded = tf.shade(lagg, cmap=cmap_colors,
+                       how="linear",
+                       span=(vmin, vmax))
+    return lshaded.to_pil()
+
+
+def create_cchart_lut(cchart):
+    """
+    Create a lookup table for colouring nominal values
+
+    Arguments:
+        cchart: dictionary mapping nominal values to colours
+
+    Returns:
+        tuple (values, lut) where values is a sorted array of the nominal values, and lut is an array of RGBA colours
+        with one row per value, followed by a transparent row for values which are not in the colour chart
+    """
+    values = np.array(sorted(cchart.keys()), dtype=float)
+    lut = np.zeros((len(values) + 1, 4), dtype=np.uint8)
+    for (index, value) in enumerate(values):
+        lut[index, :] = ImageColor.getcolor(cchart[value], "RGBA")
+    return (values, lut)
+
+
+def classify(arr, values):
+    # get the index of each element of arr in the sorted array values, or len(values) if it is not found
+    indices = np.minimum(np.searchsorted(values, arr), len(values) - 1)
+    return np.where(values[indices] == arr, indices, len(values))
+
+
+@dataclass(frozen=True)
+class RenderPlan:
+    """
+    The colour map, colour chart, legend and font shared by plots of many inputs, prepared once
+
+    A plan is not modified after it is created, so it can be shared between plots and passed to worker processes.
+    """
+
+    cmap_name: str = "viridis"
+    vmin: float = 0
+    vmax: float = 1
+    cmap_values: tuple = () # (r,g,b) values of the colour map, in the range 0-1
+    cmap_colors: tuple = () # the colour map values as hex colour strings
+    cchart: dict = None
+    cchart_values: np.ndarray = field(default=None, compare=False) # sorted nominal values of the colour chart
+    cchart_lut: np.ndarray = field(default=None, compare=False) # RGBA colour for each of the cchart_values, and a transparent colour for other values
+    legend_image: Image.Image = None
+    font_path: str = None
+
+    @staticmethod
+    def create(cmap_name="viridis", vmin=0, vmax=1, cchart=None, legend_width=300, legend_height=50, font_path=None,
+               rgb=False):
+        """
+        Create a plan
+
+        Arguments:
+            cmap_name: name of the colour map to load, unless rgb is True
+            vmin: the value at the start of the colour map
+            vmax: the value at the end of the colour map
+            cchart: optional dictionary mapping nominal values to colours
+            legend_width: width of the legend image
+            legend_height: height of the legend image, or 0 for no legend
+            font_path: path to a true-type font, defaults to Roboto
+            rgb: True if the plots will be of red, green and blue bands, which do not need a colour map
+
+        Returns:
+            RenderPlan object
+        """
+        cmap_values = ()
+        cmap_colors = ()
+        legend_image = None
+        if not rgb:
+            cmap_values = load_cmap(cmap_name)
+            cmap_colors = tuple(f"#{int(255*r):02X}{int(255*g):02X}{int(255*b):02X}" for (r, g, b) in cmap_values)
+            if legend_height and cchart is None:
+                legend_image = create_legend_image(list(cmap_colors), vmin, vmax, legend_width, legend_height)
+        (cchart_values, cchart_lut) = create_cchart_lut(cchart) if cchart is not None else (None, None)
+        font_path = font_path if font_path else os.path.join(os.path.split(__file__)[0], "..", "misc", "Roboto-Black.ttf")
+        return RenderPlan(cmap_name=cmap_name, vmin=vmin, vmax=vmax, cmap_values=cmap_values, cmap_colors=cmap_colors,
+                          cchart=cchart, cchart_values=cchart_values, cchart_lut=cchart_lut, legend_image=legend_image,
+                          font_path=font_path)
+
+
 class BigPlot:
 
     def __init__(self, data_array, x="x", y="Y", vmin=0, vmax=1, vformat="%02f", cmap_name="viridis", title="",  output_path="output.png", subtexts=[], legend_width=300, legend_height=50, plot_width=1800, flip=True, theight=50,
-                 subtheight=25, selectors={}, iselectors={}, font_path=None, border=20,  cchart=None, gamma=0.5):
+                 subtheight=25, selectors={}, iselectors={}, font_path=None, border=20,  cchart=None, gamma=0.5, tile_size=None,
+                 plan=None, quicklook=False, overview_cache=None, input_path=None, overview_key=None,
+                 categorical_method="exact",
+                 montage=None, montage_columns=None, montage_workers=4, source_crs=None, target_crs=None,
+                 reprojection_cache=None):
         self.logger = logging.getLogger("BigPlot")
         self.data_array:xr.DataArray = data_array
         self.x = x
@@ -79,20 +234,61 @@ class BigPlot:
         self.gamma = gamma
         self.selectors = selectors
         self.iselectors = iselectors
-        self.font_path = font_path if font_path else os.path.join(os.path.split(__file__)[0],"..","misc","Roboto-Black.ttf")
         self.border = border
+        # if set, read and raster the input in windows of about this many rows and columns, to limit memory use
+        self.tile_size = tile_size
+        # if set, read only every Nth row and column of the input, where N is the number of input pixels per plot pixel
+        self.quicklook = quicklook
+        # if set, read the input from the smallest level of an overview pyramid that is at least as large as the plot
+        # the pyramid is identified by the input file path and a key identifying the data array within the file, for
+        # example the variable name(s), which the caller must provide as a derived array may keep its source's name
+        self.overview_cache = overview_cache
+        self.input_path = input_path
+        self.overview_key = overview_key
+        if overview_cache is not None and overview_key is None:
+            self.logger.warning("No overview key was provided to identify the data array, not using overviews")
+        # how to downsample nominal data plotted with a colour chart:
+        #   "exact" - the most common value in the area of each plot pixel, computed by datashader
+        #   "mode" - the most common value in fixed blocks of input pixels, then the nearest block to each plot pixel
+        #   "nearest" - the input pixel nearest the centre of each plot pixel, reading only those pixels
+        self.categorical_method = categorical_method
+        # if set, plot a panel for each position along this dimension, arranged in a grid with this many columns,
+        # rendering panels in this many threads
+        self.montage = montage
+        self.montage_columns = montage_columns
+        self.montage_workers = montage_workers
+        # if target_crs is set, reproject the input from source_crs, taking the nearest input pixel to each plot pixel
+        # using grids which are computed once and reused from the reprojection cache
+        if target_crs is not None and source_crs is None:
+            raise Exception("A source CRS is required to reproject the input to a target CRS")
+        self.source_crs = source_crs
+        self.target_crs = target_crs
+        if target_crs is not None and reprojection_cache is None:
+            reprojection_cache = ReprojectionCache()
+        self.reprojection_cache = reprojection_cache
+        # use the colour map, legend and font prepared in a plan, if one is provided
+        if plan is None:
+            plan = RenderPlan.create(cmap_name=cmap_name, vmin=vmin, vmax=vmax, cchart=cchart,
+                                     legend_width=legend_width, legend_height=legend_height, font_path=font_path,
+                                     rgb="rgb" in self.data_array.dims)
+        self.plan = plan
+        self.font_path = plan.font_path
         if "rgb" not in self.data_array.dims:
-            cmap_path = os.path.join(os.path.split(__file__)[0], "..", "misc", "cmaps", self.cmap_name + ".json")
-            with open(cmap_path) as f:
-                o = json.loads(f.read())
-                for rgb in o:
-                    r = int(255*rgb[0])
-                    g = int(255*rgb[1])
-                    b = int(255*rgb[2])
-                    self.cmap_colors.append(f"#{r:02X}{g:02X}{b:02X}")
-                self.cmap = CMap(o,self.vmin,self.vmax)
+            self.cmap_colors = list(plan.cmap_colors)
+            self.cmap = CMap(list(plan.cmap_values),self.vmin,self.vmax)
+        if cchart is not None:
+            if plan.cchart == cchart:
+                (self.cchart_values, self.cchart_lut) = (plan.cchart_values, plan.cchart_lut)
+            else:
+                (self.cchart_values, self.cchart_lut) = create_cchart_lut(cchart)
 
-    def run(self):
+    def render_plot(self):
+        """
+        Render the data array without a title, legend or subtexts
+
+        Returns:
+            PIL.Image containing the plotted data, or None if the data array cannot be plotted
+        """
         da = self.data_array
 
         if self.selectors:
@@ -105,37 +301,55 @@ class BigPlot:
 
         if len(da.shape) > 3:
             self.logger.error(f"too many dimensions to plot {da.dims}")
-            return
+            return None
         if len(da.shape) < 2:
             self.logger.error(f"too few dimensions to plot {da.dims}")
-            return
+            return None
 
         h = da.shape[da.dims.index(self.y)]
         w = da.shape[da.dims.index(self.x)]
 
         plot_height = int(self.plot_width*(h/w))
-        cvs = dsh.Canvas(plot_width=self.plot_width, plot_height=plot_height,
-                    x_range=(float(da[self.x].min()), float(da[self.x].max())),
-                    y_range=(float(da[self.y].min()), float(da[self.y].max())))
+        x_range = (float(da[self.x].min()), float(da[self.x].max()))
+        y_range = (float(da[self.y].min()), float(da[self.y].max()))
+
+        if self.target_crs is not None:
+            # the plot covers the extent of the input in the target CRS
+            (x_range, y_range) = self.reprojection_cache.get_target_ranges(da[self.x].values, da[self.y].values,
+                                                                           self.source_crs, self.target_crs)
+            plot_height = max(1, int(self.plot_width * (y_range[1] - y_range[0]) / (x_range[1] - x_range[0])))
+
+        if self.overview_cache is not None and self.input_path is not None and self.overview_key is not None:
+            key = json.dumps([self.overview_key, str(self.selectors), str(self.iselectors)])
+            method = "nearest" if self.cchart is not None else "mean"
+            da = self.overview_cache.get_overview(self.input_path, key, da, self.x, self.y, self.plot_width, plot_height,
+                                                  method)
+
+        if self.quicklook:
+            da = decimate(da, self.x, self.y, self.plot_width, plot_height)
 
         if len(da.shape) == 2:
             if not self.flip:
                 da = da.isel(**{self.y: slice(None, None, -1)})
-            if self.cchart is not None:
-                agg = cvs.raster(da.squeeze(), agg=rd.mode, interpolate='nearest')
+            if self.cchart is not None and self.categorical_method != "exact" and self.target_crs is None:
+                shaded = None
+            elif self.cchart is not None:
+                agg = self.raster(da, plot_height, x_range, y_range, agg=rd.mode, interpolate='nearest')
                 shaded = tf.shade(agg, color_key=self.cchart)
             else:
-                da = xr.where(da < self.vmin, np.nan, da)
-                da = xr.where(da > self.vmax, np.nan, da)
-                agg = cvs.raster(da.squeeze(), agg=rd.first, interpolate='linear')
+                agg = self.raster(da, plot_height, x_range, y_range, prepare_fn=self.mask_range,
+                                  agg=rd.first, interpolate='linear')
                 shaded = tf.shade(agg, cmap=self.cmap_colors,
                           how="linear",
                           span=(self.vmin, self.vmax))
-            p = shaded.to_pil()
+            if shaded is None:
+                p = self.categorical_image(da, plot_height)
+            else:
+                p = shaded.to_pil()
         else:
             if self.flip:
                 da = da.isel(**{self.y: slice(None, None, -1)})
-            agg = cvs.raster(da)
+            agg = self.raster(da, plot_height, x_range, y_range)
             alist = []
             a = None
             for cindex in range(0,3):
@@ -157,8 +371,24 @@ class BigPlot:
             alist.append(a)
             arr = np.stack(alist, axis=-1)
             p = Image.fromarray(arr, mode="RGBA")
+        return p
+
+    def render(self):
+        """
+        Render the plot, with its title, legend and subtexts
+
+        Returns:
+            PIL.Image containing the plot, or None if the data array cannot be plotted
+        """
+        if self.montage:
+            p = self.render_montage()
+        else:
+            p = self.render_plot()
+        if p is None:
+            return None
+        plot_height = p.size[1]
 
-        font = ImageFont.truetype(self.font_path, size=self.theight)
+        font = load_font(self.font_path, self.theight)
         spacing = self.theight
 
         # work out the combined width and height of the whole plot
@@ -182,7 +412,7 @@ class BigPlot:
 
         if self.legend_height:
             lp = self.create_legend_image()
-            legendfont = ImageFont.truetype(self.font_path, size=self.legend_height)
+            legendfont = load_font(self.font_path, self.legend_height)
             combined.paste(lp, (round(self.border+self.plot_width * 0.5 - self.legend_width * 0.5), y))
             min_label = self.vformat % self.vmin
             max_label = self.vformat % self.vmax
@@ -192,13 +422,19 @@ class BigPlot:
             y += self.legend_height+spacing
 
         if self.subtexts:
-            subfont = ImageFont.truetype(self.font_path, size=self.subtheight)
+            subfont = load_font(self.font_path, self.subtheight)
             for subtext in self.subtexts:
                 draw.text((round(self.border + self.plot_width * 0.5), y), subtext, fill=(0, 0, 0), font=subfont,
                       anchor="ma")
                 y += int(self.subtheight*1.5)
 
         combined.paste(p, (self.border, y))
+        return combined
+
+    def run(self):
+        combined = self.render()
+        if combined is None:
+            return False
 
         with open(self.output_path, "wb") as f:
             if self.output_path.endswith(".png"):
@@ -207,32 +443,305 @@ class BigPlot:
                 format = "PDF"
             elif self.output_path.endswith(".jpg") or self.output_path.endswith(".jpeg"):
                 format = "JPEG"
+            elif self.output_path.endswith(".webp"):
+                format = "WEBP"
             else:
-                self.logger.error("Unsupported output file format, currently only pdf and png are supported")
-                return
+                self.logger.error("Unsupported output file format, currently only pdf, png, jpg and webp are supported")
+                return False
             combined.save(f, format=format)
 
         self.logger.info(f"Written {self.output_path}")
+        return True
 
-    def create_legend_image(self):
-        lwidth = self.legend_width
-        lheight = self.legend_height
-
-        ldata = xr.DataArray(np.zeros((lheight, lwidth)), dims=("y", "x"))
-        ldata["x"] = xr.DataArray(np.arange(0, lwidth), dims=("x",))
-        ldata["y"] = xr.DataArray(np.arange(0, lheight), dims=("y",))
+    def render_montage(self):
+        """
+        Render a panel for each position along the montage dimension, arranged in a grid and labelled with the
+        montage dimension's coordinate values
 
-        for i in range(0, lwidth):
-            v = self.vmin + i * (self.vmax - self.vmin) / lwidth
-            ldata[:, i] = v
-
-        lcvs = dsh.Canvas(plot_width=lwidth, plot_height=lheight,
-                          x_range=(0, lwidth),
-                          y_range=(0, lheight))
-
-        lagg = lcvs.raster(ldata, agg=rd.first, interpolate='linear')
+        Returns:
+            PIL.Image containing the panels, or None if the data array cannot be plotted
+        """
+        da = self.data_array
+        if self.selectors:
+            da = da.sel(**self.selectors)
+        if self.montage not in da.dims:
+            self.logger.error(f"Unable to plot montage, {self.montage} is not a dimension of {da.dims}")
+            return None
+        # positions along the montage dimension after selection, which are selected by each panel
+        positions = np.arange(da.sizes[self.montage])[self.iselectors.get(self.montage, slice(None))]
+        if np.ndim(positions) == 0:
+            positions = np.array([positions])
+        labels = [format_coordinate(da[self.montage].values[position]) if self.montage in da.coords else str(position)
+                  for position in positions]
+
+        count = len(positions)
+        columns = self.montage_columns if self.montage_columns else math.ceil(math.sqrt(count))
+        rows = math.ceil(count / columns)
+        gap = self.border
+        panel_width = max(1, (self.plot_width - (columns - 1) * gap) // columns)
+        # reduce the label font size if needed so that labels fit within their panels
+        label_length = max(load_font(self.font_path, self.subtheight).getlength(label) for label in labels)
+        label_size = max(6, min(self.subtheight, int(self.subtheight * panel_width / max(1, label_length))))
+        label_height = int(label_size * 1.5)
+
+        def create_panel(position):
+            # each panel is a copy of this plot, sharing its plan, selecting one position along the montage dimension
+            panel = copy.copy(self)
+            panel.montage = None
+            panel.plot_width = panel_width
+            panel.iselectors = dict(self.iselectors)
+            panel.iselectors[self.montage] = int(position)
+            return panel
+
+        # render the first panel in this thread, so that numba starts its parallel threading layer here rather
+        # than in a worker thread (which can stop the process from exiting)
+        images = [create_panel(positions[0]).render_plot()]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.montage_workers) as executor:
+            images += list(executor.map(lambda position: create_panel(position).render_plot(), positions[1:]))
+        if any(image is None for image in images):
+            return None
+
+        panel_height = images[0].size[1]
+        montage = Image.new('RGBA', (self.plot_width, rows * (label_height + panel_height) + (rows - 1) * gap), "white")
+        draw = ImageDraw.Draw(montage)
+        font = load_font(self.font_path, label_size)
+        for (index, (image, label)) in enumerate(zip(images, labels)):
+            x = (index % columns) * (panel_width + gap)
+            y = (index // columns) * (label_height + panel_height + gap)
+            draw.text((round(x + panel_width * 0.5), y), label, fill=(0, 0, 0), font=font, anchor="ma")
+            montage.paste(image, (x, y + label_height))
+        return montage
+
+    def categorical_image(self, da, plot_height, max_block_bytes=64*1024*1024):
+        """
+        Downsample nominal data with the "mode" or "nearest" method and colour it using the colour chart
+
+        Arguments:
+            da: 2-dimensional data array to plot
+            plot_height: height of the plot, in pixels
+            max_block_bytes: the approximate size limit of the arrays used to count the values in each block
+
+        Returns:
+            PIL.Image containing the coloured plot, with the last row of da at the top
+        """
+        da = da.transpose(self.y, self.x)
+        (h, w) = da.shape
+        nclasses = len(self.cchart_values) + 1
+        block = min(w // self.plot_width, h // plot_height)
+        if self.categorical_method == "mode" and block > 1:
+            # count the values in each block of block x block input pixels, in strips of rows to limit memory use
+            (bh, bw) = (h // block, w // block)
+            strip_rows = max(1, max_block_bytes // (8 * bw * max(block * block, nclasses)))
+            strips = []
+            for start in range(0, bh, strip_rows):
+                rows = min(strip_rows, bh - start)
+                arr = da.isel(**{self.y: slice(start * block, (start + rows) * block),
+                                 self.x: slice(0, bw * block)}).values
+                classes = classify(arr, self.cchart_values)
+                classes = classes.reshape(rows, block, bw, block).transpose(0, 2, 1, 3).reshape(rows * bw, block * block)
+                offsets = np.arange(rows * bw)[:, None] * nclasses
+                counts = np.bincount((classes + offsets).ravel(), minlength=rows * bw * nclasses)
+                counts = counts.reshape(rows * bw, nclasses)
+                # the most common value in each block, ignoring values not in the colour chart unless there are no others
+                modes = np.argmax(counts[:, :-1], axis=1)
+                modes = np.where(counts[:, :-1].max(axis=1) > 0, modes, nclasses - 1)
+                strips.append(modes.reshape(rows, bw))
+            classes = np.concatenate(strips, axis=0)
+            (ch, cw) = (bh, bw)
+        else:
+            classes = None
+            (ch, cw) = (h, w)
+
+        # select the block or input pixel nearest the centre of each plot pixel
+        row_indices = ((np.arange(plot_height) + 0.5) * ch / plot_height).astype(int)
+        col_indices = ((np.arange(self.plot_width) + 0.5) * cw / self.plot_width).astype(int)
+        if classes is None:
+            classes = classify(da.isel(**{self.y: row_indices, self.x: col_indices}).values, self.cchart_values)
+        else:
+            classes = classes[row_indices, :][:, col_indices]
+
+        # the last row is at the top of the image, as in the images shaded by datashader for the "exact" method
+        classes = classes[::-1, :]
+        return Image.fromarray(self.cchart_lut[classes], mode="RGBA")
+
+    def mask_range(self, da):
+        # blank out values outside the colour scale
+        da = xr.where(da < self.vmin, np.nan, da)
+        return xr.where(da > self.vmax, np.nan, da)
+
+    def raster(self, da, plot_height, x_range, y_range, prepare_fn=None, agg="mean", interpolate="linear"):
+        """
+        Raster a data array onto the plot canvas
+
+        If tile_size is set, the canvas is split into tiles which are each resampled from the window of the input
+        covering them, in the same way as datashader's distributed resampling.  Only one window of the input is read
+        into memory at a time.  The result is the same as rastering the whole input at once when the input size is
+        a whole multiple of the canvas size, otherwise pixels near tile edges may be taken from an adjacent input
+        pixel.
+
+        Arguments:
+            da: the DataArray to raster, which may be lazily loaded
+            plot_height: the height of the canvas in pixels, the width is plot_width
+            x_range: the (min,max) x coordinates covered by the canvas
+            y_range: the (min,max) y coordinates covered by the canvas
+            prepare_fn: optional function to apply to the input (or each window of the input) before rastering
+            agg: the datashader downsampling method
+            interpolate: the datashader upsampling method
+
+        Returns:
+            DataArray containing the aggregated values for each canvas pixel
+        """
+        if self.target_crs is not None:
+            return self.reproject(da, plot_height, x_range, y_range, prepare_fn)
+
+        cvs = dsh.Canvas(plot_width=self.plot_width, plot_height=plot_height, x_range=x_range, y_range=y_range)
+        da = da.squeeze()
+        if not self.tile_size:
+            if prepare_fn:
+                da = prepare_fn(da)
+            return cvs.raster(da, agg=agg, interpolate=interpolate)
+
+        # follow the steps of datashader's Canvas.raster, up to the point where the input is resampled
+        da = da.transpose(..., self.y, self.x)
+        res = ds_utils.calc_res(da)
+        x_values = da[self.x].values
+        y_values = da[self.y].values
+        (left, bottom, right, top) = ds_utils.calc_bbox(x_values, y_values, res)
+        xmin = max(x_range[0], left)
+        ymin = max(y_range[0], bottom)
+        xmax = min(x_range[1], right)
+        ymax = min(y_range[1], top)
+        w = max(int(round(self.plot_width * min((xmax - xmin) / (x_range[1] - x_range[0]), 1))), 1)
+        h = max(int(round(plot_height * min((ymax - ymin) / (y_range[1] - y_range[0]), 1))), 1)
+        if w != self.plot_width or h != plot_height:
+            # the canvas extends beyond the input, which bigplot does not do, so no need to tile
+            self.logger.warning("Canvas extends beyond the input, not using tiles")
+            if prepare_fn:
+                da = prepare_fn(da)
+            return cvs.raster(da, agg=agg, interpolate=interpolate)
+        (cmin, cmax) = ds_utils.get_indices(xmin, xmax, x_values, res[0])
+        (rmin, rmax) = ds_utils.get_indices(ymin, ymax, y_values, res[1])
+
+        # lazily orient the input with x increasing and y decreasing, and select the part covered by the canvas
+        if res[0] < 0:
+            da = da.isel(**{self.x: slice(None, None, -1)})
+        if res[1] > 0:
+            da = da.isel(**{self.y: slice(None, None, -1)})
+        da = da.isel(**{self.y: slice(rmin, rmax+1), self.x: slice(cmin, cmax+1)})
+        (src_h, src_w) = da.shape[-2:]
+
+        # choose the tile size so that each window spans about tile_size rows and columns of the input,
+        # rounded up to a whole number of the input's chunks where they are known
+        # there is no need to tile along an axis where the input is smaller than the canvas
+        preferred_chunks = da.encoding.get("preferred_chunks", {})
+        tile_shape = []
+        for (dim, src_size, size) in [(self.y, src_h, h), (self.x, src_w, w)]:
+            chunk_size = preferred_chunks.get(dim, 1)
+            tile_size = chunk_size * math.ceil(self.tile_size / chunk_size)
+            tile_shape.append(max(1, int(tile_size * size / src_size)) if src_size > size else size)
+
+        ds_method = {rd.first: "first", rd.last: "last", rd.mode: "mode", rd.mean: "mean", rd.var: "var",
+                     rd.std: "std", rd.min: "min", rd.max: "max"}.get(agg, agg)
+        data = None
+        fill_value = None
+        for chunk in resampling.map_chunks((src_h, src_w), (h, w), tuple(tile_shape)).values():
+            (in_y0, in_y1) = chunk["in"]["y"]
+            (in_x0, in_x1) = chunk["in"]["x"]
+            (out_y0, out_y1) = chunk["out"]["y"]
+            (out_x0, out_x1) = chunk["out"]["x"]
+            window = da.isel(**{self.y: slice(in_y0, in_y1), self.x: slice(in_x0, in_x1)})
+            if prepare_fn:
+                window = prepare_fn(window)
+            window = window.values
+            if ds_method in ["var", "std"]:
+                window = window.astype("f")
+            if data is None:
+                fill_value = 0 if np.issubdtype(window.dtype, np.integer) else np.nan
+                data = np.full(window.shape[:-2] + (h, w), fill_value, dtype=window.dtype)
+            for layer in np.ndindex(window.shape[:-2]):
+                data[layer + (slice(out_y0, out_y1), slice(out_x0, out_x1))] = resampling.resample_2d(
+                    window[layer], out_x1 - out_x0, out_y1 - out_y0, ds_method=ds_method, us_method=interpolate,
+                    fill_value=fill_value, x_offset=chunk["in"]["xoffset"], y_offset=chunk["in"]["yoffset"])
+
+        # restore the original orientation and attach coordinates, as Canvas.raster does
+        if res[1] > 0:
+            data = data[..., ::-1, :]
+        if res[0] < 0:
+            data = data[..., ::-1]
+        if np.allclose([left, right], x_range) and np.size(x_values) == self.plot_width:
+            xs = x_values
+        else:
+            xs = cvs.x_axis.compute_index(cvs.x_axis.compute_scale_and_translate(x_range, self.plot_width), self.plot_width)
+            if res[0] < 0:
+                xs = xs[::-1]
+        if np.allclose([bottom, top], y_range) and np.size(y_values) == plot_height:
+            ys = y_values
+        else:
+            ys = cvs.y_axis.compute_index(cvs.y_axis.compute_scale_and_translate(y_range, plot_height), plot_height)
+            if res[1] > 0:
+                ys = ys[::-1]
+        coords = {self.x: xs, self.y: ys}
+        dims = [self.y, self.x]
+        if data.ndim == 3:
+            layer_dim = da.dims[0]
+            coords[layer_dim] = da.coords[layer_dim] if layer_dim in da.coords else np.arange(data.shape[0])
+            dims = [layer_dim] + dims
+        return xr.DataArray(data, coords=coords, dims=dims, attrs=dict(res=res[0], x_range=x_range, y_range=y_range))
+
+    def reproject(self, da, plot_height, x_range, y_range, prepare_fn=None):
+        """
+        Resample a data array onto the plot canvas in the target CRS, taking the input pixel nearest to the centre of
+        each canvas pixel
+
+        Only the input rows and columns which are used by the canvas are read, so memory use is limited by the size
+        of the plot rather than the size of the input.
+
+        Arguments:
+            da: the DataArray to resample, in the source CRS, which may be lazily loaded
+            plot_height: the height of the canvas in pixels, the width is plot_width
+            x_range: the (min,max) x coordinates covered by the canvas, in the target CRS
+            y_range: the (min,max) y coordinates covered by the canvas, in the target CRS
+            prepare_fn: optional function to apply to the input before resampling
+
+        Returns:
+            DataArray containing the value for each canvas pixel, or NaN outside the input, with the x and y
+            coordinates of the canvas pixels ordered in the same directions as the input's coordinates
+        """
+        da = da.squeeze()
+        layer_dims = [dim for dim in da.dims if dim not in (self.y, self.x)]
+        da = da.transpose(*layer_dims, self.y, self.x)
+        (rows, cols) = self.reprojection_cache.get_indices(da[self.x].values, da[self.y].values,
+                                                           self.source_crs, self.target_crs,
+                                                           self.plot_width, plot_height, x_range, y_range)
+        inside = rows >= 0
+        (unique_rows, row_indices) = np.unique(rows[inside], return_inverse=True)
+        (unique_cols, col_indices) = np.unique(cols[inside], return_inverse=True)
+        window = da.isel(**{self.y: unique_rows, self.x: unique_cols})
+        if prepare_fn:
+            window = prepare_fn(window)
+        window = window.values
+        data = np.full(window.shape[:-2] + rows.shape, np.nan, dtype=np.result_type(window.dtype, np.float32))
+        data[..., inside] = window[..., row_indices, col_indices]
+
+        xs = x_range[0] + (np.arange(self.plot_width) + 0.5) * (x_range[1] - x_range[0]) / self.plot_width
+        ys = y_range[0] + (np.arange(plot_height) + 0.5) * (y_range[1] - y_range[0]) / plot_height
+        # follow the orientation of the input, as Canvas.raster does
+        input_xs = da[self.x].values
+        input_ys = da[self.y].values
+        if len(input_xs) > 1 and input_xs[0] > input_xs[-1]:
+            (data, xs) = (data[..., ::-1], xs[::-1])
+        if len(input_ys) > 1 and input_ys[0] > input_ys[-1]:
+            (data, ys) = (data[..., ::-1, :], ys[::-1])
+        coords = {self.x: xs, self.y: ys}
+        for dim in layer_dims:
+            coords[dim] = da.coords[dim] if dim in da.coords else np.arange(da.sizes[dim])
+        return xr.DataArray(data, coords=coords, dims=layer_dims + [self.y, self.x],
+                            attrs=dict(x_range=x_range, y_range=y_range))
 
-        lshaded = tf.shade(lagg, cmap=self.cmap_colors,
-                           how="linear",
-                           span=(self.vmin, self.vmax))
-        return lshaded.to_pil()
\ No newline at end of file
+    def create_legend_image(self):
+        # reuse the legend prepared by the plan if it matches this plot
+        lp = self.plan.legend_image
+        if lp is not None and lp.size == (self.legend_width, self.legend_height) \
+                and (self.plan.vmin, self.plan.vmax) == (self.vmin, self.vmax):
+            return lp
+        return create_legend_image(self.cmap_colors, self.vmin, self.vmax, self.legend_width, self.legend_height)
@@ -1,8 +1,11 @@
 
 class CMap {
 
+    static LUT_SIZE = 256;
+
     constructor(base_url) {
         this.cmaps = {};
+        this.luts = {};
         this.base_url = base_url;
     }
 
@@ -33,4 +36,42 @@ class CMap {
         }
         return cols[index];
     }
+
+    get_lut(name) {
+        // get a LUT_SIZE entry RGBA lookup table for a loaded colour map, spanning the range 0 to 1
+        // the table does not depend on vmin/vmax so it is built only once per colour map
+        if (!(name in this.luts)) {
+            let cols = this.cmaps[name];
+            let ncols = cols.length;
+            let lut = new Uint8ClampedArray(4*CMap.LUT_SIZE);
+            for (let i = 0; i < CMap.LUT_SIZE; i++) {
+                let rgb = cols[Math.min(ncols-1, Math.floor(i*ncols/CMap.LUT_SIZE))];
+                lut[4*i] = Math.round(255*rgb[0]);
+                lut[4*i+1] = Math.round(255*rgb[1]);
+                lut[4*i+2] = Math.round(255*rgb[2]);
+                lut[4*i+3] = 255;
+            }
+            this.luts[name] = lut;
+        }
+        return this.luts[name];
+    }
+
+    static apply_lut(lut, vmin, vmax, values, pixels) {
+        // colour an array of values into an RGBA pixel array in one pass, using a lookup table from get_lut
+        // NaN values are mapped to transparent pixels
+        let lut32 = new Uint32Array(lut.buffer, lut.byteOffset, CMap.LUT_SIZE);
+        let pixels32 = new Uint32Array(pixels.buffer, pixels.byteOffset, values.length);
+        let scale = CMap.LUT_SIZE / (vmax - vmin);
+        let max_index = CMap.LUT_SIZE - 1;
+        for (let i = 0; i < values.length; i++) {
+            let v = values[i];
+            if (v !== v) {
+                pixels32[i] = 0;
+            } else {
+                let index = Math.floor((v - vmin) * scale);
+                pixels32[i] = lut32[index < 0 ? 0 : (index > max_index ? max_index : index)];
+            }
+        }
+        return pixels;
+    }
 }
@@ -0,0 +1,47 @@
+
+class DataCodec {
+
+    /**
+     * Fetch and decode the gzipped data files written by the DataEncoder, and encode coloured images
+     *
+     * This code is shared between the main page (index.js) and the data workers (worker.js)
+     */
+
+    static async fetch(url, signal) {
+        // fetch and decode a data file, returning {height, width, data} where data is a row-major Float32Array
+        // signal is an optional AbortSignal that can be used to cancel the fetch
+        let fetched = await fetch(url, {"signal": signal});
+        let blob = await fetched.blob();
+        const ds = new DecompressionStream("gzip");
+        const decompressedStream = blob.stream().pipeThrough(ds);
+        let r = await new Response(decompressedStream).arrayBuffer();
+        return DataCodec.decode(r);
+    }
+
+    static decode(buffer) {
+        let dv = new DataView(buffer);
+        let height = dv.getInt32(0, true);
+        let width = dv.getInt32(4, true);
+
+        // values are little-endian float32 in row-major order following the 8 byte header
+        let data = new Float32Array(height * width);
+        for (let pos = 0; pos < data.length; pos++) {
+            data[pos] = dv.getFloat32(8 + 4 * pos, true /* littleEndian */);
+        }
+        return {"height": height, "width": width, "data": data};
+    }
+
+    static async encode(image_data) {
+        // encode image data to a PNG blob
+        let cnv = new OffscreenCanvas(image_data.width, image_data.height);
+        cnv.getContext("2d").putImageData(image_data, 0, 0);
+        return await cnv.convertToBlob({"type": "image/png"});
+    }
+
+    static async colour(decoded, lut, vmin, vmax) {
+        // colour decoded data through a CMap lookup table, returning a PNG blob
+        let image_data = new ImageData(decoded.width, decoded.height);
+        CMap.apply_lut(lut, vmin, vmax, decoded.data, image_data.data);
+        return await DataCodec.encode(image_data);
+    }
+}
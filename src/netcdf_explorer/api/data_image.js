@@ -1,5 +1,8 @@
 var cmap = new CMap("cmaps");
 
+// fetching, decoding and colouring of data layers is offloaded to web workers where possible
+var data_workers = DataWorkerPool.create("worker.js");
+
 class DataImage {
 
     constructor() {
@@ -7,6 +10,7 @@ class DataImage {
         this.width = null;
         this.layer_names = [];
         this.data_layers = {};
+        this.layer_urls = {};
         this.layer_options = {};
         this.ele = null;
         this.mouseover_listener = null;
@@ -18,35 +22,36 @@ class DataImage {
         this.layer_names.push(layer_name);
     }
 
-    async load(layer_name, data_source) {
-        let from_url = data_source.url;
-        let options = data_source.options;
-        let fetched = await fetch(from_url);
-        let blob = await fetched.blob();
-        const ds = new DecompressionStream("gzip");
-        const decompressedStream = blob.stream().pipeThrough(ds);
-        let r = await new Response(decompressedStream).arrayBuffer();
-        let dv = new DataView(r);
-        this.height = dv.getInt32(0, true);
-        this.width = dv.getInt32(4, true);
-
-        let pos = 8;
-        let data = [];
-        for (let y = 0; y < this.height; y++) {
-            let row = [];
-            for (let x = 0; x < this.width; x++) {
-                let v = dv.getFloat32(pos, true /* littleEndian */);
-                row.push(v);
-                pos += 4;
+    static async fetch(url, signal) {
+        // fetch and decode a data file, in a data worker if possible, returning {height, width, data}
+        if (data_workers && data_workers.is_available()) {
+            try {
+                return await data_workers.load(url, signal);
+            } catch (e) {
+                if (e.name === "AbortError") {
+                    throw e;
+                }
+                console.log("Unable to load " + url + " in a data worker: " + e.message);
             }
-            data.push(row);
         }
-        this.data_layers[layer_name] = data;
-        this.layer_options[layer_name] = options;
+        return await DataCodec.fetch(url, signal);
+    }
+
+    async load(layer_name, data_source) {
+        this.set_layer(layer_name, data_source, await DataImage.fetch(data_source.url));
+    }
+
+    set_layer(layer_name, data_source, decoded) {
+        // add decoded data for a layer, obtained from DataImage.fetch
+        this.height = decoded.height;
+        this.width = decoded.width;
+        this.data_layers[layer_name] = decoded.data;
+        this.layer_urls[layer_name] = data_source.url;
+        this.layer_options[layer_name] = data_source.options;
     }
 
     get_data(layer_name, x, y) {
-        return this.data_layers[layer_name][y][x];
+        return this.data_layers[layer_name][y * this.width + x];
     }
 
     get_height() {
@@ -58,43 +63,40 @@ class DataImage {
     }
 
     get_value(layer_name, y, x) {
-        return this.data_layers[layer_name][y][x];
+        return this.data_layers[layer_name][y * this.width + x];
     }
 
-    get_legend_url(cmap_name, vmin, vmax, height, width) {
-        const canvas = document.createElement("canvas");
-        const ctx = canvas.getContext("2d");
-        ctx.canvas.width = width;
-        ctx.canvas.height = height;
-
+    async get_legend_url(cmap_name, vmin, vmax, height, width) {
+        // colour one row of the legend through the cmap lookup table and repeat it for every row
+        let values = new Float32Array(width);
         for (let x = 0; x < width; x++) {
-            let v = vmin + ((x + 0.5) / (width)) * (vmax - vmin);
-            for (let y = 0; y < height; y++) {
-                let rgb = cmap.get_rgb(cmap_name, vmin, vmax, v);
-                ctx.fillStyle = "rgb(" + 255 * rgb[0] + "," + 255 * rgb[1] + "," + 255 * rgb[2] + ")";
-                ctx.fillRect(x, y, 1, 1);
-            }
+            values[x] = vmin + ((x + 0.5) / (width)) * (vmax - vmin);
         }
-        return canvas.toDataURL("image/png");
+        let row = CMap.apply_lut(cmap.get_lut(cmap_name), vmin, vmax, values, new Uint8ClampedArray(4 * width));
+        let image_data = new ImageData(width, height);
+        for (let y = 0; y < height; y++) {
+            image_data.data.set(row, 4 * y * width);
+        }
+        return URL.createObjectURL(await DataCodec.encode(image_data));
     }
 
-    get_image_url(layer_name, cmap_name, vmin, vmax) {
-        const canvas = document.createElement("canvas");
-        const ctx = canvas.getContext("2d");
-        ctx.canvas.width = this.width;
-        ctx.canvas.height = this.height;
-        let data = this.data_layers[layer_name];
-        for (let y = 0; y < this.height; y++) {
-            for (let x = 0; x < this.width; x++) {
-                let v = data[y][x];
-                let rgb = cmap.get_rgb(cmap_name, vmin, vmax, v);
-                if (rgb !== null) {
-                    ctx.fillStyle = "rgb(" + 255 * rgb[0] + "," + 255 * rgb[1] + "," + 255 * rgb[2] + ")";
-                    ctx.fillRect(x, y, 1, 1);
-                }
+    async get_image_url(layer_name, cmap_name, vmin, vmax) {
+        // return an object URL for the layer coloured with a cmap
+        // callers should release the URL with URL.revokeObjectURL when it is replaced
+        let lut = cmap.get_lut(cmap_name);
+        let decoded = {"height": this.height, "width": this.width, "data": this.data_layers[layer_name]};
+        let blob = null;
+        if (data_workers && data_workers.is_available()) {
+            try {
+                blob = await data_workers.colour(this.layer_urls[layer_name], decoded, lut, vmin, vmax);
+            } catch (e) {
+                console.log("Unable to colour " + layer_name + " in a data worker: " + e.message);
             }
         }
-        return canvas.toDataURL("image/png");
+        if (blob === null) {
+            blob = await DataCodec.colour(decoded, lut, vmin, vmax);
+        }
+        return URL.createObjectURL(blob);
     }
 
     set_zoom(zoom) {
@@ -0,0 +1,52 @@
+// entry point for the data workers (worker.js), which fetch, decode and colour data layers off the main thread
+// messages are {id, op, url, ...} and replies are {id, result} or {id, error}
+
+class DataWorker {
+
+    constructor() {
+        this.controllers = new Map(); // request id => AbortController, for loads in progress
+    }
+
+    cancel(id) {
+        // abort a load in progress, its reply is ignored by the main thread
+        let controller = this.controllers.get(id);
+        if (controller) {
+            controller.abort();
+        }
+    }
+
+    async handle(msg) {
+        if (msg.op === "load") {
+            // transfer the decoded data to the main thread, which keeps the only copy
+            let controller = new AbortController();
+            this.controllers.set(msg.id, controller);
+            try {
+                let decoded = await DataCodec.fetch(msg.url, controller.signal);
+                return [decoded, [decoded.data.buffer]];
+            } finally {
+                this.controllers.delete(msg.id);
+            }
+        } else if (msg.op === "colour") {
+            // colour data sent by the main thread, which transfers a copy of its decoded data
+            let blob = await DataCodec.colour(msg.decoded, msg.lut, msg.vmin, msg.vmax);
+            return [blob, []];
+        }
+        throw new Error("Unknown operation: " + msg.op);
+    }
+}
+
+const data_worker = new DataWorker();
+
+self.onmessage = async (evt) => {
+    let msg = evt.data;
+    if (msg.op === "cancel") {
+        data_worker.cancel(msg.id);
+        return;
+    }
+    try {
+        let [result, transfer] = await data_worker.handle(msg);
+        self.postMessage({"id": msg.id, "result": result}, transfer);
+    } catch (e) {
+        self.postMessage({"id": msg.id, "error": String(e)});
+    }
+};
@@ -0,0 +1,114 @@
+
+class DataWorkerPool {
+
+    /**
+     * Manage a small pool of web workers (see data_worker.js) which fetch, decompress, decode and colour data layers
+     *
+     * Requests are spread between the workers by a hash of their url, so that requests for the same url are handled
+     * in order by one worker
+     */
+
+    constructor(worker_url, size) {
+        this.workers = [];
+        this.pending = {}; // request id => {resolve, reject}
+        this.next_id = 0;
+        this.failed = false;
+        for (let idx = 0; idx < size; idx++) {
+            let worker = new Worker(worker_url);
+            worker.onmessage = (evt) => {
+                this.handle_reply(evt.data);
+            };
+            worker.onerror = (evt) => {
+                // the worker script could not be loaded or failed, fall back to the main thread from now on
+                console.log("Data worker failed: " + evt.message);
+                this.failed = true;
+                for (let id in this.pending) {
+                    this.pending[id].reject(new Error("Data worker failed"));
+                }
+                this.pending = {};
+            };
+            this.workers.push(worker);
+        }
+    }
+
+    static create(worker_url) {
+        // create a pool if web workers are supported, otherwise return null
+        if (typeof Worker === "undefined" || typeof OffscreenCanvas === "undefined") {
+            return null;
+        }
+        let size = Math.max(1, Math.min(4, (navigator.hardwareConcurrency || 2) - 1));
+        return new DataWorkerPool(worker_url, size);
+    }
+
+    is_available() {
+        return !this.failed;
+    }
+
+    handle_reply(reply) {
+        let pending = this.pending[reply.id];
+        if (pending) {
+            delete this.pending[reply.id];
+            if ("error" in reply) {
+                pending.reject(new Error(reply.error));
+            } else {
+                pending.resolve(reply.result);
+            }
+        }
+    }
+
+    get_worker(url) {
+        let hash = 0;
+        for (let idx = 0; idx < url.length; idx++) {
+            hash = (Math.imul(hash, 31) + url.charCodeAt(idx)) | 0;
+        }
+        return this.workers[(hash >>> 0) % this.workers.length];
+    }
+
+    submit(msg, transfer, signal) {
+        // send a request to a worker, resolving to its result
+        // if the optional AbortSignal fires first, the worker is asked to cancel and the promise rejects with an AbortError
+        return new Promise((resolve, reject) => {
+            if (signal && signal.aborted) {
+                reject(new DOMException("The request was aborted", "AbortError"));
+                return;
+            }
+            let id = this.next_id;
+            this.next_id += 1;
+            msg.id = id;
+            let worker = this.get_worker(msg.url);
+            let on_abort = () => {
+                if (id in this.pending) {
+                    delete this.pending[id];
+                    worker.postMessage({"op": "cancel", "id": id});
+                    reject(new DOMException("The request was aborted", "AbortError"));
+                }
+            };
+            let settle = (fn) => (value) => {
+                if (signal) {
+                    signal.removeEventListener("abort", on_abort);
+                }
+                fn(value);
+            };
+            this.pending[id] = {"resolve": settle(resolve), "reject": settle(reject)};
+            if (signal) {
+                signal.addEventListener("abort", on_abort);
+            }
+            worker.postMessage(msg, transfer || []);
+        });
+    }
+
+    async load(url, signal) {
+        // resolve to {height, width, data} where data is a Float32Array transferred from the worker
+        // signal is an optional AbortSignal that can be used to cancel the fetch
+        return await this.submit({"op": "load", "url": url}, [], signal);
+    }
+
+    async colour(url, decoded, lut, vmin, vmax) {
+        // resolve to a PNG blob with decoded data (loaded from url) coloured through a CMap lookup table
+        // a copy of the data is transferred to the worker, the caller keeps the original
+        let data = decoded.data.slice();
+        let msg = {"op": "colour", "url": url, "decoded": {"height": decoded.height, "width": decoded.width, "data": data},
+                   "lut": lut, "vmin": vmin, "vmax": vmax};
+        return await this.submit(msg, [data.buffer]);
+    }
+}
@@ -0,0 +1,74 @@
+# MIT License
+#
+# Copyright (c) 2023-2024 National Centre for Earth Observation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import collections
+
+import xarray as xr
+
+
+class DatasetCache:
+    """
+    Keep recently used datasets open, so that they can be reused without being opened again
+
+    A dataset is reopened if its file has been modified since it was opened.  When more than max_size datasets are
+    open, the least recently used dataset is closed.
+    """
+
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self.datasets = collections.OrderedDict() # path => (file signature, dataset)
+
+    def open(self, path):
+        """
+        Open a dataset, or return the open dataset if the file has not changed since it was opened
+
+        Arguments:
+            path: path to the netcdf4 file
+
+        Returns:
+            xarray.Dataset, which should not be closed by the caller
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if path in self.datasets:
+            (cached_signature, ds) = self.datasets.pop(path)
+            if cached_signature == signature:
+                self.datasets[path] = (signature, ds)
+                return ds
+            ds.close()
+        ds = xr.open_dataset(path)
+        self.datasets[path] = (signature, ds)
+        while len(self.datasets) > self.max_size:
+            (_, (_, evicted_ds)) = self.datasets.popitem(last=False)
+            evicted_ds.close()
+        return ds
+
+    def close(self):
+        """
+        Close all open datasets
+        """
+        for (_, ds) in self.datasets.values():
+            ds.close()
+        self.datasets.clear()
@@ -0,0 +1,125 @@
+# MIT License
+#
+# Copyright (c) 2023-2024 National Centre for Earth Observation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import numpy as np
+import xarray as xr
+from xarray.backends import BackendArray
+from xarray.core import indexing
+
+from .expr_compiler import ExpressionCompiler
+
+
+class DerivedBandArray(BackendArray):
+    """
+    Lazily evaluate a compiled derive_bands expression over the bands of a dataset
+
+    Only the part of the derived band that is indexed is evaluated, by indexing each referenced band in the same
+    way.  Requests spanning many slices of the first dimension (usually the case dimension) are evaluated in chunks
+    of slices, so that the intermediate arrays stay within a memory budget.
+    """
+
+    def __init__(self, ds, compiled_expression, dims, max_chunk_bytes=64*1024*1024):
+        self.ds = ds
+        self.compiled_expression = compiled_expression
+        self.dims = dims
+        self.shape = tuple(ds.sizes[dim] for dim in dims)
+        # evaluate a single element to find the type of the result
+        self.dtype = self.evaluate(tuple(slice(0, 1) for _ in dims)).dtype
+        # intermediate arrays are assumed to be no more than 8 bytes per element
+        slice_bytes = 8 * int(np.prod(self.shape[1:]))
+        self.chunk_size = max(1, max_chunk_bytes // max(1, slice_bytes))
+
+    @staticmethod
+    def create(ds, parsed_expression, compiler, max_chunk_bytes=64*1024*1024):
+        """
+        Create a lazily evaluated DataArray for an expression
+
+        Arguments:
+            ds: the dataset containing the bands referenced by the expression
+            parsed_expression: an expression parsed by ExpressionParser
+            compiler: an ExpressionCompiler, which shares subexpressions between the expressions it compiles
+            max_chunk_bytes: the approximate size limit of each intermediate array created during evaluation
+
+        Returns:
+            DataArray whose dimensions match the referenced band with the most dimensions
+        """
+        dims = ()
+        for band in ExpressionCompiler.get_band_names(parsed_expression, []):
+            if band not in ds:
+                raise Exception(f"Expression references unknown band: {band}")
+            if len(ds[band].dims) > len(dims):
+                dims = ds[band].dims
+        backend_array = DerivedBandArray(ds, compiler.compile(parsed_expression), dims, max_chunk_bytes)
+        return xr.DataArray(xr.Variable(dims, indexing.LazilyIndexedArray(backend_array)))
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape, indexing.IndexingSupport.OUTER, self.get_items)
+
+    def get_items(self, key):
+        # key holds an integer, slice or integer array for each dimension (outer indexing)
+        if self.dims and not isinstance(key[0], (int, np.integer)):
+            positions = np.arange(self.shape[0])[key[0]]
+            if len(positions) > self.chunk_size:
+                result = None
+                for start in range(0, len(positions), self.chunk_size):
+                    chunk = self.evaluate((positions[start:start + self.chunk_size],) + tuple(key[1:]))
+                    if result is None:
+                        result = np.empty((len(positions),) + chunk.shape[1:], dtype=chunk.dtype)
+                    result[start:start + len(chunk)] = chunk
+                return result
+        return self.evaluate(key)
+
+    def evaluate(self, key):
+        # evaluate the expression for the part of the band selected by key
+        selectors = dict(zip(self.dims, key))
+        result_dims = [dim for (dim, k) in selectors.items() if not isinstance(k, (int, np.integer))]
+        result_shape = tuple(len(np.arange(size)[k]) for (size, k) in zip(self.shape, key)
+                             if not isinstance(k, (int, np.integer)))
+        # the selection identifies the arrays returned by get_band, so that shared subexpressions can be reused
+        selection = (self.dims, tuple(DerivedBandArray.get_selection_key(k) for k in key))
+        (arr, _) = self.compiled_expression(lambda band: self.get_band(band, selectors, result_dims), selection)
+        arr = np.asarray(arr)
+        if arr.shape != result_shape:
+            arr = np.array(np.broadcast_to(arr, result_shape))
+        return arr
+
+    @staticmethod
+    def get_selection_key(k):
+        # get a hashable value for an integer, slice or integer array indexer
+        if isinstance(k, slice):
+            return ("slice", k.start, k.stop, k.step)
+        elif isinstance(k, np.ndarray):
+            return ("array", k.tobytes())
+        else:
+            return int(k)
+
+    def get_band(self, band, selectors, result_dims):
+        # get the selected part of a band, with its dimensions arranged to broadcast against the result
+        da = self.ds[band]
+        da = da.isel({dim: k for (dim, k) in selectors.items() if dim in da.dims})
+        da = da.transpose(*[dim for dim in result_dims if dim in da.dims])
+        arr = da.values
+        # add size-1 axes for any result dimensions that this band does not have
+        for (axis, dim) in enumerate(result_dims):
+            if dim not in da.dims:
+                arr = np.expand_dims(arr, axis)
+        return arr
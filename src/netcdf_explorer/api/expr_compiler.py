@@ -0,0 +1,199 @@
+# MIT License
+#
+# Copyright (c) 2023-2024 National Centre for Earth Observation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+
+import numpy as np
+
+
+def get_out(candidate, is_temporary, other, ufunc=None):
+    # get the candidate array to receive the result of an operation in place, if it is a temporary
+    # with the shape and type of the result, otherwise None
+    if not is_temporary or not isinstance(candidate, np.ndarray) or not isinstance(other, np.ndarray):
+        return None
+    if np.broadcast_shapes(candidate.shape, other.shape) != candidate.shape:
+        return None
+    if ufunc is not None:
+        result_type = ufunc(candidate.flat[:1], other.flat[:1]).dtype if candidate.size and other.size else None
+        if result_type != candidate.dtype:
+            return None
+    return candidate
+
+
+def apply_bitwise(ufunc, evaluated):
+    a = np.astype(evaluated[0][0], int)
+    b = np.astype(evaluated[1][0], int)
+    return ufunc(a, b, out=get_out(a, True, b))
+
+
+def apply_arithmetic(ufunc, evaluated):
+    ((a, a_is_temporary), (b, b_is_temporary)) = evaluated
+    out = get_out(a, a_is_temporary, b, ufunc)
+    if out is None:
+        # try to reuse the right hand operand instead
+        out = get_out(b, b_is_temporary, a, ufunc)
+    return ufunc(a, b, out=out)
+
+
+# map from operator to (number of arguments, function computing the result from a list of (array, is_temporary))
+operators = {
+    "==": (2, lambda evaluated: np.equal(evaluated[0][0], evaluated[1][0])),
+    "&": (2, lambda evaluated: apply_bitwise(np.bitwise_and, evaluated)),
+    "|": (2, lambda evaluated: apply_bitwise(np.bitwise_or, evaluated)),
+    "and": (2, lambda evaluated: np.logical_and(np.astype(evaluated[0][0], int), np.astype(evaluated[1][0], int))),
+    "or": (2, lambda evaluated: np.logical_or(np.astype(evaluated[0][0], int), np.astype(evaluated[1][0], int))),
+    "not": (1, lambda evaluated: np.logical_not(evaluated[0][0])),
+    "*": (2, lambda evaluated: apply_arithmetic(np.multiply, evaluated)),
+    "/": (2, lambda evaluated: apply_arithmetic(np.divide, evaluated)),
+    "+": (2, lambda evaluated: apply_arithmetic(np.add, evaluated)),
+    "-": (2, lambda evaluated: apply_arithmetic(np.subtract, evaluated))
+}
+
+
+class ExpressionCompiler:
+    """
+    Compile expressions parsed by ExpressionParser into callables
+
+    Subexpressions involving only literals are folded into a single literal when compiled.  Identical subexpressions
+    are compiled once and shared between all the expressions compiled by the same compiler.  A subexpression which
+    is used more than once keeps its results for the most recently used selections of the input bands, so that it is
+    computed only once for each selection.  Results are kept separately for each selection, as evaluating a derived
+    band which references another derived band evaluates the referenced band for its own selection part way through.
+
+    A compiled expression is called as fn(get_band, selection) and returns a tuple (array, is_temporary) where:
+        get_band: function returning the array for a band name, for the current selection
+        selection: hashable value identifying the current selection of the input bands
+        is_temporary: True if the returned array is not referenced elsewhere and may be modified
+    """
+
+    def __init__(self, max_selections=4):
+        self.compiled = {} # expression key => compiled callable
+        self.use_counts = {} # expression key => number of uses in all compiled expressions
+        self.max_selections = max_selections
+        self.caches = collections.OrderedDict() # selection => {expression key => array computed for the selection}
+
+    @staticmethod
+    def get_key(parsed_expression):
+        # get a hashable key which is equal for identical expressions
+        if "name" in parsed_expression:
+            return ("name", parsed_expression["name"])
+        elif "literal" in parsed_expression:
+            literal = parsed_expression["literal"]
+            return ("literal", type(literal).__name__, literal)
+        elif "operator" in parsed_expression:
+            return ("operator", parsed_expression["operator"]) \
+                + tuple(ExpressionCompiler.get_key(arg) for arg in parsed_expression["args"])
+        else:
+            raise Exception(f"Unable to compile expression: {str(parsed_expression)}")
+
+    @staticmethod
+    def get_band_names(parsed_expression, accumulator):
+        # collect the names of bands referenced by an expression
+        if "name" in parsed_expression:
+            accumulator.append(parsed_expression["name"])
+        elif "operator" in parsed_expression:
+            for arg in parsed_expression["args"]:
+                ExpressionCompiler.get_band_names(arg, accumulator)
+        return accumulator
+
+    def fold(self, parsed_expression):
+        """
+        Fold operators whose arguments are all literals into literals
+
+        Arguments:
+            parsed_expression: an expression parsed by ExpressionParser
+
+        Returns:
+            the expression with literal subexpressions folded
+        """
+        if "operator" not in parsed_expression:
+            return parsed_expression
+        operator = parsed_expression["operator"]
+        args = [self.fold(arg) for arg in parsed_expression["args"]]
+        if operator in operators and all("literal" in arg for arg in args):
+            try:
+                value = operators[operator][1]([(np.array(arg["literal"]), False) for arg in args])
+                return {"literal": value.item()}
+            except Exception:
+                pass # leave the error to be reported when the expression is evaluated
+        return {"operator": operator, "args": args}
+
+    def compile(self, parsed_expression):
+        """
+        Compile an expression
+
+        Arguments:
+            parsed_expression: an expression parsed by ExpressionParser
+
+        Returns:
+            a callable fn(get_band, selection) returning a tuple (array, is_temporary)
+        """
+        folded = self.fold(parsed_expression)
+        return self.compile_node(folded, ExpressionCompiler.get_key(folded))
+
+    def compile_node(self, parsed_expression, key):
+        self.use_counts[key] = self.use_counts.get(key, 0) + 1
+        if key in self.compiled:
+            return self.compiled[key]
+
+        if "name" in parsed_expression:
+            name = parsed_expression["name"]
+            fn = lambda get_band, selection: (get_band(name), False)
+        elif "literal" in parsed_expression:
+            value = np.array(parsed_expression["literal"])
+            fn = lambda get_band, selection: (value, False)
+        else:
+            operator = parsed_expression["operator"]
+            args = parsed_expression["args"]
+            if operator not in operators:
+                raise Exception(f"Unknown operator: {operator}")
+            (nargs, apply_fn) = operators[operator]
+            assert len(args) == nargs
+            arg_fns = []
+            for arg in args:
+                arg_fns.append(self.compile_node(arg, ExpressionCompiler.get_key(arg)))
+            fn = self.create_operator_fn(key, apply_fn, arg_fns)
+        self.compiled[key] = fn
+        return fn
+
+    def create_operator_fn(self, key, apply_fn, arg_fns):
+
+        def operator_fn(get_band, selection):
+            if self.use_counts[key] < 2:
+                return (apply_fn([arg_fn(get_band, selection) for arg_fn in arg_fns]), True)
+            # this subexpression is shared, reuse the result computed for the same selection
+            cache = self.get_cache(selection)
+            if key not in cache:
+                cache[key] = apply_fn([arg_fn(get_band, selection) for arg_fn in arg_fns])
+            return (cache[key], False)
+
+        return operator_fn
+
+    def get_cache(self, selection):
+        # get the results kept for a selection, forgetting the results for the least recently used selections
+        if selection in self.caches:
+            self.caches.move_to_end(selection)
+        else:
+            self.caches[selection] = {}
+            while len(self.caches) > self.max_selections:
+                self.caches.popitem(last=False)
+        return self.caches[selection]
@@ -1,7 +1,20 @@
-
+import re
 
 class ExpressionParser:
 
+    # tokens recognised by fast_lex, in order of preference at each position
+    token_pattern = re.compile(r"""
+        (?P<whitespace>[ \t\n]+)
+        |"(?P<d_string>[^"]*)"
+        |'(?P<s_string>[^']*)'
+        |(?P<number>[0-9.](?:[0-9.]|[eE]-?)*)
+        |(?P<name>[A-Za-z][A-Za-z0-9_.]*)
+        |(?P<open_parenthesis>\()
+        |(?P<close_parenthesis>\))
+        |(?P<comma>,)
+        |(?P<operator>[^ \t\n"'(),0-9.A-Za-z]+)
+    """, re.VERBOSE)
+
     class ParseError(Exception):
 
         def __init__(self, error_type, error_position, error_content):
@@ -230,6 +243,40 @@ class ExpressionParser:
         self.merge_string_tokens()
         return self.tokens
 
+    def fast_lex(self):
+        # tokenise the input using a regular expression, producing the same tokens as lex
+        # inputs that lex would reject, and other unusual inputs, are passed to lex instead
+        self.reset()
+        s = self.input
+        index = 0
+        while index < len(s):
+            m = ExpressionParser.token_pattern.match(s, index)
+            if m is None:
+                return self.lex()
+            token_type = m.lastgroup
+            content = m.group(token_type)
+            if token_type == "number":
+                if content[-1] in "eE" or (m.end() < len(s) and self.is_alpha(s[m.end()])):
+                    return self.lex()
+                self.tokens.append([token_type, content, index])
+            elif token_type == "name":
+                if content in self.binary_operators or content in self.unary_operators:
+                    token_type = "operator"
+                self.tokens.append([token_type, content, index])
+            elif token_type == "operator":
+                # split a run of operator characters, ending each operator as soon as it is recognised
+                start = index
+                for pos in range(index+1, m.end()):
+                    operator = s[start:pos]
+                    if operator in self.unary_operators or operator in self.binary_operators:
+                        self.tokens.append(["operator", operator, start])
+                        start = pos
+                self.tokens.append(["operator", s[start:m.end()], start])
+            elif token_type != "whitespace":
+                self.tokens.append([token_type, content, index])
+            index = m.end()
+        self.merge_string_tokens()
+        return self.tokens
 
     def get_ascending_precedence(self):
         prec_list = []
@@ -245,7 +292,7 @@ class ExpressionParser:
     def parse(self, s):
         self.input = s
         try:
-            self.lex()
+            self.fast_lex()
             self.token_index = 0
             parsed = self.parse_expr()
             self.strip_debug(parsed)
@@ -0,0 +1,244 @@
+
+class GridView {
+
+    /**
+     * Render the rows of the grid view table from the html view's filtered scene index, keeping only the rows near the visible part
+     * of the page (plus a buffer) in the DOM
+     *
+     * Rows are assumed to share a common height, measured from the rows that have been rendered.  Spacer rows above
+     * and below the rendered rows keep the table (and the page scrollbar) at its full height.
+     */
+
+    constructor(html_view, table, spec, buffer_rows) {
+        this.html_view = html_view;
+        this.table = table;
+        this.tbody = table.tBodies[0];
+        this.spec = spec;
+        this.buffer_rows = buffer_rows;
+        this.row_height = spec.image_height + 30; // estimate, updated as rows are rendered
+        this.first_row = 0;
+        this.last_row = 0; // exclusive
+        this.rows = new Map(); // scene position in the index => tr element
+        this.update_pending = false;
+
+        this.top_spacer = this.create_spacer();
+        this.bottom_spacer = this.create_spacer();
+        this.tbody.appendChild(this.top_spacer);
+        this.tbody.appendChild(this.bottom_spacer);
+
+        window.addEventListener("scroll", () => this.request_update());
+        window.addEventListener("resize", () => this.request_update());
+    }
+
+    get scenes() {
+        return this.html_view.index;
+    }
+
+    create_spacer() {
+        let tr = document.createElement("tr");
+        let td = document.createElement("td");
+        td.setAttribute("colspan", "100%");
+        td.style.padding = "0px";
+        tr.appendChild(td);
+        return tr;
+    }
+
+    set_spacer_height(spacer, height) {
+        spacer.style.height = height + "px";
+        spacer.style.display = height > 0 ? "table-row" : "none";
+    }
+
+    request_update() {
+        // update the rendered rows at the next animation frame, coalescing scroll events
+        if (!this.update_pending) {
+            this.update_pending = true;
+            window.requestAnimationFrame(() => {
+                this.update_pending = false;
+                this.update();
+            });
+        }
+    }
+
+    update() {
+        if (this.table.offsetParent === null) {
+            return; // the grid view is not displayed
+        }
+        let n = this.scenes.length;
+        let tbody_top = this.tbody.getBoundingClientRect().top;
+        let first_row = Math.floor(-tbody_top / this.row_height) - this.buffer_rows;
+        let last_row = Math.ceil((window.innerHeight - tbody_top) / this.row_height) + this.buffer_rows;
+        first_row = Math.max(0, Math.min(n, first_row));
+        last_row = Math.max(first_row, Math.min(n, last_row));
+
+        // remove rows that are no longer needed and add the new ones
+        for (let [idx, tr] of this.rows) {
+            if (idx < first_row || idx >= last_row) {
+                this.remove_row(tr);
+                this.rows.delete(idx);
+            }
+        }
+        let next = this.bottom_spacer;
+        for (let idx = last_row - 1; idx >= first_row; idx--) {
+            let tr = this.rows.get(idx);
+            if (!tr) {
+                tr = this.create_row(idx);
+                this.rows.set(idx, tr);
+                this.tbody.insertBefore(tr, next);
+            }
+            next = tr;
+        }
+        this.first_row = first_row;
+        this.last_row = last_row;
+
+        // if rendered rows are taller than expected, use their height from now on
+        let row_height = this.row_height;
+        this.rows.forEach(tr => {
+            row_height = Math.max(row_height, tr.offsetHeight);
+        });
+        this.rows.forEach(tr => {
+            tr.style.height = row_height + "px";
+        });
+        this.set_spacer_height(this.top_spacer, first_row * row_height);
+        this.set_spacer_height(this.bottom_spacer, (n - last_row) * row_height);
+        if (row_height > this.row_height) {
+            this.row_height = row_height;
+            this.request_update();
+        }
+    }
+
+    refresh() {
+        // discard all rendered rows and render them again
+        this.rows.forEach(tr => this.remove_row(tr));
+        this.rows.clear();
+        this.update();
+    }
+
+    remove_row(tr) {
+        tr.querySelectorAll("img").forEach(img => {
+            this.html_view.image_observer.unobserve(img);
+        });
+        tr.remove();
+    }
+
+    create_row(idx) {
+        let scene = this.scenes[idx];
+        let tr = document.createElement("tr");
+
+        let open_btn = document.createElement("button");
+        open_btn.setAttribute("id", "open_" + idx + "_btn");
+        open_btn.appendChild(document.createTextNode("Open: " + scene.original_index));
+        open_btn.addEventListener("click", this.html_view.create_open_callback(idx));
+        this.add_cell(tr, open_btn);
+
+        if (this.spec.info) {
+            this.add_cell(tr, this.create_info_table(scene));
+        }
+
+        if (this.spec.labels) {
+            this.add_cell(tr, this.create_label_controls(scene.pos));
+        }
+
+        let image_width = this.spec.image_width;
+        let image_height = this.spec.image_height;
+        let image_srcs = scene.image_srcs;
+        this.spec.layers.forEach(layer_name => {
+            let div = document.createElement("div");
+            div.style.width = image_width + "px";
+            div.style.height = image_height + "px";
+            div.appendChild(this.create_image(layer_name, scene, image_srcs[layer_name], image_height));
+            this.add_cell(tr, div);
+        });
+        this.spec.histograms.forEach(layer_name => {
+            this.add_cell(tr, this.create_image(layer_name, scene, image_srcs[layer_name], null));
+        });
+        return tr;
+    }
+
+    add_cell(tr, content) {
+        let td = document.createElement("td");
+        td.appendChild(content);
+        tr.appendChild(td);
+    }
+
+    create_image(layer_name, scene, src, height) {
+        // create an img which is loaded lazily by the html view when it becomes visible
+        let img = document.createElement("img");
+        img.setAttribute("id", layer_name + "_grid_" + scene.pos);
+        img.setAttribute("alt", scene.timestamp);
+        img.setAttribute("width", String(this.spec.image_width));
+        if (height !== null) {
+            img.setAttribute("height", String(height));
+        }
+        img.setAttribute("src", "");
+        img.setAttribute("load_url", src);
+        this.html_view.image_observer.observe(img);
+        return img;
+    }
+
+    create_info_table(scene) {
+        let btn = document.createElement("button");
+        btn.setAttribute("class", "info_table");
+        btn.style.maxHeight = this.spec.image_width + "px";
+        let tbl = document.createElement("table");
+        tbl.setAttribute("class", "info_table");
+        tbl.style.width = this.spec.image_width + "px";
+        btn.appendChild(tbl);
+        this.html_view.scene_index.get_info(scene).then(info => {
+            let tbody = document.createElement("tbody");
+            for (let key in info) {
+                let tr = document.createElement("tr");
+                [key, info[key]].forEach(text => {
+                    let td = document.createElement("td");
+                    td.appendChild(document.createTextNode(text));
+                    tr.appendChild(td);
+                });
+                tbody.appendChild(tr);
+            }
+            tbl.appendChild(tbody);
+        }, e => {
+            console.log("Unable to load scene info: " + e);
+        });
+        return btn;
+    }
+
+    create_label_controls(pos) {
+        let div = document.createElement("div");
+        let values = this.html_view.labels ? this.html_view.labels.values : {};
+        for (let label_group in this.spec.labels) {
+            let fieldset = document.createElement("fieldset");
+            fieldset.style.width = this.spec.image_width + "px";
+            let legend = document.createElement("legend");
+            legend.appendChild(document.createTextNode(label_group));
+            fieldset.appendChild(legend);
+            let current_value = label_group in values ? values[label_group][pos] : null;
+            this.spec.labels[label_group].forEach(label => {
+                let control_id = this.html_view.get_label_control_id(label_group, label, pos);
+                let input = document.createElement("input");
+                input.setAttribute("type", "radio");
+                input.setAttribute("name", "label_group_" + label_group + "_" + pos);
+                input.setAttribute("value", label);
+                input.setAttribute("id", control_id);
+                input.checked = (label === current_value);
+                if (this.html_view.labels) {
+                    input.addEventListener("click",
+                        this.html_view.create_grid_label_control_callback(label_group, label, pos));
+                }
+                let lbl = document.createElement("label");
+                lbl.setAttribute("for", control_id);
+                lbl.appendChild(document.createTextNode(label));
+                fieldset.appendChild(input);
+                fieldset.appendChild(lbl);
+            });
+            div.appendChild(fieldset);
+        }
+        return div;
+    }
+
+    update_label(label_group, pos, label) {
+        // check the control for a label updated elsewhere, if its row is rendered
+        let control = document.getElementById(this.html_view.get_label_control_id(label_group, label, pos));
+        if (control) {
+            control.checked = true;
+        }
+    }
+}
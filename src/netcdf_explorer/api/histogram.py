@@ -20,14 +20,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import math
-import numpy as np
+import os
+import warnings
 
-import matplotlib.pyplot as plt
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 
 class Histogram:
 
-    def __init__(self, layer_name, label, band, threshold=None, min_value=None, max_value=None, bin_width=1):
+    # colours of the bars below and at or above the threshold
+    colours = [(31, 119, 180), (255, 127, 14)]
+
+    def __init__(self, layer_name, label, band, threshold=None, min_value=None, max_value=None, bin_width=1,
+                 width=640, height=480, font_path=None, block_size=64):
         self.layer_name = layer_name
         self.label = label
         self.band = band
@@ -35,25 +40,129 @@ class Histogram:
         self.min_value = min_value
         self.max_value = max_value
         self.bin_width = bin_width
+        self.width = width
+        self.height = height
+        self.font_path = font_path if font_path else os.path.join(os.path.split(__file__)[0],"..","misc","Roboto-Black.ttf")
+        self.block_size = block_size
+        self.case_counts = None # list of (first_edge, bin_width, counts_below, counts_above) per case, see compute
 
-    def build(self,ds,path):
-        data = ds[self.band]
-        min_v = data.min(skipna=True).item()
-        max_v = data.max(skipna=True).item()
-        if math.isnan(min_v) or math.isnan(max_v):
-            return
-        min_v = math.floor(min_v) if self.min_value is None else self.min_value
-        max_v = math.ceil(max_v) if self.max_value is None else self.max_value
-        bin_width = 1 if self.bin_width is None else self.bin_width
-        bins = np.arange(min_v, max_v, bin_width)
-        plt.cla()
+    def compute(self, ds, case_dimension):
+        """
+        Compute the bin counts for every case, processing blocks of cases at once
+
+        Arguments:
+            ds: the dataset containing the band, organised by the case dimension
+            case_dimension: the name of the case dimension
+        """
+        data = ds[self.band].transpose(case_dimension, ...)
+        n = data.shape[0]
+        thresholds = None
         if self.threshold is not None:
-            threshold = self.threshold
             # if the threshold is a string use it to look up a variable with this name to get the threshold value
-            if isinstance(threshold, str):
-                threshold = ds[threshold].item()
-            data.where(data < threshold, np.nan).plot.hist(bins=bins)
-            data.where(data >= threshold, np.nan).plot.hist(bins=bins)
+            if isinstance(self.threshold, str):
+                thresholds = np.broadcast_to(ds[self.threshold].values, (n,))
+            else:
+                thresholds = np.full(n, self.threshold)
+        self.case_counts = []
+        for start in range(0, n, self.block_size):
+            end = min(n, start + self.block_size)
+            block = data[start:end].values.reshape((end - start, -1))
+            self.case_counts += self.count(block, thresholds[start:end] if thresholds is not None else None)
+
+    def count(self, block, thresholds):
+        # count the values of each row of block (one row per case) into bins, split by the threshold for each row
+        # bins run from the floor of the minimum value (or min_value) in steps of bin_width up to but not including
+        # the ceiling of the maximum value (or max_value), the last bin including its upper edge
+        ncases = block.shape[0]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            min_vs = np.nanmin(block, axis=1)
+            max_vs = np.nanmax(block, axis=1)
+        bin_width = 1 if self.bin_width is None else self.bin_width
+        first_edges = np.floor(min_vs) if self.min_value is None else np.full(ncases, float(self.min_value))
+        stops = np.ceil(max_vs) if self.max_value is None else np.full(ncases, float(self.max_value))
+        with np.errstate(invalid="ignore"):
+            nbins = np.where(np.isnan(min_vs), 0, np.maximum(np.ceil((stops - first_edges) / bin_width) - 1, 0))
+        nbins = nbins.astype(np.int64)
+        # each case's bins follow those of the previous case, so the total number of bins is the sum for all cases
+        offsets = np.concatenate([[0], np.cumsum(nbins)])
+        total_bins = int(offsets[-1])
+
+        with np.errstate(invalid="ignore"):
+            bin_indices = np.floor((block - first_edges[:, None]) / bin_width)
+            last_edges = first_edges + nbins * bin_width
+            bin_indices = np.where(block == last_edges[:, None], nbins[:, None] - 1, bin_indices)
+            valid = (bin_indices >= 0) & (bin_indices < nbins[:, None])
+        groups = (offsets[:-1, None] + np.where(valid, bin_indices, 0)).astype(np.int64)
+        if thresholds is not None:
+            with np.errstate(invalid="ignore"):
+                above = block >= thresholds[:, None]
+            counts_below = np.bincount(groups[valid & ~above], minlength=total_bins)
+            counts_above = np.bincount(groups[valid & above], minlength=total_bins)
         else:
-            data.plot.hist(bins=bins)
-        plt.savefig(path)
\ No newline at end of file
+            counts_below = np.bincount(groups[valid], minlength=total_bins)
+            counts_above = None
+
+        results = []
+        for case in range(ncases):
+            if np.isnan(min_vs[case]) or np.isnan(max_vs[case]):
+                results.append(None)
+                continue
+            row = slice(offsets[case], offsets[case + 1])
+            results.append((first_edges[case], bin_width, counts_below[row],
+                            counts_above[row] if counts_above is not None else None))
+        return results
+
+    def build(self, ds, path, index=None):
+        """
+        Draw the histogram for a case
+
+        Arguments:
+            ds: the dataset for this case
+            path: the path to write the PNG image to
+            index: the index of the case, to use the counts from compute if it has been called
+        """
+        if self.case_counts is not None and index is not None:
+            counts = self.case_counts[index]
+        else:
+            thresholds = None
+            if self.threshold is not None:
+                threshold = self.threshold
+                if isinstance(threshold, str):
+                    threshold = ds[threshold].item()
+                thresholds = np.array([threshold])
+            counts = self.count(ds[self.band].values.reshape((1, -1)), thresholds)[0]
+        if counts is None:
+            return
+        self.render(*counts, path)
+
+    def render(self, first_edge, bin_width, counts_below, counts_above, path):
+        # draw the histogram bars with axes labelled with the range of values and the maximum count
+        im = Image.new("RGB", (self.width, self.height), (255, 255, 255))
+        draw = ImageDraw.Draw(im)
+        font = ImageFont.truetype(self.font_path, size=14)
+        (left, right, top, bottom) = (70, self.width - 30, 20, self.height - 40)
+
+        nbins = len(counts_below)
+        max_count = int(counts_below.max()) if nbins else 0
+        if counts_above is not None and nbins:
+            max_count = max(max_count, int(counts_above.max()))
+        bar_width = (right - left) / max(nbins, 1)
+        for (colour, counts) in zip(Histogram.colours, [counts_below, counts_above]):
+            if counts is None or max_count == 0:
+                continue
+            for (bin_index, bin_count) in enumerate(counts):
+                if bin_count:
+                    x0 = left + bin_index * bar_width
+                    y0 = bottom - (bottom - top) * bin_count / max_count
+                    draw.rectangle([round(x0), round(y0), max(round(x0), round(x0 + bar_width) - 1), bottom],
+                                   fill=colour)
+
+        draw.line([(left, top), (left, bottom), (right, bottom)], fill=(0, 0, 0), width=1)
+        for (x, value) in [(left, first_edge), (right, first_edge + nbins * bin_width)]:
+            draw.line([(x, bottom), (x, bottom + 5)], fill=(0, 0, 0))
+            draw.text((x, bottom + 8), f"{value:g}", fill=(0, 0, 0), font=font, anchor="mt")
+        for (y, value) in [(bottom, 0), (top, max_count)]:
+            draw.line([(left - 5, y), (left, y)], fill=(0, 0, 0))
+            draw.text((left - 8, y), str(value), fill=(0, 0, 0), font=font, anchor="rm")
+        im.save(path)
@@ -21,7 +21,6 @@
 # SOFTWARE.
 
 import csv
-import datetime
 import math
 import os
 import sys
@@ -34,11 +33,16 @@ from mako.template import Template
 import pyproj
 import logging
 import copy
+import warnings
 
 from .histogram import Histogram
+from .region_aggregator import RegionAggregator
+from .timeseries_encoder import TimeseriesEncoder
 
 from .layers import LayerFactory, LayerSingleBand, LayerWMS
 from .expr_parser import ExpressionParser
+from .expr_compiler import ExpressionCompiler
+from .derived_band import DerivedBandArray
 
 from netcdf_explorer.htmlfive.html5_builder import Html5Builder, ElementFragment
 
@@ -51,12 +55,22 @@ from netcdf_explorer.fragments.select import SelectFragment
 src_folder = os.path.split(__file__)[0]
 
 js_paths = [os.path.join(src_folder, "cmap.js"),
+            os.path.join(src_folder, "data_codec.js"),
+            os.path.join(src_folder, "data_worker_pool.js"),
             os.path.join(src_folder, "data_image.js"),
+            os.path.join(src_folder, "scene_index.js"),
+            os.path.join(src_folder, "scene_cache.js"),
+            os.path.join(src_folder, "grid_view.js"),
             os.path.join(src_folder, "leaflet_map.js"),
             os.path.join(src_folder, "timeseries_chart.js"),
             os.path.join(src_folder, "terrain_view.js"),
             os.path.join(src_folder, "html_view.js")]
 
+# scripts combined into worker.js, run by the web workers that load and colour data layers
+worker_js_paths = [os.path.join(src_folder, "cmap.js"),
+            os.path.join(src_folder, "data_codec.js"),
+            os.path.join(src_folder, "data_worker.js")]
+
 css_path = os.path.join(src_folder, "index.css")
 
 dygraph_dependency_paths = [os.path.join(src_folder,"..","dependencies","dygraph.css"),
@@ -65,6 +79,12 @@ dygraph_dependency_paths = [os.path.join(src_folder,"..","dependencies","dygraph
 babylonjs_dependency_paths = [os.path.join(src_folder,"..","dependencies","babylon.js"),
                     os.path.join(src_folder,"..","dependencies","babylonTerrain.js")]
 
+# scene info is written to separate files ("pages") each holding this many scenes, loaded by the browser on demand
+info_page_size = 500
+
+# statistics recorded for each case and layer, as the layer images are rendered
+stats_fields = ["min", "max", "mean", "valid_fraction", "nan_count"]
+
 class Progress(object):
 
     def __init__(self,label):
@@ -121,7 +141,9 @@ class HTMLGenerator:
         self.output_html_path = os.path.join(output_folder, "index.html")
         self.filter_controls = filter_controls
         self.info = config.get("info",{})
+        self.info_templates = {key: Template(value) for (key, value) in self.info.items()}
         self.crs = config.get("crs",None)
+        self.case_centroids = None # (lons, lats) arrays indexed by case, computed when first needed
         self.labels = config.get("labels",None)
         self.logger = logging.getLogger("generate_html")
         self.timeseries = config.get("timeseries",{})
@@ -166,6 +188,14 @@ class HTMLGenerator:
         with open(os.path.join(self.output_folder, "index.js"), "w") as f:
             f.write(js_code)
 
+        worker_js_code = ""
+        for js_path in worker_js_paths:
+            with open(js_path) as f:
+                worker_js_code += f.read()
+
+        with open(os.path.join(self.output_folder, "worker.js"), "w") as f:
+            f.write(worker_js_code)
+
         shutil.copyfile(css_path, os.path.join(self.output_folder, "index.css"))
         if download_from:
             shutil.copyfile(download_from, os.path.join(self.output_folder, self.netcdf_download_filename))
@@ -187,11 +217,17 @@ class HTMLGenerator:
         self.layer_definitions = []
 
         self.layer_images = []
+        self.layer_stats = [] # for each entry in layer_images, a dictionary mapping layer name to its statistics
         self.layer_data = []
         self.layer_legends = {}
 
+        # url patterns for each layer's image and data, where {index} is substituted by the case index
+        self.image_src_patterns = {}
+        self.data_src_patterns = {}
+
         self.timeseries_definitions = []
         self.histogram_definitions = []
+        self.grid_spec = None
 
         if self.x_coordinate:
             self.input_ds = self.reduce_coordinate_dimension(self.input_ds, self.x_coordinate, self.case_dimension)
@@ -272,70 +308,25 @@ class HTMLGenerator:
                 flattened_layers.append(layer)
         return flattened_layers
 
+    def get_stats_layer_names(self):
+        # get the names of layers for which per-case statistics were recorded
+        layer_names = []
+        for case_stats in self.layer_stats:
+            for layer_name in case_stats:
+                if layer_name not in layer_names:
+                    layer_names.append(layer_name)
+        return layer_names
+
     def build_derived_bands(self):
+        # derived bands are evaluated lazily, only for the parts of the band that are used
+        # subexpressions shared between derived bands are computed once for each part
+        compiler = ExpressionCompiler()
         for (band_name, band_expression) in self.derive_bands.items():
-            from_bands = []
             parsed_expression = self.parser.parse(band_expression)
             try:
-                arr = self.evaluate_expression(parsed_expression, from_bands)
+                self.input_ds[band_name] = DerivedBandArray.create(self.input_ds, parsed_expression, compiler)
             except Exception as ex:
                 self.logger.warning(f"Unable to derive band {band_name}: {str(ex)}")
-                continue
-            dims = []
-            # the dimensions of the derived band should match the longest dimensions of the input bands
-            for band in from_bands:
-                if len(self.input_ds[band].dims) > len(dims):
-                    dims = self.input_ds[band].dims
-            self.input_ds[band_name] = xr.DataArray(arr,dims=dims)
-
-    def evaluate_expression(self, parsed_expression, from_bands_accumulator):
-        if "name" in parsed_expression:
-            source_band = parsed_expression["name"]
-            if source_band in self.input_ds:
-                from_bands_accumulator.append(source_band)
-                return self.input_ds[source_band].data
-            else:
-                raise Exception(f"Expression references unknown band: {source_band}")
-        elif "operator" in parsed_expression:
-            operator = parsed_expression["operator"]
-            args = parsed_expression["args"]
-            arrays = []
-            for arg in args:
-                arrays.append(self.evaluate_expression(arg,from_bands_accumulator))
-            if operator == "==":
-                assert len(args) == 2
-                return np.equal(arrays[0],arrays[1])
-            elif operator == "&":
-                assert len(args) == 2
-                return np.bitwise_and(np.astype(arrays[0],int),np.astype(arrays[1],int))
-            elif operator == "|":
-                assert len(args) == 2
-                return np.bitwise_or(np.astype(arrays[0],int), np.astype(arrays[1],int))
-            elif operator == "and":
-                assert len(args) == 2
-                return np.logical_and(np.astype(arrays[0],int),np.astype(arrays[1],int))
-            elif operator == "or":
-                assert len(args) == 2
-                return np.logical_or(np.astype(arrays[0],int), np.astype(arrays[1],int))
-            elif operator == "not":
-                assert(len(args) == 1)
-                return np.logical_not(arrays[0])
-            elif operator == "*":
-                assert len(args) == 2
-                return np.multiply(arrays[0],arrays[1])
-            elif operator == "/":
-                assert len(args) == 2
-                return np.divide(arrays[0],arrays[1])
-            elif operator == "+":
-                assert len(args) == 2
-                return np.add(arrays[0],arrays[1])
-            elif operator == "-":
-                assert len(args) == 2
-                return np.subtract(arrays[0], arrays[1])
-            else:
-                raise Exception(f"Unknown operator: {operator}")
-        elif "literal" in parsed_expression:
-            return np.array([parsed_expression["literal"]])
 
     def reduce_coordinate_dimension(self, ds, coordinate_name, case_dimension):
         dims = ds[coordinate_name].dims
@@ -434,25 +425,28 @@ class HTMLGenerator:
             d.add_fragment(fieldset)
         return d
 
-    def generate_info_table(self, index, ds):
-        d = self.generate_info_dict(index, ds)
-        tf = TableFragment(attrs={"class":"info_table"},style={"width":"%dpx"%self.grid_image_width})
-        for (key,value) in d.items():
-            tf.add_row([key,value])
-        ef = ElementFragment("button", attrs={"class": "info_table"},style={"max-height":"%dpx"%self.grid_image_width}).add_fragment(tf)
-        return ef
+    def get_case_centroids(self):
+        # get the (lon, lat) of the mean x and y coordinates of every case, transformed in one call
+        n = len(self.input_ds[self.case_dimension])
+        means = []
+        for coordinate in [self.x_coordinate, self.y_coordinate]:
+            da = self.input_ds[coordinate]
+            mean = da.mean(dim=[dim for dim in da.dims if dim != self.case_dimension]).values
+            means.append(np.broadcast_to(mean, (n,)))
+        transformer = pyproj.Transformer.from_crs(self.crs, "EPSG:4326", always_xy=True)
+        return transformer.transform(means[0], means[1])
 
     def generate_info_dict(self, index, ds):
         d = {}
         variables = { "data": ds, "index":index }
         if self.crs:
-            transformer = pyproj.Transformer.from_crs(self.crs, "EPSG:4326", always_xy=True)
-            lon, lat = transformer.transform(ds[self.x_coordinate].mean().item(), ds[self.y_coordinate].mean().item())
-            variables["lon"] = lon
-            variables["lat"] = lat
+            if self.case_centroids is None:
+                self.case_centroids = self.get_case_centroids()
+            (lons, lats) = self.case_centroids
+            variables["lon"] = float(lons[index])
+            variables["lat"] = float(lats[index])
 
-        for (key,value) in self.info.items():
-            template = Template(value)
+        for (key,template) in self.info_templates.items():
             try:
                 d[key] = template.render(**variables)
             except Exception as ex:
@@ -514,26 +508,37 @@ class HTMLGenerator:
                     (src, path) = self.get_image_path(layer_definition.layer_name)
                     layer_definition.build(self.input_ds, path)
                     static_image_srcs[layer_definition.layer_name] = src
+                    self.image_src_patterns[layer_definition.layer_name] = src
                     if layer_definition.save_data():
                         (data_src, data_path) = self.get_data_path(layer_definition.layer_name)
                         data_options = layer_definition.build_data(self.input_ds, data_path)
                         static_data_srcs[layer_definition.layer_name] = {"url": data_src, "options": data_options}
+                        self.data_src_patterns[layer_definition.layer_name] = static_data_srcs[layer_definition.layer_name]
+
+            # count the histogram bins for all cases at once
+            for histogram_definition in self.histogram_definitions:
+                histogram_definition.compute(self.input_ds, self.case_dimension)
 
             for (index, timestamp, ds) in cases:
                 p.report("",index/n)
                 image_srcs = {}
                 histogram_srcs = {}
                 data_srcs = {}
+                case_stats = {}
 
                 for layer_definition in self.flatten_layers(self.layer_definitions):
                     if layer_definition.get_case_wise():
                         (src, path) = self.get_image_path(layer_definition.layer_name, index=index)
                         layer_definition.build(ds, path)
                         image_srcs[layer_definition.layer_name] = src
+                        if layer_definition.get_stats() is not None:
+                            case_stats[layer_definition.layer_name] = layer_definition.get_stats()
+                        self.image_src_patterns[layer_definition.layer_name] = self.get_image_path(layer_definition.layer_name, index="{index}")[0]
                         if layer_definition.save_data():
                             (data_src, data_path) = self.get_data_path(layer_definition.layer_name, index)
                             data_options = layer_definition.build_data(ds, data_path)
                             data_srcs[layer_definition.layer_name] = {"url":data_src, "options":data_options}
+                            self.data_src_patterns[layer_definition.layer_name] = {"url": self.get_data_path(layer_definition.layer_name, index="{index}")[0], "options": data_options}
                     else:
                         image_srcs[layer_definition.layer_name] = static_image_srcs[layer_definition.layer_name]
                         if layer_definition.save_data():
@@ -541,8 +546,9 @@ class HTMLGenerator:
 
                 for histogram_definition in self.histogram_definitions:
                     (src, path) = self.get_image_path(histogram_definition.layer_name, index=index)
-                    histogram_definition.build(ds, path)
+                    histogram_definition.build(ds, path, index)
                     image_srcs[histogram_definition.layer_name] = src
+                    self.image_src_patterns[histogram_definition.layer_name] = self.get_image_path(histogram_definition.layer_name, index="{index}")[0]
 
                 if self.labels:
                     for label_group in self.labels:
@@ -555,6 +561,7 @@ class HTMLGenerator:
 
 
                 self.layer_images.append((index, timestamp, image_srcs, data_srcs, ds))
+                self.layer_stats.append(case_stats)
 
             p.complete("Done")
 
@@ -606,11 +613,15 @@ class HTMLGenerator:
             terrain_container_div = container_div.add_element("div", {"id": "terrain_container", "style":"display:none;"})
             self.build_terrain_view(terrain_container_div, builder)
 
-        scenes = { "layers":[], "index": [], "layer_groups":{} }
+        scenes = { "layers":[], "layer_groups":{}, "image_srcs": self.image_src_patterns, "data_srcs": self.data_src_patterns,
+                   "timestamps": [], "positions": [] }
 
         if self.terrain_view:
             scenes["terrain_view"] = self.terrain_view
 
+        if self.grid_spec:
+            scenes["grid"] = self.grid_spec
+
         for layer_definition in self.flatten_layers(self.layer_definitions):
             layer_dict = {"name": layer_definition.layer_name, "label": layer_definition.layer_label, "has_data": layer_definition.save_data()}
             if isinstance(layer_definition,LayerWMS):
@@ -625,29 +636,51 @@ class HTMLGenerator:
                     scenes["layer_groups"][group_layer_name] = []
                 scenes["layer_groups"][group_layer_name].append(layer_definition.layer_name)
 
-        for (index, timestamp, layer_sources, data_sources, ds) in self.layer_images:
-
-            info = {}
-            if self.info:
-                info = self.generate_info_dict(index, ds)
+        # write per-scene values as arrays, with the (possibly large) scene info split into separately loaded pages
+        wms_layers = [layer for layer in self.flatten_layers(self.layer_definitions) if isinstance(layer, LayerWMS)]
+        if wms_layers:
+            scenes["bounds"] = []
 
-            scene_dict = {"timestamp": timestamp if timestamp is not None else "", "image_srcs": layer_sources,
-                               "data_srcs": data_sources, "info": info, "pos":index}
-            for layer_definition in self.flatten_layers(self.layer_definitions):
-                if isinstance(layer_definition, LayerWMS):
-                    ((x_min, y_min), (x_max, y_max)) = layer_definition.get_bounds(ds)
-                    scene_dict["x_min"] = x_min
-                    scene_dict["x_max"] = x_max
-                    scene_dict["y_min"] = y_min
-                    scene_dict["y_max"] = y_max
+        for (index, timestamp, layer_sources, data_sources, ds) in self.layer_images:
+            scenes["timestamps"].append(timestamp if timestamp is not None else "")
+            scenes["positions"].append(index)
+            if wms_layers:
+                ((x_min, y_min), (x_max, y_max)) = wms_layers[-1].get_bounds(ds)
+                scenes["bounds"].append([x_min, y_min, x_max, y_max])
 
-            scenes["index"].append(scene_dict)
+        if self.info:
+            info_folder = os.path.join(self.output_folder, "info")
+            os.makedirs(info_folder, exist_ok=True)
+            scenes["info_page_size"] = info_page_size
+            scenes["info_pages"] = []
+            for page_start in range(0, len(self.layer_images), info_page_size):
+                page = []
+                for (index, _, _, _, ds) in self.layer_images[page_start:page_start+info_page_size]:
+                    page.append(self.generate_info_dict(index, ds))
+                info_src = f"info/info_{page_start//info_page_size}.json"
+                with open(os.path.join(self.output_folder, info_src), "w") as f:
+                    f.write(json.dumps(page, separators=(",", ":")))
+                scenes["info_pages"].append(info_src)
+
+        # write the per-case statistics of each layer as a separate file, with an array of values for each field
+        stats_layer_names = self.get_stats_layer_names()
+        if stats_layer_names:
+            stats = {"fields": stats_fields, "layers": {}}
+            for layer_name in stats_layer_names:
+                stats["layers"][layer_name] = {}
+                for field in stats_fields:
+                    stats["layers"][layer_name][field] = [case_stats.get(layer_name, {}).get(field, None)
+                                                          for case_stats in self.layer_stats]
+            with open(os.path.join(self.output_folder, "stats.json"), "w") as f:
+                # the statistics are parsed in the browser, so must not contain NaN or infinite values
+                f.write(json.dumps(stats, separators=(",", ":"), allow_nan=False))
+            scenes["stats_src"] = "stats.json"
 
         scenes["data_width"] = self.data_width
         scenes["data_height"] = self.data_height
 
         with open(os.path.join(self.output_folder, "scenes.json"), "w") as f:
-            f.write(json.dumps(scenes,indent=4))
+            f.write(json.dumps(scenes, separators=(",", ":")))
 
         if image_width:
             builder.head().add_element("script").add_text("let image_width=" + json.dumps(image_width) + ";")
@@ -658,7 +691,8 @@ class HTMLGenerator:
                 timeseries.append({
                     "name": timeseries_name,
                     "spec": timeseries_spec,
-                    "csv_url": timeseries_detail["csv_url"],
+                    "csv_url": timeseries_detail.get("csv_url", None),
+                    "header_url": timeseries_detail.get("header_url", None),
                     "div_id": timeseries_detail["div_id"]
                 })
             with open(os.path.join(self.output_folder, "timeseries.json"), "w") as f:
@@ -666,7 +700,7 @@ class HTMLGenerator:
 
         self.logger.info(f"writing {self.output_html_path}")
         with open(self.output_html_path, "w") as f:
-            f.write(builder.get_html())
+            builder.write_html(f)
 
         if label_values:
             with open(os.path.join(self.output_folder, "labels.json"),"w") as f:
@@ -691,7 +725,7 @@ class HTMLGenerator:
                                                  "download": self.netcdf_download_filename}).add_text(
                 "download netcdf4")
 
-        tf = TableFragment()
+        tf = TableFragment(attrs={"id": "grid_table"})
 
         columns_hidden = [False]
         column_ids = ["index_col"]
@@ -774,38 +808,21 @@ class HTMLGenerator:
 
         tf.add_header_row(button_cells)
 
-        current_group_label = ""
-        row = 0
-        for (index, timestamp, layer_sources, _, ds) in self.layer_images:
-            cells = [self.generate_index_cell(row)]
-            if self.info:
-                cells += [self.generate_info_table(index,ds)]
-            if self.labels:
-                cells += [self.generate_label_controls(index)]
-            for layer_definition in self.flatten_layers(self.layer_definitions,only_grid_view=True)[::-1]:
-                src = layer_sources[layer_definition.layer_name]
-                width = self.grid_image_width if self.grid_image_width else image_width
-                height = round(self.grid_image_width * (image_height/image_width)) if self.grid_image_width else image_height
-                img = ImageFragment("", layer_definition.layer_name + "_grid_" + str(index), alt_text=timestamp,
-                                    w=width,
-                                    h=height,
-                                    load_url=src)
-                div = ElementFragment("div",{"style":f"width:{width}px;height:{height}px;"})
-                div.add_fragment(img)
-                cells.append(div)
-            for histogram_definition in self.histogram_definitions:
-                src = layer_sources[histogram_definition.layer_name]
-                img = ImageFragment("", histogram_definition.layer_name + "_grid_" + str(index), alt_text=timestamp,
-                                    w=self.grid_image_width if self.grid_image_width else image_width, load_url=src)
-                cells.append(img)
-            tf.add_row(cells)
-            row += 1
+        # the table rows are rendered in the browser (see grid_view.js) from this specification and the scene index
+        width = self.grid_image_width if self.grid_image_width else image_width
+        height = round(self.grid_image_width * (image_height/image_width)) if self.grid_image_width else image_height
+        self.grid_spec = {
+            "layers": [layer_definition.layer_name
+                       for layer_definition in self.flatten_layers(self.layer_definitions, only_grid_view=True)[::-1]],
+            "histograms": [histogram_definition.layer_name for histogram_definition in self.histogram_definitions],
+            "image_width": width,
+            "image_height": height,
+            "info": bool(self.info),
+            "labels": self.labels if self.labels else None
+        }
 
         grid_container_div.add_fragment(tf)
 
-    def generate_index_cell(self, index):
-        return ElementFragment("button",attrs={"id":f"open_{index}_btn"}).add_text("Open: "+str(index+1))
-
     def build_overlay_view(self, overlay_container_div, builder, image_width, image_height):
 
         overlay_container_div.add_element("input", {"type": "button", "id": "grid_view_btn", "value": "Show Grid View"})
@@ -938,6 +955,19 @@ class HTMLGenerator:
                 month_filter.add_element("span").add_text(month_name)
                 month_filter.add_element("input", {"id": f"month{month + 1}", "type": "checkbox", "checked": "checked"})
 
+            stats_layer_names = self.get_stats_layer_names()
+            if stats_layer_names:
+                # filter out scenes where too few pixels of a layer are valid
+                valid_filter = filter_fieldset.add_element("div", {})
+                valid_filter.add_element("span").add_text("Minimum valid %")
+                valid_filter.add_element("input", {"id": "stats_filter_min_valid", "type": "number",
+                                                   "min": "0", "max": "100", "value": "0"})
+                valid_filter.add_element("span").add_text("in")
+                layer_selector = valid_filter.add_element("select", {"id": "stats_filter_layer"})
+                layer_labels = {layer.layer_name: layer.layer_label for layer in self.flatten_layers(self.layer_definitions)}
+                for layer_name in stats_layer_names:
+                    layer_selector.add_element("option", {"value": layer_name}).add_text(layer_labels.get(layer_name, layer_name))
+
         if self.info:
             info_div = overlay_container_div.add_element("div",
                                                            {"id": "info_container", "class": "control_container"})
@@ -978,105 +1008,120 @@ class HTMLGenerator:
             variables = timeseries_spec["variables"]
             timeseries_type = timeseries_spec.get("type","timeseries")
 
-            data = []
             n = len(self.input_ds[self.time_coordinate])
 
-            years = set()
-
-            for i in range(n):
-                timestamp = str(self.input_ds[self.time_coordinate].data[i])[:19] if self.time_coordinate else None
-
-                data_slice = self.input_ds.isel(**{self.case_dimension: i})
-
-                dt = datetime.datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S")
-                years.add(dt.year)
-
-                rowdata = {"datetime": dt, "timestamp": timestamp}
+            # timestamps to the nearest second, with the year and day of year of each
+            times = self.input_ds[self.time_coordinate].data
+            timestamps = np.datetime_as_string(times, unit="s").tolist()
+            time_years = times.astype("datetime64[Y]")
+            case_years = (time_years.astype(int) + 1970).tolist()
+            case_doys = ((times.astype("datetime64[D]") - time_years).astype(int) + 1).tolist()
+            years = sorted(set(case_years))
+
+            columns = {} # column name => list of values, one per case
+
+            if source_masks:
+                # build a timseries for each combination of mask and variable
+                # masks which do not vary between cases are aggregated for all regions at once by a RegionAggregator
+                # others are applied to each variable and reduced over all dimensions except the case dimension
+                masks = {source_mask: self.input_ds[source_mask].squeeze() for source_mask in source_masks}
+                region_masks = {name: mask for (name, mask) in masks.items() if self.case_dimension not in mask.dims}
+                aggregator = None
+                if region_masks:
+                    region_dims = next(iter(region_masks.values())).dims
+                    region_masks = {name: mask.transpose(*region_dims) for (name, mask) in region_masks.items()
+                                    if set(mask.dims) == set(region_dims)}
+                    aggregator = RegionAggregator(region_masks, self.case_dimension)
+
+                for variable in variables:
+                    variable_components = variable.split(":")
+                    variable_name = variable_components[0]
+                    if len(variable_components) == 2:
+                        aggregation_fn = variable_components[1]
+                    else:
+                        aggregation_fn = "mean"
+                    da = self.input_ds[variable_name]
+                    aggregated = {}
+                    if aggregator is not None and aggregator.can_aggregate(da):
+                        aggregated = aggregator.aggregate(da, aggregation_fn)
 
-                if source_masks:
-                    # build a timseries for each combination of mask and variable
                     for source_mask in source_masks:
-                        mask_slice = self.input_ds[source_mask].squeeze()
-                        if self.case_dimension in mask_slice.dims:
-                            mask_slice = mask_slice.isel(**{self.case_dimension: i})
-
-                        for variable in variables:
-                            variable_components = variable.split(":")
-                            variable_name = variable_components[0]
-                            if len(variable_components) == 2:
-                                aggregation_fn = variable_components[1]
-                            else:
-                                aggregation_fn = "mean"
-                            values = xr.where(mask_slice, data_slice[variable_name], np.nan)
-                            if aggregation_fn == "mean":
-                                value = values.mean(skipna=True).item()
-                            elif aggregation_fn == "min":
-                                value = values.min(skipna=True).item()
-                            elif aggregation_fn == "max":
-                                value = values.max(skipna=True).item()
-                            elif aggregation_fn == "median":
-                                value = float(np.median(values.data))
+                        column = f"{source_mask}_{variable.replace(':', '_')}"
+                        if source_mask in aggregated:
+                            columns[column] = aggregated[source_mask].tolist()
+                            continue
+                        values = xr.where(masks[source_mask], da, np.nan)
+                        if self.case_dimension in values.dims:
+                            values = values.transpose(self.case_dimension, ...)
+                        # NaN values are ignored, as they are by the RegionAggregator
+                        reduce_fns = {"mean": np.nanmean, "min": np.nanmin, "max": np.nanmax,
+                                      "median": np.nanmedian}
+                        if aggregation_fn not in reduce_fns:
+                            raise Exception(f"Cannot apply unrecognised aggregation function {aggregation_fn}")
+                        arr = values.values.astype(float)
+                        with warnings.catch_warnings():
+                            # cases where the mask selects no values are expected, and give NaN
+                            warnings.simplefilter("ignore", category=RuntimeWarning)
+                            if self.case_dimension in values.dims:
+                                reduced = reduce_fns[aggregation_fn](arr.reshape((arr.shape[0], -1)), axis=1)
                             else:
-                                raise Exception(f"Cannot apply unrecognised aggregation function {aggregation_fn}")
-                            column = f"{source_mask}_{variable.replace(':', '_')}"
-                            rowdata[column] = value
+                                reduced = reduce_fns[aggregation_fn](arr)
+                        columns[column] = np.broadcast_to(reduced, (n,)).astype(float).tolist()
 
-                else:
-                    for variable in variables:
-                        value = data_slice[variable].item()
-                        rowdata[variable] = value
+            else:
+                for variable in variables:
+                    columns[variable] = self.input_ds[variable].values.reshape((n,)).tolist()
 
-                data.append(rowdata)
+            variable_names = []
+            if source_masks:
+                for source_mask in source_masks:
+                    for variable in variables:
+                        variable_names.append(f"{source_mask}_{variable.replace(':', '_')}")
+            else:
+                variable_names = variables
 
-            years = sorted(list(years))
+            if timeseries_type == "timeseries" and timeseries_spec.get("format", "csv") == "binary":
+                # write binary columns at several resolutions instead of a CSV file
+                header_filename = TimeseriesEncoder().encode(folder, timeseries_name, times, variable_names, columns)
+                timeseries_detail["header_url"] = os.path.join("timeseries", header_filename)
+                continue
 
             with open(csv_path, "w") as f:
                 writer = csv.writer(f)
-                variable_names = []
-                if source_masks:
-                    for source_mask in source_masks:
-                        for variable in variables:
-                            variable_names.append(f"{source_mask}_{variable.replace(':', '_')}")
-                else:
-                    variable_names = variables
 
                 if timeseries_type == "timeseries":
                     headers = ["datetime"] + variable_names
                     writer.writerow(headers)
-                    for rowdata in data:
-                        row = [rowdata["timestamp"]]
+                    for i in range(n):
+                        row = [timestamps[i]]
                         for header in headers[1:]:
-                            v = rowdata.get(header,"")
+                            v = columns[header][i]
                             if math.isnan(v):
                                 v = ""
                             row.append(v)
                         writer.writerow(row)
                 elif timeseries_type == "seasonal":
-                    headers = ["day"]+years
+                    # one column per year for each variable, with a row for each day of the year
+                    # cases are placed into the table in one pass, a later case replacing an earlier one on the same day
+                    if len(variable_names) == 1:
+                        headers = ["day"]+years
+                    else:
+                        headers = ["day"]+[f"{variable_name}_{year}" for variable_name in variable_names for year in years]
                     writer.writerow(headers)
 
-                    if len(variable_names) != 1:
-                        raise Exception(f"Can only produce a seasonal plot for timeseries {timeseries_name} with 1 variable, got {len(variable_names)} variables")
+                    year_positions = {year: pos for (pos, year) in enumerate(years)}
+                    table = [[""] * (len(headers) - 1) for _ in range(366)]
+                    for i in range(n):
+                        day_row = table[case_doys[i] - 1]
+                        year_pos = year_positions[case_years[i]]
+                        for (variable_pos, variable_name) in enumerate(variable_names):
+                            v = columns[variable_name][i]
+                            if math.isnan(v):
+                                v = ""
+                            day_row[variable_pos * len(years) + year_pos] = v
 
                     for day in range(1,367):
-                        values_by_year = {}
-                        for rowdata in data:
-                            dt = rowdata["datetime"]
-                            year = dt.year
-                            doy = dt.timetuple()[7]
-                            if doy == day:
-                                values_by_year[year] = rowdata[variable_names[0]]
-
-                        row = [day]
-                        for year in years:
-                            if year in values_by_year:
-                                v = values_by_year[year]
-                                if math.isnan(v):
-                                    v = ""
-                                row.append(v)
-                            else:
-                                row.append("")
-                        writer.writerow(row)
+                        writer.writerow([day] + table[day - 1])
 
             timeseries_detail["csv_url"] = os.path.join("timeseries", timeseries_name + ".csv")
 
@@ -39,6 +39,11 @@ class ImageFetcher {
 
     async fetch(image_id) {
         let img = document.getElementById(image_id);
+        if (!img) {
+            // the row containing this image has been removed from the grid view
+            this.pending_image_ids.delete(image_id);
+            return;
+        }
         let load_url = img.getAttribute("load_url");
         let response = await fetch(load_url);
         const blob = await response.blob();
@@ -58,10 +63,13 @@ class HtmlView {
 
     constructor() {
         this.scenes = {};
+        this.scene_index = null;
         this.index = [];
         this.current_index = 0;
         this.layer_opacities = {};
         this.months_excluded = {};
+        this.layer_stats = null; // per-case layer statistics, loaded when a statistics filter is first used
+        this.min_valid_fraction = 0;
         this.labels = null;
         this.di = null; // the dataimage used in the overlay view
 
@@ -81,6 +89,8 @@ class HtmlView {
         this.close_all_btn = document.getElementById("close_all_sliders");
         this.show_filters = document.getElementById("show_filters");
         this.filter_container = document.getElementById("filter_container");
+        this.stats_filter_min_valid = document.getElementById("stats_filter_min_valid"); // optional, may be undefined
+        this.stats_filter_layer = document.getElementById("stats_filter_layer"); // optional, may be undefined
         this.scene_label_elt = document.getElementById("scene_label");
 
         this.show_labels = document.getElementById("show_labels");
@@ -107,7 +117,7 @@ class HtmlView {
         this.terrain_zoom = document.getElementById("terrain_zoom");
         this.terrain_zoom_value = document.getElementById("terrain_zoom_value");
 
-        this.grid_label_controls = {}; // label_group => [label_value => label_control]
+        this.grid_view = null; // populated with a GridView object if there is a grid view
         this.overlay_label_controls = {}; // label_group => label_value => label_control
 
         this.download_labels_btn = document.getElementById("download_labels_btn"); // optional, may be undefined
@@ -124,6 +134,16 @@ class HtmlView {
         // record the last image url viewed in overlay mode for each layer
         this.overlay_urls = {};
 
+        // record the urls of images created by recolouring data layers, which must be released when replaced
+        this.recoloured_urls = {};
+
+        // cache scenes for the overlay view, prefetching this many scenes either side of the current scene
+        this.scene_cache = null;
+        this.scene_cache_bytes = 256 * 1024 * 1024;
+        this.prefetch_count = 2;
+        this.scene_image_urls = {};
+        this.show_counter = 0; // incremented on each call to show, to detect when a call has been superseded
+
         this.lm = null;
 
         this.timeseries_charts = null;
@@ -156,16 +176,17 @@ class HtmlView {
             "delay": 200 /* check every 200ms */
         };
 
-        const observer = new IntersectionObserver((entries, observer) => {
+        this.image_observer = new IntersectionObserver((entries, observer) => {
             this.intersection_callback(entries);
         }, intersection_options);
 
         // when img elements specify their urls using load_url attributes,
         // observe them and load the images lazily when they come into view
+        // (images in the grid view are observed by the GridView as their rows are created)
         let images = document.querySelectorAll("img");
         images.forEach((img) => {
             if (img.hasAttribute("load_url")) {
-                observer.observe(img);
+                this.image_observer.observe(img);
             }
         });
 
@@ -236,8 +257,9 @@ class HtmlView {
                     let name = o["name"];
                     let csv_url = o["csv_url"];
                     let spec = o["spec"];
+                    let header_url = o["header_url"];
                     let div_id = o["div_id"];
-                    let chart = new TimeseriesChart(div_id, csv_url, spec);
+                    let chart = new TimeseriesChart(div_id, csv_url, spec, header_url);
                     this.timeseries_charts[name] = chart;
                 });
             }
@@ -249,6 +271,9 @@ class HtmlView {
         // this needs to be called before init
         let r = await fetch("scenes.json");
         this.scenes = await r.json();
+        this.scene_index = new SceneIndex(this.scenes);
+        this.scenes.index = this.scene_index.index;
+        this.scene_cache = new SceneCache(this.scenes.layers, this.scene_cache_bytes);
 
         if (this.overlay_container) {
             this.lm = new LeafletMap('map', this.scenes.data_height, this.scenes.data_width,
@@ -306,7 +331,9 @@ class HtmlView {
             }
             let index = this.index[this.current_index].pos;
             this.labels.values[label_group][index] = label;
-            this.grid_label_controls[label_group][index][label].checked = true;
+            if (this.grid_view) {
+                this.grid_view.update_label(label_group, index, label);
+            }
             await this.notify_label_update(label_group, index, label);
         }
     }
@@ -315,7 +342,7 @@ class HtmlView {
         // create a callback to be called when a label is updated by a grid label control
         return async () => {
             this.labels.values[label_group][i] = label;
-            if (i === this.current_index) {
+            if (this.index.length > 0 && i === this.index[this.current_index].pos) {
                 this.overlay_label_controls[label_group][label].checked = true;
             }
             await this.notify_label_update(label_group, i, label);
@@ -330,7 +357,7 @@ class HtmlView {
             let new_cmap = select_control.value;
             this.data_layers[layer_name] = {"cmap": new_cmap, "vmin": new_min, "vmax": new_max}
             await cmap.load(new_cmap);
-            this.update_data_layer(layer_name);
+            await this.update_data_layer(layer_name);
         }
         select_control.addEventListener("change", cb);
         min_control.addEventListener("input", cb);
@@ -421,7 +448,8 @@ class HtmlView {
         }
 
         if (this.time_range) {
-            this.time_range.addEventListener("change", async (evt) => {
+            // load scenes while the slider is being dragged, superseded loads are cancelled
+            this.time_range.addEventListener("input", async (evt) => {
                 if (this.index.length) {
                     let fraction = Number.parseFloat(evt.target.value) / 100;
                     this.current_index = Math.round(fraction * (this.index.length - 1));
@@ -437,6 +465,12 @@ class HtmlView {
             }
         }
 
+        if (this.stats_filter_min_valid && this.stats_filter_layer) {
+            let callback = this.create_stats_filter_callback();
+            this.stats_filter_min_valid.addEventListener("change", callback);
+            this.stats_filter_layer.addEventListener("change", callback);
+        }
+
         this.scenes.layers.forEach(layer => {
             let group = this.get_layer_group(layer.name);
             this.layer_opacities[layer.name] = 1;
@@ -578,10 +612,9 @@ class HtmlView {
             });
         }
 
-        for (let i = 0; i < this.scenes.index.length; i++) {
-            let open_btn_id = "open_" + i + "_btn";
-            let btn = document.getElementById(open_btn_id);
-            btn.addEventListener("click", this.create_open_callback(i));
+        let grid_table = document.getElementById("grid_table");
+        if (grid_table && this.scenes.grid) {
+            this.grid_view = new GridView(this, grid_table, this.scenes.grid, 5);
         }
 
         if (this.labels) {
@@ -595,18 +628,6 @@ class HtmlView {
                     control.checked = false;
                     this.overlay_label_controls[label_group][label_value] = control;
                 }
-
-                this.grid_label_controls[label_group] = [];
-                for (let i = 0; i < this.labels.values[label_group].length; i++) {
-                    let label_controls = {};
-                    for (let label_idx in this.labels.schema[label_group]) {
-                        let label_value = this.labels.schema[label_group][label_idx];
-                        let control = document.getElementById(this.get_label_control_id(label_group, label_value, i));
-                        control.checked = false;
-                        label_controls[label_value] = control;
-                    }
-                    this.grid_label_controls[label_group].push(label_controls);
-                }
             }
 
             // set the values on the controls
@@ -616,8 +637,6 @@ class HtmlView {
                 for (let i = 0; i < values.length; i++) {
                     let value = values[i];
                     if (value) {
-                        this.grid_label_controls[label_group][i][value].checked = true;
-
                         if (i === this.current_index) {
                             this.overlay_label_controls[label_group][value].checked = true;
                         }
@@ -631,13 +650,6 @@ class HtmlView {
                     this.overlay_label_controls[label_group][label].addEventListener("click",
                         this.create_overlay_label_control_callback(label_group, label));
                 }
-                let grid_controls = this.grid_label_controls[label_group];
-                for (let i = 0; i < grid_controls.length; i++) {
-                    let controls = grid_controls[i];
-                    for (let label in controls) {
-                        controls[label].addEventListener("click", this.create_grid_label_control_callback(label_group, label, i));
-                    }
-                }
             }
         }
 
@@ -747,6 +759,9 @@ class HtmlView {
                 container.style.display = "block";
             }
         });
+        if (this.grid_view && target_container === this.grid_container) {
+            this.grid_view.refresh();
+        }
     }
 
     set_zoom(zoom) {
@@ -778,15 +793,25 @@ class HtmlView {
 
     update_filters() {
         // called from the overlay view after filters are updated
-        // rebuild the main index based on the new filter settings
+        // rebuild the main index based on the new filter settings, and the grid view rows from it
         this.current_index = 0;
         this.index = [];
         for (let idx = 0; idx < this.scenes.index.length; idx++) {
             let item = this.scenes.index[idx];
             let month = Number.parseInt(item.timestamp.slice(5, 7));
-            if (!(month in this.months_excluded)) {
-                this.index.push(item);
+            if (month in this.months_excluded) {
+                continue;
             }
+            if (this.layer_stats && this.min_valid_fraction > 0) {
+                let layer_stats = this.layer_stats[this.stats_filter_layer.value];
+                if (layer_stats && !(layer_stats.valid_fraction[item.idx] >= this.min_valid_fraction)) {
+                    continue;
+                }
+            }
+            this.index.push(item);
+        }
+        if (this.grid_view) {
+            this.grid_view.refresh();
         }
     }
 
@@ -804,6 +829,25 @@ class HtmlView {
         }
     }
 
+    create_stats_filter_callback() {
+        // create a callback for when the statistics filter controls are changed
+        return async () => {
+            let min_valid = Number.parseFloat(this.stats_filter_min_valid.value);
+            this.min_valid_fraction = Number.isNaN(min_valid) ? 0 : min_valid / 100;
+            if (this.layer_stats === null && this.min_valid_fraction > 0) {
+                try {
+                    this.layer_stats = await this.scene_index.get_stats();
+                } catch (e) {
+                    console.log("Unable to load scene statistics: " + e);
+                    return;
+                }
+            }
+            this.update_filters();
+            this.update_time_range();
+            await this.show();
+        }
+    }
+
     create_opacity_callback(layer_name) {
         // create a callback for changes to an overlay view opacity slider
         return (evt) => {
@@ -846,27 +890,40 @@ class HtmlView {
         info_content.appendChild(tbl);
     }
 
-    update_data_layer(layer_name) {
+    async update_data_layer(layer_name) {
         let dl = this.data_layers[layer_name];
-        let lurl = this.di.get_legend_url(dl.cmap, dl.vmin, dl.vmax, 20, 200);
-        let img_id = layer_name + "_legend_img";
-        document.getElementById(img_id).src = lurl;
-        this.update_image(layer_name);
+        let lurl = await this.di.get_legend_url(dl.cmap, dl.vmin, dl.vmax, 20, 200);
+        let img = document.getElementById(layer_name + "_legend_img");
+        this.release_url(img.src);
+        img.src = lurl;
+        this.overlay_urls[layer_name] = await this.update_image(layer_name);
     }
 
-    update_image(layer_name) {
-        let image_srcs = this.index[this.current_index].image_srcs;
+    async update_image(layer_name) {
         let url = "";
         if (layer_name in this.data_layers) {
             let dl = this.data_layers[layer_name];
-            url = this.di.get_image_url(layer_name, dl.cmap, dl.vmin, dl.vmax);
+            url = await this.di.get_image_url(layer_name, dl.cmap, dl.vmin, dl.vmax);
         } else {
-            url = image_srcs[layer_name];
+            url = this.scene_image_urls[layer_name];
         }
         this.lm.add_image_layer(layer_name, url);
+        this.release_url(this.recoloured_urls[layer_name]);
+        if (layer_name in this.data_layers) {
+            this.recoloured_urls[layer_name] = url;
+        } else {
+            delete this.recoloured_urls[layer_name];
+        }
         return url;
     }
 
+    release_url(url) {
+        // free the memory held by an object URL created when recolouring a data layer
+        if (url && url.startsWith("blob:")) {
+            URL.revokeObjectURL(url);
+        }
+    }
+
     open_spinner() {
         if (!this.spinner) {
             this.spinner = document.createElement("div");
@@ -882,23 +939,29 @@ class HtmlView {
         this.spinner = null;
     }
 
+    get_adjacent_scenes() {
+        // get the scenes to prefetch either side of the current scene in the index, nearest first
+        let scenes = [];
+        for (let offset = 1; offset <= this.prefetch_count; offset++) {
+            if (this.current_index + offset < this.index.length) {
+                scenes.push(this.index[this.current_index + offset]);
+            }
+            if (this.current_index - offset >= 0) {
+                scenes.push(this.index[this.current_index - offset]);
+            }
+        }
+        return scenes;
+    }
+
     async show() {
+        // called in the overlay view to show the currently selected scene
+        // may be called again before a previous call completes, in which case the earlier call is abandoned
+        this.show_counter += 1;
+        let show_counter = this.show_counter;
 
         this.overlay_updating = true;
-        if (this.time_range) {
-            this.time_range.disabled = true;
-        }
-        if (this.next_button) {
-            this.next_button.disabled = true;
-        }
-        if (this.prev_button) {
-            this.prev_button.disabled = true;
-        }
-
         this.open_spinner();
 
-        // called in the overlay view to show the currently selected scene
-
         if (this.index.length == 0) {
             // nothing to show, hide the imagery
             if (this.lm) {
@@ -911,6 +974,7 @@ class HtmlView {
             if (this.terrain_view_button) {
                 this.terrain_view_button.disabled = true;
             }
+            this.overlay_updating = false;
             this.close_spinner();
             return;
         } else {
@@ -919,31 +983,59 @@ class HtmlView {
             }
         }
 
-        this.di = new DataImage("viridis");
-        let data_srcs = this.index[this.current_index].data_srcs;
-        for (let layer_name in data_srcs) {
-            this.di.register_layer(layer_name);
-            await this.di.load(layer_name, data_srcs[layer_name]);
+        let scene = this.index[this.current_index];
+
+        if (this.scene_label_elt) {
+            let overlay_label = "(" + (this.current_index + 1) + "/" + this.index.length + ") " + scene.timestamp;
+            this.scene_label_elt.innerHTML = overlay_label;
         }
 
-        this.overlay_urls = {};
+        // fetch all layers of this scene concurrently, cancelling any fetches for scenes no longer needed
+        let adjacent_scenes = this.get_adjacent_scenes();
+        this.scene_cache.set_wanted([scene].concat(adjacent_scenes));
+        let info_promise = this.info_content ? this.scene_index.get_info(scene) : null;
+        let loaded = null;
+        let info = {};
+        try {
+            loaded = await this.scene_cache.get_scene(scene);
+            if (info_promise) {
+                info = await info_promise;
+            }
+        } catch (e) {
+            if (show_counter === this.show_counter) {
+                console.log("Unable to load scene: " + e.message);
+                this.overlay_updating = false;
+                this.close_spinner();
+            }
+            return;
+        }
 
-        let label_specs = this.index[this.current_index].label_specs;
+        if (show_counter !== this.show_counter) {
+            return; // superseded by a later call
+        }
+
+        this.di = new DataImage();
+        for (let layer_name in scene.data_srcs) {
+            this.di.register_layer(layer_name);
+            this.di.set_layer(layer_name, scene.data_srcs[layer_name], loaded.data[layer_name]);
+        }
+        this.scene_image_urls = loaded.image_urls;
 
         for (let idx = this.scenes.layers.length - 1; idx >= 0; idx = idx - 1) {
             let layer_name = this.scenes.layers[idx].name;
-            let image_url = this.update_image(layer_name);
+            let image_url = await this.update_image(layer_name);
             this.overlay_urls[layer_name] = image_url;
+            if (show_counter !== this.show_counter) {
+                return;
+            }
         }
 
-
         if (this.info_content) {
-            let info = this.index[this.current_index].info;
             this.populate_info(this.info_content, info);
         }
 
         if (this.labels) {
-            let pos = this.index[this.current_index].pos;
+            let pos = scene.pos;
             for (let label_group in this.labels.values) {
                 let label = this.labels.values[label_group][pos];
                 if (label) {
@@ -957,21 +1049,14 @@ class HtmlView {
             }
         }
 
-        if (this.scene_label_elt) {
-            let overlay_label = "0/0";
-            if (this.index.length) {
-                overlay_label = "(" + (this.current_index + 1) + "/" + this.index.length + ") " + this.index[this.current_index].timestamp;
-            }
-            this.scene_label_elt.innerHTML = overlay_label;
-        }
-
         this.overlay_updating = false;
 
-        this.time_range.disabled = false;
-        this.next_button.disabled = false;
-        this.prev_button.disabled = false;
-
         this.close_spinner();
+
+        // fetch the neighbouring scenes in the background, without waiting for them
+        this.scene_cache.prefetch(adjacent_scenes).catch(e => {
+            console.log("Unable to prefetch scenes: " + e.message);
+        });
     }
 
     async get_overlay_combined_image() {
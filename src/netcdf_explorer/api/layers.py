@@ -87,6 +87,27 @@ def save_image_discrete(arr,path,values):
     im = Image.fromarray(np.uint8((np.vectorize(get_rgba,signature='()->(n)')(arr))),mode="RGBA")
     im.save(path)
 
+def compute_stats(arr):
+    # summarise the values of an array that has been rendered, returning a dictionary
+    arr = np.asarray(arr)
+    if arr.dtype.kind not in "fc":
+        arr = arr.astype(np.float64)
+    nan_count = int(np.count_nonzero(np.isnan(arr)))
+    valid_count = arr.size - nan_count
+    stats = {"min": None, "max": None, "mean": None,
+             "valid_fraction": valid_count / arr.size if arr.size else 0.0, "nan_count": nan_count}
+    if valid_count:
+        stats["min"] = float(np.nanmin(arr))
+        stats["max"] = float(np.nanmax(arr))
+        with np.errstate(invalid="ignore"):
+            # the mean of infinite values of opposite signs is NaN
+            stats["mean"] = float(np.nanmean(arr, dtype=np.float64))
+    # infinite values (for example from a division by zero in a derived band) cannot be written to JSON
+    for field in ["min", "max", "mean"]:
+        if stats[field] is not None and not math.isfinite(stats[field]):
+            stats[field] = None
+    return stats
+
 class LayerGroup:
 
     def __init__(self, layer, converter, layer_name, layer_label, sublayers):
@@ -166,6 +187,7 @@ class LayerBase:
         self.case_wise = False
         self.grid_view = False
         self.overlay_view = False
+        self.stats = None # statistics of the data rendered by the most recent call to build, if available
 
     def set_group(self, group):
         self.group = group
@@ -241,6 +263,9 @@ class LayerBase:
     def save_data(self):
         return False
 
+    def get_stats(self):
+        return self.stats
+
     def get_sublayers(self):
         return None
 
@@ -274,6 +299,7 @@ class LayerRGB(LayerBase):
         red = self.get_data(ds[self.red_variable])
         green = self.get_data(ds[self.green_variable])
         blue = self.get_data(ds[self.blue_variable])
+        self.stats = compute_stats(np.stack([red, green, blue]))
         save_image_falsecolour(red, green, blue, path, red_gamma=self.red_gamma,
                                green_gamma=self.green_gamma, blue_gamma=self.blue_gamma)
 
@@ -301,7 +327,9 @@ class LayerSingleBand(LayerBase):
             self.set_case_wise(True)
 
     def build(self,ds,path):
-        save_image(self.get_data(ds[self.band_name]), self.vmin, self.vmax, path, self.cmap_name)
+        arr = self.get_data(ds[self.band_name])
+        self.stats = compute_stats(arr)
+        save_image(arr, self.vmin, self.vmax, path, self.cmap_name)
 
     def has_legend(self):
         return True
@@ -453,7 +481,9 @@ class LayerMask(LayerBase):
             self.set_case_wise(True)
 
     def build(self,ds,path):
-        save_image_mask(self.get_data(ds[self.band_name].astype(int)), path, self.r, self.g, self.b)
+        arr = self.get_data(ds[self.band_name].astype(int))
+        self.stats = compute_stats(arr)
+        save_image_mask(arr, path, self.r, self.g, self.b)
 
 class ImageLayerDiscrete(LayerBase):
 
@@ -477,7 +507,9 @@ class ImageLayerDiscrete(LayerBase):
             self.set_case_wise(True)
 
     def build(self,ds,path):
-        save_image_discrete(self.get_data(ds[self.band_name]), path, self.values)
+        arr = self.get_data(ds[self.band_name])
+        self.stats = compute_stats(arr)
+        save_image_discrete(arr, path, self.values)
 
     def has_legend(self):
         return False
@@ -0,0 +1,186 @@
+# MIT License
+#
+# Copyright (c) 2023-2024 National Centre for Earth Observation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import warnings
+
+import numpy as np
+import xarray as xr
+
+
+def reduce_pairs(arr, axis, method):
+    # halve the size of an array along an axis, by averaging or by taking the first of each pair of elements
+    # any odd element at the end is dropped
+    n = (arr.shape[axis] // 2) * 2
+    arr = np.take(arr, np.arange(n), axis=axis)
+    if method == "nearest":
+        return np.take(arr, np.arange(0, n, 2), axis=axis)
+    shape = arr.shape[:axis] + (n // 2, 2) + arr.shape[axis + 1:]
+    with warnings.catch_warnings():
+        # all-NaN pairs are expected, and give NaN
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(arr.reshape(shape), axis=axis + 1)
+
+
+class OverviewCache:
+    """
+    Build and reuse overview pyramids of the variables in netcdf4 files
+
+    An overview pyramid holds successive power-of-two reductions of a data array, computed by averaging (or for
+    nominal data, by taking the nearest value from) each 2x2 block of the previous level.  Each level is stored as a
+    compressed numpy (.npz) file in a cache folder, under a fingerprint of the input file's path, size and modification
+    time, so that a modified input file gets a new pyramid.  When a pyramid for the same input path is built, any
+    pyramids built before the file was last modified are removed.  Several processes may build and read pyramids in the
+    same folder at once.
+
+    Arguments:
+        cache_folder: the folder in which to store the pyramids, or None to store them in a sidecar folder
+                      <input_path>.overviews next to each input file
+        max_strip_bytes: approximate size limit of the strips of the input that are read to build the first level
+    """
+
+    logger = logging.getLogger("OverviewCache")
+
+    def __init__(self, cache_folder=None, max_strip_bytes=256*1024*1024):
+        self.cache_folder = cache_folder
+        self.max_strip_bytes = max_strip_bytes
+
+    def get_folder(self, input_path):
+        # get the folder holding all pyramids for an input path, and the sub-folder name for the file's current version
+        input_path = os.path.abspath(input_path)
+        stat = os.stat(input_path)
+        version = hashlib.sha1(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+        if self.cache_folder is None:
+            return (input_path + ".overviews", version)
+        path_hash = hashlib.sha1(input_path.encode("utf-8")).hexdigest()
+        return (os.path.join(self.cache_folder, path_hash), version)
+
+    def get_overview(self, input_path, key, da, x_dim, y_dim, plot_width, plot_height, method="mean"):
+        """
+        Get the smallest overview of a data array which is at least as large as the plot
+
+        The pyramid is built and stored the first time an overview is requested for the input file and key.
+
+        Arguments:
+            input_path: path of the netcdf4 file from which da was read
+            key: string identifying da within the input file, for example the variable name and any selections
+            da: the data array
+            x_dim: name of the x dimension
+            y_dim: name of the y dimension
+            plot_width: width of the plot, in pixels
+            plot_height: height of the plot, in pixels
+            method: "mean" to average each block, or "nearest" to take one value from each block for nominal data
+
+        Returns:
+            a data array with the same dimensions as da, reduced along x_dim and y_dim, or da itself if there is no
+            smaller overview at least as large as the plot
+        """
+        (h, w) = (da.sizes[y_dim], da.sizes[x_dim])
+        level = 0
+        while (w // 2**(level+1)) >= max(1, plot_width) and (h // 2**(level+1)) >= max(1, plot_height):
+            level += 1
+        if level == 0:
+            return da
+
+        (path_folder, version) = self.get_folder(input_path)
+        key_hash = hashlib.sha1(json.dumps([key, list(da.dims), method]).encode("utf-8")).hexdigest()
+        pyramid_folder = os.path.join(path_folder, version, key_hash)
+        level_path = os.path.join(pyramid_folder, f"level_{level}.npz")
+        if not os.path.exists(level_path):
+            self.build(input_path, path_folder, version, pyramid_folder, da, x_dim, y_dim, method)
+        try:
+            return self.load(level_path, da, x_dim, y_dim)
+        except FileNotFoundError:
+            # the pyramid was removed by another process after the input file was modified
+            self.logger.warning(f"Overview {level_path} was removed, reading {input_path}")
+            return da
+
+    def build(self, input_path, path_folder, version, pyramid_folder, da, x_dim, y_dim, method):
+        # build all levels, down to a single row or column
+        # remove pyramids built before the input file was last modified, which are for earlier versions of the file
+        # pyramids built since then may be for the current version and in use by another process
+        input_mtime = os.stat(input_path).st_mtime
+        if os.path.isdir(path_folder):
+            for name in os.listdir(path_folder):
+                folder = os.path.join(path_folder, name)
+                try:
+                    if name != version and os.stat(folder).st_mtime < input_mtime:
+                        shutil.rmtree(folder, ignore_errors=True)
+                except FileNotFoundError:
+                    pass # already removed by another process
+        os.makedirs(pyramid_folder, exist_ok=True)
+        self.logger.info(f"Building overviews in {pyramid_folder}")
+
+        # arrange the spatial dimensions last, and build the first level from strips of rows to limit memory use
+        other_dims = [dim for dim in da.dims if dim not in (y_dim, x_dim)]
+        da = da.transpose(*other_dims, y_dim, x_dim)
+        h = da.sizes[y_dim]
+        row_bytes = max(1, da.size // max(1, h)) * da.dtype.itemsize
+        strip_rows = max(2, 2 * (self.max_strip_bytes // row_bytes // 2))
+        strips = []
+        for start in range(0, (h // 2) * 2, strip_rows):
+            strip = da.isel(**{y_dim: slice(start, min(start + strip_rows, (h // 2) * 2))}).values
+            strip = reduce_pairs(strip, strip.ndim - 2, method)
+            strips.append(reduce_pairs(strip, strip.ndim - 1, method))
+        arr = np.concatenate(strips, axis=len(other_dims))
+
+        # coordinates along the spatial dimensions are averaged
+        coords = {}
+        for (name, coord) in da.coords.items():
+            if coord.dims and set(coord.dims) <= {y_dim, x_dim}:
+                coords[name] = (coord.dims, coord.values.astype(float))
+
+        max_level = int(np.log2(min(h, da.sizes[x_dim])))
+        for level in range(1, max_level + 1):
+            if level > 1:
+                arr = reduce_pairs(reduce_pairs(arr, arr.ndim - 2, method), arr.ndim - 1, method)
+            for (name, (dims, values)) in coords.items():
+                for (axis, dim) in enumerate(dims):
+                    values = reduce_pairs(values, axis, "mean")
+                coords[name] = (dims, values)
+            level_path = os.path.join(pyramid_folder, f"level_{level}.npz")
+            if not os.path.exists(level_path):
+                # write under a unique temporary name, so that an incomplete level is never read, even if other
+                # processes are building the same pyramid
+                (fd, tmp_path) = tempfile.mkstemp(suffix=".tmp.npz", dir=pyramid_folder)
+                with os.fdopen(fd, "wb") as f:
+                    np.savez_compressed(f, data=arr, **{"coord_" + name: values for (name, (_, values)) in coords.items()})
+                os.replace(tmp_path, level_path)
+
+    def load(self, level_path, da, x_dim, y_dim):
+        other_dims = [dim for dim in da.dims if dim not in (y_dim, x_dim)]
+        with np.load(level_path) as f:
+            arr = f["data"]
+            coords = {}
+            for (name, coord) in da.coords.items():
+                if coord.dims and set(coord.dims) <= {y_dim, x_dim}:
+                    coords[name] = (coord.dims, f["coord_" + name])
+                elif y_dim not in coord.dims and x_dim not in coord.dims:
+                    coords[name] = coord
+        overview = xr.DataArray(arr, dims=other_dims + [y_dim, x_dim], coords=coords, name=da.name, attrs=da.attrs)
+        return overview.transpose(*da.dims)
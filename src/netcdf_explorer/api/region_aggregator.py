@@ -0,0 +1,149 @@
+# MIT License
+#
+# Copyright (c) 2023-2024 National Centre for Earth Observation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import numpy as np
+
+
+class RegionAggregator:
+    """
+    Aggregate variables over many regions, each defined by a mask which does not vary between cases
+
+    Each mask is converted once into a list of the flat indices of the pixels it selects.  If no pixel is selected
+    by more than one mask, the masks are instead combined into a single label raster.  Aggregation then reduces the
+    selected pixels of a block of cases for all regions at once, using grouped reductions.
+    """
+
+    def __init__(self, masks, case_dimension, max_block_bytes=256*1024*1024):
+        """
+        Arguments:
+            masks: dictionary mapping region name to a mask DataArray, all with the same dimensions in the same order
+            case_dimension: the name of the case dimension, which the masks should not include
+            max_block_bytes: the approximate size limit of the arrays used to aggregate a block of cases at once
+        """
+        self.region_names = list(masks.keys())
+        self.case_dimension = case_dimension
+        self.max_block_bytes = max_block_bytes
+        self.dims = masks[self.region_names[0]].dims if self.region_names else ()
+        self.shape = None
+
+        index_lists = []
+        for name in self.region_names:
+            mask = masks[name]
+            if mask.dims != self.dims:
+                raise Exception(f"Mask {name} has dimensions {mask.dims}, expected {self.dims}")
+            selected = mask.values.astype(bool).ravel()
+            self.shape = mask.shape
+            index_lists.append(np.flatnonzero(selected))
+
+        # arrange the selected pixels into one contiguous segment per region
+        counts = np.array([len(indices) for indices in index_lists], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        self.counts = counts
+        self.labels = None
+        indices = np.concatenate(index_lists) if index_lists else np.zeros(0, dtype=np.int64)
+        if len(np.unique(indices)) == len(indices):
+            # the masks are mutually exclusive, keep a label raster (-1 for no region) and the segment order
+            self.labels = np.full(int(np.prod(self.shape)) if self.shape else 0, -1, dtype=np.int32)
+            for (region, region_indices) in enumerate(index_lists):
+                self.labels[region_indices] = region
+            self.labelled = np.flatnonzero(self.labels >= 0)
+            self.order = self.labelled[np.argsort(self.labels[self.labelled], kind="stable")]
+        else:
+            self.order = indices
+
+    def can_aggregate(self, da):
+        # check that a variable has the case dimension and the same dimensions as the masks
+        return self.case_dimension in da.dims and set(da.dims) == set((self.case_dimension,) + self.dims)
+
+    def aggregate(self, da, aggregation_fn):
+        """
+        Aggregate a variable within each region, for every case
+
+        Arguments:
+            da: DataArray with the case dimension and the mask dimensions
+            aggregation_fn: one of "mean", "min", "max" or "median".  NaN values are ignored.
+
+        Returns:
+            dictionary mapping region name to an array of aggregated values, one per case, NaN where a region
+            contains no valid values
+        """
+        if aggregation_fn not in ("mean", "min", "max", "median"):
+            raise Exception(f"Cannot apply unrecognised aggregation function {aggregation_fn}")
+        da = da.transpose(self.case_dimension, *self.dims)
+        n = da.shape[0]
+        nregions = len(self.region_names)
+        results = np.full((nregions, n), np.nan)
+        non_empty = np.flatnonzero(self.counts > 0)
+        # each case needs its frame as read, and 8 byte values and group indices (plus a mask) for the selected pixels
+        frame_size = int(np.prod(da.shape[1:]))
+        selected_size = len(self.labelled) if (aggregation_fn == "mean" and self.labels is not None) else len(self.order)
+        case_bytes = frame_size * da.dtype.itemsize + 17 * selected_size
+        block_size = max(1, self.max_block_bytes // max(1, case_bytes))
+        for start in range(0, n, block_size):
+            end = min(n, start + block_size)
+            block = da[start:end].values.reshape((end - start, -1))
+            if aggregation_fn == "mean" and self.labels is not None:
+                results[:, start:end] = self.bincount_mean(block)
+            elif len(non_empty):
+                selected = block[:, self.order].astype(np.float64)
+                results[non_empty, start:end] = self.segment_reduce(selected, aggregation_fn, non_empty).T
+        return {name: results[region] for (region, name) in enumerate(self.region_names)}
+
+    def bincount_mean(self, block):
+        # mean of each region in each case, using the label raster to group the sums and counts
+        nregions = len(self.region_names)
+        ncases = block.shape[0]
+        values = block[:, self.labelled].astype(np.float64)
+        valid = ~np.isnan(values)
+        group = (np.arange(ncases)[:, None] * nregions + self.labels[self.labelled][None, :])
+        sums = np.bincount(group[valid], weights=values[valid], minlength=ncases * nregions)
+        counts = np.bincount(group[valid], minlength=ncases * nregions)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        return means.reshape((ncases, nregions)).T
+
+    def segment_reduce(self, selected, aggregation_fn, regions):
+        # reduce the contiguous segment of values for each region, returning an array of shape (cases, regions)
+        offsets = self.offsets[regions]
+        if aggregation_fn == "min":
+            return np.fmin.reduceat(selected, offsets, axis=1)
+        elif aggregation_fn == "max":
+            return np.fmax.reduceat(selected, offsets, axis=1)
+        elif aggregation_fn == "mean":
+            valid = ~np.isnan(selected)
+            sums = np.add.reduceat(np.where(valid, selected, 0), offsets, axis=1)
+            counts = np.add.reduceat(valid.astype(np.int64), offsets, axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return sums / counts
+        else:
+            medians = np.full((selected.shape[0], len(regions)), np.nan)
+            for (idx, region) in enumerate(regions):
+                segment = selected[:, self.offsets[region]:self.offsets[region] + self.counts[region]]
+                # sort each case's values, NaNs are sorted to the end
+                segment = np.sort(segment, axis=1)
+                valid_counts = np.sum(~np.isnan(segment), axis=1)
+                has_values = valid_counts > 0
+                rows = np.flatnonzero(has_values)
+                lower = segment[rows, (valid_counts[rows] - 1) // 2]
+                upper = segment[rows, valid_counts[rows] // 2]
+                medians[rows, idx] = (lower + upper) / 2
+            return medians
@@ -0,0 +1,178 @@
+# MIT License
+#
+# Copyright (c) 2023-2024 National Centre for Earth Observation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import hashlib
+import logging
+import tempfile
+import functools
+import collections
+
+import numpy as np
+import pyproj
+
+
+@functools.lru_cache(maxsize=None)
+def get_crs_wkt(crs):
+    # get the WKT representation of a CRS given as an EPSG code, proj string, WKT or pyproj.CRS
+    return pyproj.CRS.from_user_input(crs).to_wkt()
+
+
+def nearest_index(coords, values):
+    # get the index of the coordinate nearest to each value, or -1 where the value lies outside the pixels
+    # centred on the coordinates, which must be monotonic
+    order = np.argsort(coords)
+    sorted_coords = coords[order]
+    half_spacing = 0.5 * abs(sorted_coords[-1] - sorted_coords[0]) / max(1, len(coords) - 1)
+    positions = np.clip(np.searchsorted(sorted_coords, values), 1, max(1, len(coords) - 1))
+    left = sorted_coords[positions - 1]
+    right = sorted_coords[np.minimum(positions, len(coords) - 1)]
+    positions = np.where(values - left < right - values, positions - 1, np.minimum(positions, len(coords) - 1))
+    with np.errstate(invalid="ignore"):
+        inside = (values >= sorted_coords[0] - half_spacing) & (values <= sorted_coords[-1] + half_spacing)
+    return np.where(inside, order[positions], -1)
+
+
+class ReprojectionCache:
+    """
+    Compute and reuse the grids which map each pixel of a plot in a target CRS to the nearest input pixel in a
+    source CRS
+
+    A grid depends only on the input's x and y coordinates, the two CRSs and the plot size and extent, so plots of
+    many input files on the same grid share one grid and pay the cost of transforming the plot's pixel coordinates
+    with pyproj only once.  Recently used grids are kept in memory, and if a cache folder is given, each grid is also
+    stored there as a compressed numpy (.npz) file named by a fingerprint of everything it depends on, to be reused by
+    later runs.
+
+    Arguments:
+        cache_folder: the folder in which to store the grids, or None to keep them only in memory
+        max_size: the number of grids to keep in memory
+    """
+
+    logger = logging.getLogger("ReprojectionCache")
+
+    def __init__(self, cache_folder=None, max_size=16):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        self.grids = collections.OrderedDict() # fingerprint => (rows, cols)
+        self.ranges = {} # fingerprint => (x_range, y_range)
+
+    @staticmethod
+    def get_fingerprint(xs, ys, source_crs, target_crs, *args):
+        # get a hash of the input coordinates, the two CRSs and any other values a grid depends on
+        h = hashlib.sha1()
+        for coords in (xs, ys):
+            coords = np.ascontiguousarray(coords, dtype=float)
+            h.update(str(coords.shape).encode("utf-8"))
+            h.update(coords.tobytes())
+        h.update(get_crs_wkt(source_crs).encode("utf-8"))
+        h.update(get_crs_wkt(target_crs).encode("utf-8"))
+        h.update(repr(args).encode("utf-8"))
+        return h.hexdigest()
+
+    def get_target_ranges(self, xs, ys, source_crs, target_crs):
+        """
+        Get the extent of the input in the target CRS
+
+        Arguments:
+            xs: the input's x coordinates (pixel centres) in the source CRS
+            ys: the input's y coordinates (pixel centres) in the source CRS
+            source_crs: the CRS of the input
+            target_crs: the CRS of the plot
+
+        Returns:
+            tuple (x_range, y_range) of the (min,max) coordinates in the target CRS which cover the input pixels
+        """
+        fingerprint = ReprojectionCache.get_fingerprint(xs, ys, source_crs, target_crs)
+        if fingerprint not in self.ranges:
+            # extend the coordinates of the pixel centres to the pixel edges
+            (xmin, xmax) = (float(np.min(xs)), float(np.max(xs)))
+            (ymin, ymax) = (float(np.min(ys)), float(np.max(ys)))
+            half_width = 0.5 * (xmax - xmin) / max(1, len(xs) - 1)
+            half_height = 0.5 * (ymax - ymin) / max(1, len(ys) - 1)
+            transformer = pyproj.Transformer.from_crs(source_crs, target_crs, always_xy=True)
+            (left, bottom, right, top) = transformer.transform_bounds(xmin - half_width, ymin - half_height,
+                                                                      xmax + half_width, ymax + half_height,
+                                                                      densify_pts=21)
+            self.ranges[fingerprint] = ((left, right), (bottom, top))
+        return self.ranges[fingerprint]
+
+    def get_indices(self, xs, ys, source_crs, target_crs, plot_width, plot_height, x_range, y_range):
+        """
+        Get the input pixel nearest to each plot pixel
+
+        Arguments:
+            xs: the input's x coordinates in the source CRS, which must be monotonic
+            ys: the input's y coordinates in the source CRS, which must be monotonic
+            source_crs: the CRS of the input
+            target_crs: the CRS of the plot
+            plot_width: width of the plot, in pixels
+            plot_height: height of the plot, in pixels
+            x_range: the (min,max) x coordinates covered by the plot, in the target CRS
+            y_range: the (min,max) y coordinates covered by the plot, in the target CRS
+
+        Returns:
+            tuple (rows, cols) of integer arrays of shape (plot_height, plot_width), ordered with y and x increasing,
+            holding the input row and column for each plot pixel or -1 where the plot pixel lies outside the input
+        """
+        fingerprint = ReprojectionCache.get_fingerprint(xs, ys, source_crs, target_crs, plot_width, plot_height,
+                                                        tuple(x_range), tuple(y_range))
+        if fingerprint in self.grids:
+            self.grids.move_to_end(fingerprint)
+            return self.grids[fingerprint]
+
+        grid_path = os.path.join(self.cache_folder, fingerprint + ".npz") if self.cache_folder else None
+        if grid_path and os.path.exists(grid_path):
+            with np.load(grid_path) as f:
+                grid = (f["rows"], f["cols"])
+        else:
+            grid = self.compute_indices(xs, ys, source_crs, target_crs, plot_width, plot_height, x_range, y_range)
+            if grid_path:
+                os.makedirs(self.cache_folder, exist_ok=True)
+                self.logger.info(f"Storing reprojection grid {grid_path}")
+                # write under a temporary name, so that an incomplete grid is never read, even if other processes
+                # are storing the same grid
+                (fd, tmp_path) = tempfile.mkstemp(suffix=".tmp.npz", dir=self.cache_folder)
+                with os.fdopen(fd, "wb") as f:
+                    np.savez_compressed(f, rows=grid[0], cols=grid[1])
+                os.replace(tmp_path, grid_path)
+
+        self.grids[fingerprint] = grid
+        while len(self.grids) > self.max_size:
+            self.grids.popitem(last=False)
+        return grid
+
+    def compute_indices(self, xs, ys, source_crs, target_crs, plot_width, plot_height, x_range, y_range):
+        # transform the centre of each plot pixel into the source CRS and find the nearest input pixel
+        self.logger.info(f"Computing reprojection grid of {plot_width}x{plot_height} pixels")
+        target_xs = x_range[0] + (np.arange(plot_width) + 0.5) * (x_range[1] - x_range[0]) / plot_width
+        target_ys = y_range[0] + (np.arange(plot_height) + 0.5) * (y_range[1] - y_range[0]) / plot_height
+        (target_xx, target_yy) = np.meshgrid(target_xs, target_ys)
+        transformer = pyproj.Transformer.from_crs(target_crs, source_crs, always_xy=True)
+        (source_xx, source_yy) = transformer.transform(target_xx, target_yy)
+        cols = nearest_index(np.asarray(xs, dtype=float), source_xx)
+        rows = nearest_index(np.asarray(ys, dtype=float), source_yy)
+        outside = (rows < 0) | (cols < 0)
+        rows[outside] = -1
+        cols[outside] = -1
+        return (rows.astype(np.int32), cols.astype(np.int32))
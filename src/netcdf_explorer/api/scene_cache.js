@@ -0,0 +1,145 @@
+
+class SceneCache {
+
+    /**
+     * Fetch and cache the images and data needed to display scenes in the overlay view
+     *
+     * Resources are keyed by url, so layers shared between scenes are only fetched once.  When the total size of
+     * cached resources exceeds budget_bytes, the least recently used are evicted, except for those needed by the
+     * scenes that are currently wanted.  Fetches of resources which are no longer wanted are aborted.
+     */
+
+    constructor(layers, budget_bytes) {
+        this.layers = layers;
+        this.budget_bytes = budget_bytes;
+        this.resources = new Map(); // url => {promise, controller, value, bytes, complete}, in least recently used order
+        this.wanted_urls = new Set();
+        this.total_bytes = 0;
+    }
+
+    get_resources(scene) {
+        // get [url, is_data] for each image and data file needed to display a scene
+        let resources = [];
+        this.layers.forEach(layer => {
+            if (layer.name in scene.image_srcs) {
+                resources.push([scene.image_srcs[layer.name], false]);
+            }
+        });
+        for (let layer_name in scene.data_srcs) {
+            resources.push([scene.data_srcs[layer_name].url, true]);
+        }
+        return resources;
+    }
+
+    async load_image(url, signal) {
+        let response = await fetch(url, {"signal": signal});
+        if (!response.ok) {
+            // leave the map to deal with the missing image
+            return [url, 0];
+        }
+        let blob = await response.blob();
+        return [URL.createObjectURL(blob), blob.size];
+    }
+
+    async load_data(url, signal) {
+        let decoded = await DataImage.fetch(url, signal);
+        return [decoded, decoded.data.byteLength];
+    }
+
+    fetch(url, is_data) {
+        let resource = this.resources.get(url);
+        if (resource) {
+            // move to the most recently used position
+            this.resources.delete(url);
+            this.resources.set(url, resource);
+            return resource.promise;
+        }
+        let controller = new AbortController();
+        resource = {"controller": controller, "value": null, "bytes": 0, "complete": false};
+        let loader = is_data ? this.load_data(url, controller.signal) : this.load_image(url, controller.signal);
+        resource.promise = loader.then(([value, bytes]) => {
+            resource.value = value;
+            resource.bytes = bytes;
+            resource.complete = true;
+            if (this.resources.get(url) === resource) {
+                this.total_bytes += bytes;
+                this.evict();
+            } else {
+                // cancelled, but could not be aborted in time
+                this.release(resource);
+            }
+            return value;
+        }, (e) => {
+            if (this.resources.get(url) === resource) {
+                this.resources.delete(url);
+            }
+            throw e;
+        });
+        this.resources.set(url, resource);
+        return resource.promise;
+    }
+
+    release(resource) {
+        if (typeof resource.value === "string" && resource.value.startsWith("blob:")) {
+            URL.revokeObjectURL(resource.value);
+        }
+    }
+
+    evict() {
+        for (let [url, resource] of this.resources) {
+            if (this.total_bytes <= this.budget_bytes) {
+                break;
+            }
+            if (resource.complete && !this.wanted_urls.has(url)) {
+                this.resources.delete(url);
+                this.total_bytes -= resource.bytes;
+                this.release(resource);
+            }
+        }
+    }
+
+    set_wanted(scenes) {
+        // set the scenes that are wanted (the scene being shown and those to prefetch)
+        // and abort fetches of resources not needed by any of them
+        this.wanted_urls = new Set();
+        scenes.forEach(scene => {
+            this.get_resources(scene).forEach(([url, is_data]) => this.wanted_urls.add(url));
+        });
+        for (let [url, resource] of this.resources) {
+            if (!resource.complete && !this.wanted_urls.has(url)) {
+                resource.controller.abort();
+                this.resources.delete(url);
+            }
+        }
+    }
+
+    async get_scene(scene) {
+        // fetch all the resources for a scene concurrently, returning {image_urls, data}
+        // image_urls maps layer names to urls, data maps data layer names to decoded data
+        let image_urls = {};
+        let data = {};
+        let fetches = [];
+        this.layers.forEach(layer => {
+            if (layer.name in scene.image_srcs) {
+                fetches.push(this.fetch(scene.image_srcs[layer.name], false).then(url => {
+                    image_urls[layer.name] = url;
+                }));
+            }
+        });
+        for (let layer_name in scene.data_srcs) {
+            fetches.push(this.fetch(scene.data_srcs[layer_name].url, true).then(decoded => {
+                data[layer_name] = decoded;
+            }));
+        }
+        await Promise.all(fetches);
+        return {"image_urls": image_urls, "data": data};
+    }
+
+    async prefetch(scenes) {
+        // fetch scenes in the background concurrently
+        // fetches of scenes which stop being wanted are aborted by set_wanted
+        await Promise.all(scenes.map(scene => this.get_scene(scene).catch(e => {
+            // aborted or failed, this will be retried if the scene is shown
+        })));
+    }
+}
@@ -0,0 +1,102 @@
+
+class Scene {
+
+    /**
+     * Represent one scene in the compact scenes.json index
+     *
+     * Image and data urls are expanded from the per-layer patterns in scenes.json when they are needed
+     */
+
+    constructor(scene_index, idx) {
+        this.scene_index = scene_index;
+        this.idx = idx;
+        this.timestamp = scene_index.scenes.timestamps[idx];
+        this.pos = scene_index.scenes.positions[idx];
+    }
+
+    get image_srcs() {
+        let image_srcs = {};
+        let patterns = this.scene_index.scenes.image_srcs;
+        for (let layer_name in patterns) {
+            image_srcs[layer_name] = patterns[layer_name].replace("{index}", this.pos);
+        }
+        return image_srcs;
+    }
+
+    get data_srcs() {
+        let data_srcs = {};
+        let patterns = this.scene_index.scenes.data_srcs;
+        for (let layer_name in patterns) {
+            data_srcs[layer_name] = {
+                "url": patterns[layer_name].url.replace("{index}", this.pos),
+                "options": patterns[layer_name].options
+            };
+        }
+        return data_srcs;
+    }
+
+    get x_min() {
+        return this.scene_index.scenes.bounds[this.idx][0];
+    }
+
+    get y_min() {
+        return this.scene_index.scenes.bounds[this.idx][1];
+    }
+
+    get x_max() {
+        return this.scene_index.scenes.bounds[this.idx][2];
+    }
+
+    get y_max() {
+        return this.scene_index.scenes.bounds[this.idx][3];
+    }
+}
+
+class SceneIndex {
+
+    /**
+     * Provide access to the scenes described in scenes.json, fetching pages of scene info on demand
+     */
+
+    constructor(scenes) {
+        this.scenes = scenes;
+        this.info_pages = {}; // page number => promise resolving to an array of info objects
+        this.stats = null; // promise resolving to the per-case layer statistics
+        this.index = [];
+        for (let idx = 0; idx < scenes.timestamps.length; idx++) {
+            this.index.push(new Scene(this, idx));
+        }
+    }
+
+    async get_info(scene) {
+        // get the info for a scene, fetching the page containing it if not already loaded
+        if (!this.scenes.info_pages) {
+            return {};
+        }
+        let page_number = Math.floor(scene.idx / this.scenes.info_page_size);
+        if (!(page_number in this.info_pages)) {
+            this.info_pages[page_number] = fetch(this.scenes.info_pages[page_number]).then(r => r.json());
+            // allow a failed fetch to be retried
+            this.info_pages[page_number].catch(() => {
+                delete this.info_pages[page_number];
+            });
+        }
+        let page = await this.info_pages[page_number];
+        return page[scene.idx % this.scenes.info_page_size];
+    }
+
+    async get_stats() {
+        // get the statistics for each layer and scene, fetching them if not already loaded
+        // returns an object mapping layer name => field name => array of values (null if undefined), one per scene
+        if (!this.scenes.stats_src) {
+            return {};
+        }
+        if (this.stats === null) {
+            this.stats = fetch(this.scenes.stats_src).then(r => r.json()).then(stats => stats.layers);
+            this.stats.catch(() => {
+                this.stats = null;
+            });
+        }
+        return await this.stats;
+    }
+}
@@ -2,7 +2,10 @@ class TimeseriesChart {
 
     static all_charts = [];
 
-    constructor(element_id, csv_url, spec) {
+    // when zoomed, load a finer level of a binary timeseries if fewer than this many points would be visible
+    static MIN_VISIBLE_POINTS = 1000;
+
+    constructor(element_id, csv_url, spec, header_url) {
         this.type = spec.type || "timeseries";
         let div = document.getElementById(element_id);
         let options = {
@@ -15,20 +18,104 @@ class TimeseriesChart {
                 }
             }
         }
-        this.g = new Dygraph(div, csv_url, options);
+        this.g = null;
+        this.header = null;
+        this.levels = {}; // level index => promise resolving to the rows for that level
+        this.current_level = null;
+        if (header_url) {
+            this.load_binary(div, header_url, options).then(() => {
+            });
+        } else {
+            this.g = new Dygraph(div, csv_url, options);
+        }
         TimeseriesChart.all_charts.push(this);
     }
 
+    async load_binary(div, header_url, options) {
+        // load the header and the coarsest level of a binary timeseries
+        this.header_url = new URL(header_url, window.location.href);
+        let r = await fetch(this.header_url);
+        this.header = await r.json();
+        this.time_origin = new Date(this.header.time_origin).getTime();
+        let rows = await this.load_level(0);
+        this.current_level = 0;
+        options.labels = this.header.columns;
+        this.g = new Dygraph(div, rows, options);
+    }
+
+    load_level(level) {
+        // fetch and decode a level (0 is the coarsest) into rows of [Date, value, ...], caching the result
+        if (!(level in this.levels)) {
+            let url = new URL(this.header.levels[level].url, this.header_url);
+            this.levels[level] = fetch(url).then(r => r.arrayBuffer()).then(buffer => this.decode(buffer, level));
+            this.levels[level].catch(() => {
+                delete this.levels[level];
+            });
+        }
+        return this.levels[level];
+    }
+
+    decode(buffer, level) {
+        // each level holds a little-endian float64 time column (in seconds since the origin)
+        // followed by a little-endian float32 column for each variable
+        let length = this.header.levels[level].length;
+        let ncols = this.header.columns.length;
+        let dv = new DataView(buffer);
+        let rows = [];
+        for (let idx = 0; idx < length; idx++) {
+            let row = [new Date(this.time_origin + 1000 * dv.getFloat64(8 * idx, true))];
+            for (let col = 1; col < ncols; col++) {
+                let v = dv.getFloat32(8 * length + 4 * ((col - 1) * length + idx), true);
+                row.push(Number.isNaN(v) ? null : v);
+            }
+            rows.push(row);
+        }
+        return rows;
+    }
+
+    async update_level(minDate, maxDate) {
+        // switch to the coarsest level which shows enough points in the date window
+        if (this.header === null || this.g === null) {
+            return;
+        }
+        let levels = this.header.levels;
+        let [first, last] = this.g.xAxisExtremes();
+        let window_fraction = (last > first) ? Math.min(1, (maxDate - minDate) / (last - first)) : 1;
+        let level = levels.length - 1;
+        for (let idx = 0; idx < levels.length; idx++) {
+            if (levels[idx].length * window_fraction >= TimeseriesChart.MIN_VISIBLE_POINTS) {
+                level = idx;
+                break;
+            }
+        }
+        if (level !== this.current_level) {
+            this.current_level = level;
+            let rows = await this.load_level(level);
+            if (this.current_level === level) {
+                this.disable_zoom_event = true;
+                this.g.updateOptions({"file": rows, "dateWindow": this.g.isZoomed("x") ? [minDate, maxDate] : null});
+                this.disable_zoom_event = false;
+            }
+        }
+    }
+
     set_zoom(minDate, maxDate) {
+        if (this.g === null) {
+            return;
+        }
         this.disable_zoom_event = true;
         this.g.updateOptions({
           dateWindow: [minDate, maxDate]
         });
         this.disable_zoom_event = false;
+        this.update_level(minDate, maxDate).then(() => {
+        });
     }
 
     handle_zoom_event(minDate, maxDate, yRange, type) {
         if (!this.disable_zoom_event) {
+            this.update_level(minDate, maxDate).then(() => {
+            });
             TimeseriesChart.all_charts.forEach((chart) => {
                 if (chart !== this && chart.type === type) {
                     chart.set_zoom(minDate, maxDate);
@@ -36,4 +123,4 @@ class TimeseriesChart {
             });
         }
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,139 @@
+# MIT License
+#
+# Copyright (C) 2023-2024 National Centre For Earth Observation (NCEO)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software
+# and associated documentation files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or
+# substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING
+# BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM,
+# DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import json
+import math
+import os
+
+import numpy as np
+
+class TimeseriesEncoder:
+
+    """
+    Write timeseries as columns of little-endian values, at full resolution and at a series of coarser levels
+    decimated with the largest-triangle-three-buckets (LTTB) algorithm.
+
+    Each level is a file containing the time column followed by one column per variable.  Times are stored as float64
+    seconds since the first timestamp, which is exact to well under a second over centuries, and variables are stored
+    as float32.  A JSON header describes the columns and lists the levels, coarsest first,
+    with urls relative to the header.
+    """
+
+    def __init__(self, decimation_factor=4, min_points=2000):
+        """
+        Arguments:
+            decimation_factor: the number of points in each level is reduced by this factor from the next finer level
+            min_points: no levels are decimated to fewer than this number of points
+        """
+        self.decimation_factor = decimation_factor
+        self.min_points = min_points
+
+    @staticmethod
+    def lttb(x, y, threshold):
+        """
+        Select up to threshold points from a series with the largest-triangle-three-buckets algorithm
+
+        Arguments:
+            x: array of x values, increasing
+            y: array of y values (NaN values are ignored)
+            threshold: the number of points to select
+
+        Returns:
+            array of the indices of the selected points
+        """
+        valid = np.flatnonzero(~np.isnan(y))
+        n = len(valid)
+        if threshold >= n or threshold < 3:
+            return valid
+        x = x[valid]
+        y = y[valid]
+        selected = np.zeros(threshold, dtype=np.int64)
+        # the first and last points are always selected, the others are split into threshold-2 buckets
+        every = (n - 2) / (threshold - 2)
+        a = 0
+        for i in range(threshold - 2):
+            # choose the point in this bucket forming the largest triangle with the previously selected
+            # point and the average of the next bucket
+            avg_start = int(math.floor((i + 1) * every)) + 1
+            avg_end = min(int(math.floor((i + 2) * every)) + 1, n)
+            if avg_start >= avg_end:
+                avg_start = n - 1
+                avg_end = n
+            avg_x = x[avg_start:avg_end].mean()
+            avg_y = y[avg_start:avg_end].mean()
+            range_start = int(math.floor(i * every)) + 1
+            range_end = int(math.floor((i + 1) * every)) + 1
+            areas = np.abs((x[a] - avg_x) * (y[range_start:range_end] - y[a])
+                           - (x[a] - x[range_start:range_end]) * (avg_y - y[a]))
+            a = range_start + int(np.argmax(areas))
+            selected[i + 1] = a
+        selected[-1] = n - 1
+        return valid[selected]
+
+    def encode(self, folder, name, times, column_names, columns):
+        """
+        Write the levels and header for a timeseries
+
+        Arguments:
+            folder: the folder to write to
+            name: the name of the timeseries, used to name the files
+            times: numpy datetime64 array of timestamps
+            column_names: list of the names of the variable columns
+            columns: dictionary mapping column name to a list of values, one per timestamp
+
+        Returns:
+            the filename of the header, in the folder
+        """
+        n = len(times)
+        origin = times[0] if n else np.datetime64("1970-01-01T00:00:00")
+        seconds = (times - origin) / np.timedelta64(1, "s")
+        values = [np.array(columns[column_name], dtype=np.float64) for column_name in column_names]
+
+        # work out the number of points in each decimated level, from finest to coarsest
+        thresholds = []
+        threshold = n
+        while threshold // self.decimation_factor >= self.min_points:
+            threshold = threshold // self.decimation_factor
+            thresholds.append(threshold)
+
+        level_indices = [np.arange(n)]
+        for threshold in thresholds:
+            # keep the points selected for any of the variables
+            level_indices.append(np.unique(np.concatenate(
+                [np.zeros(0, dtype=np.int64)] + [TimeseriesEncoder.lttb(seconds, y, threshold) for y in values])))
+
+        levels = []
+        for (level, indices) in enumerate(reversed(level_indices)):
+            filename = f"{name}_{level}.bin"
+            with open(os.path.join(folder, filename), "wb") as f:
+                f.write(seconds[indices].astype("<f8").tobytes())
+                for y in values:
+                    f.write(y[indices].astype("<f4").tobytes())
+            levels.append({"url": filename, "length": len(indices)})
+
+        header = {
+            "columns": ["datetime"] + column_names,
+            "time_origin": str(np.datetime_as_string(origin, unit="s")),
+            "time_units": "seconds",
+            "levels": levels
+        }
+        header_filename = f"{name}.json"
+        with open(os.path.join(folder, header_filename), "w") as f:
+            f.write(json.dumps(header, indent=4))
+        return header_filename
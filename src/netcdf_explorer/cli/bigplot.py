@@ -22,12 +22,27 @@ import glob
 import os.path
 import sys
 import logging
+import concurrent.futures
 
 import xarray as xr
+import pyproj
 
-from netcdf_explorer.api.bigplot import BigPlot
+from netcdf_explorer.api.bigplot import BigPlot, RenderPlan
+from netcdf_explorer.api.animation import Animation, MAX_FRAME_DURATION
+from netcdf_explorer.api.overview_cache import OverviewCache
+from netcdf_explorer.api.reprojection_cache import ReprojectionCache
 
-def main():
+def main(argv=None, dataset_cache=None):
+    """
+    Run bigplot
+
+    Arguments:
+        argv: list of command line arguments, defaults to sys.argv[1:]
+        dataset_cache: optional DatasetCache used to open the input files when they are plotted in this process
+
+    Returns:
+        0 if all input files were plotted, otherwise 1
+    """
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-path", nargs="+", help="path matching one or more netcdf input file(s)", required=True)
@@ -44,6 +59,9 @@ def main():
     parser.add_argument("--cmap", help="colour scale to use, should be the  name of a matplotlib color map", default="turbo")
 
     parser.add_argument("--cchart", metavar="PATH", help="path to a JSON format {<value>:<colour>} colour chart mapping nominal values to colours, overrides --cmap if specified", default=None)
+    parser.add_argument("--categorical-method", choices=["exact", "mode", "nearest"], default="exact",
+                        help="how to downsample nominal values plotted with --cchart: exact (most common value in each plot pixel), "
+                             "mode (most common value in fixed blocks of input pixels, faster) or nearest (fastest)")
     parser.add_argument("--legend-width", help="width of the legend in pixels", type=int, default=100)
     parser.add_argument("--legend-height", help="height of the legend in pixels", type=int, default=50)
 
@@ -55,14 +73,47 @@ def main():
     parser.add_argument("--attr-height", help="Height of attribute text", type=int, default=25)
     parser.add_argument("--font-path", help="Path to a true-type (.ttf) font to use (defaults to Roboto)", default=None)
     parser.add_argument("--output-path", help="Path to an output folder or filename", default=".")
-    parser.add_argument("--output-filetype", help="output filetype (pdf or png)", default="png")
+    parser.add_argument("--output-filetype", help="output filetype (pdf, png or webp)", default="png")
     parser.add_argument("--plot-width", help="Width of the main image plot, in pixels", type=int, default=1024)
     parser.add_argument("--border", help="Width of border around edge of the plot, in pixels", type=int, default=20)
+    parser.add_argument("--tile-size", type=int, metavar="PIXELS", default=None,
+                        help="Read and plot the input in tiles of about this many rows and columns, to limit memory use for large inputs")
+    parser.add_argument("--quicklook", action="store_true",
+                        help="Read only every Nth row and column of the input, where N is the number of input pixels per plot pixel")
+    parser.add_argument("--overviews", action="store_true",
+                        help="Build and reuse overview pyramids of the input variables, stored next to the input files")
+    parser.add_argument("--overview-folder", default=None,
+                        help="Build and reuse overview pyramids of the input variables, stored in this folder")
+    parser.add_argument("--source-crs", default=None,
+                        help="CRS of the input x and y coordinates, for example EPSG:27700, defaults to the CRS of the variable's grid mapping")
+    parser.add_argument("--target-crs", default=None,
+                        help="Reproject the input to this CRS, for example EPSG:3857, taking the nearest input pixel for each plot pixel")
+    parser.add_argument("--reprojection-folder", default=None,
+                        help="Store the grids used to reproject the input in this folder, to be reused by later runs on the same input grid")
+    parser.add_argument("--animate", metavar="DIMENSION", default=None,
+                        help="Write an animation with one frame for each position along this dimension, as an animated png or webp file")
+    parser.add_argument("--frame-duration", type=int, metavar="MILLISECONDS", default=500,
+                        help="Duration of each frame of an animation")
+    parser.add_argument("--frame-workers", type=int, default=4,
+                        help="Number of animation frames to render in parallel")
+    parser.add_argument("--montage", metavar="DIMENSION", default=None,
+                        help="Plot a grid of panels, one for each position along this dimension, with a shared title and legend")
+    parser.add_argument("--montage-columns", type=int, default=None,
+                        help="Number of columns of panels in a montage, defaults to a square grid")
+    parser.add_argument("--montage-workers", type=int, default=4,
+                        help="Number of montage panels to render in parallel")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes to use when plotting many input files")
+    parser.add_argument("--summary-path", default=None,
+                        help="Path to write a JSON summary of the input files that were plotted and those that failed")
 
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("main")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if args.animate and not (0 <= args.frame_duration <= MAX_FRAME_DURATION):
+        parser.error(f"--frame-duration should be between 0 and {MAX_FRAME_DURATION} milliseconds")
 
     selectors = {}
     iselectors = {}
@@ -96,76 +147,169 @@ def main():
             sys.exit(-1)
         else:
             # special case - for backwards compatibility allow args.output_path to point to a filename and not a folder
-            if suffix not in [".pdf", ".png"]:
-                logger.error(f"--output-path suffix {suffix} is not .pdf or .png")
+            if suffix not in [".pdf", ".png", ".webp"]:
+                logger.error(f"--output-path suffix {suffix} is not .pdf, .png or .webp")
                 sys.exit(-1)
     else:
         # no suffix, looks like a folder?
         output_folder = args.output_path
         os.makedirs(output_folder,exist_ok=True)
 
-    for input_path in input_paths:
-        logger.info(f"Processing {input_path}")
-        try:
-            ds = xr.open_dataset(input_path)
-            flip = args.flip
-            if not flip:
-                # look for y-coordinates to autodetect flipping
-                for cname in ds.coords:
-                    coords = ds.coords[cname]
-                    if coords.attrs.get("standard_name","") == "projection_y_coordinate":
-                        if ds[cname].data[0].item() < ds[cname].data[1].item():
-                            # flip so y coordinates are descending
-                            flip = True
-
-            if len(args.input_variable) > 1:
-                if len(args.input_variable) == 3:
-                    da = xr.concat([ds[args.input_variable[0]],ds[args.input_variable[1]],ds[args.input_variable[2]]],dim="rgb")
-                    args.legend_height = 0 # this will turn off the legend
-                else:
-                    logger.error("Please specify either 1 or 3 input variables")
-                    sys.exit(-1)
-            else:
-                da = ds[args.input_variable[0]]
-
-            subtexts = []
-            for attr in args.attrs:
-                if attr in ds.attrs:
-                    subtexts.append(f"{attr}: {ds.attrs[attr]}")
-
-            if output_folder is not None:
-                input_filename = os.path.split(input_path)[-1]
-                input_fileroot = os.path.splitext(input_filename)[0]
-                output_path = os.path.join(output_folder,input_fileroot+"."+args.output_filetype)
-            else:
-                output_path = args.output_path
-
-            legend_width = args.legend_width
-            legend_height = args.legend_height
-
-            cchart = None
-            if args.cchart is not None:
-                # cchart defines a nominal mapping from values to colours
-                with open(args.cchart) as f:
-                    input_cchart = json.loads(f.read())
-                    # input is JSON format, need to convert keys from strings to floats
-                    cchart = {float(key): value for key, value in input_cchart.items()}
-                    legend_height = 0  # switch off legend for a nomimal colour mapping
-
-            bp = BigPlot(data_array=da,
-                         x=args.x, y=args.y, vmin=args.vmin, vmax=args.vmax, vformat=args.vformat,
-                         cmap_name=args.cmap, cchart=cchart, gamma=args.gamma,
-                         legend_width=legend_width, legend_height=legend_height,
-                         title=args.title, subtexts=subtexts, theight=args.title_height, subtheight=args.attr_height,
-                         output_path=output_path, plot_width=args.plot_width, flip=flip,
-                         selectors=selectors, iselectors=iselectors, font_path=args.font_path)
-            bp.run()
-            ds.close()
-        except Exception:
-            logger.exception(f"Failed to process {input_path}")
+    if len(args.input_variable) not in (1, 3):
+        logger.error("Please specify either 1 or 3 input variables")
+        sys.exit(-1)
+    rgb = len(args.input_variable) == 3
+
+    cchart = None
+    if args.cchart is not None:
+        # cchart defines a nominal mapping from values to colours
+        with open(args.cchart) as f:
+            input_cchart = json.loads(f.read())
+            # input is JSON format, need to convert keys from strings to floats
+            cchart = {float(key): value for key, value in input_cchart.items()}
 
+    # the legend is switched off for rgb plots and for a nominal colour mapping
+    legend_height = 0 if (rgb or cchart is not None) else args.legend_height
+
+    # prepare the colour map, colour chart, legend and font once, to be shared by all plots
+    plan = RenderPlan.create(cmap_name=args.cmap, vmin=args.vmin, vmax=args.vmax, cchart=cchart,
+                             legend_width=args.legend_width, legend_height=legend_height, font_path=args.font_path,
+                             rgb=rgb)
+    # reprojection grids are shared by all the input files plotted in each process
+    reprojection_cache = ReprojectionCache(args.reprojection_folder) if args.target_crs else None
+    settings = (plan, args, legend_height, output_folder, selectors, iselectors, reprojection_cache)
+
+    results = []
+    if args.workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                                    initargs=(settings,)) as executor:
+            futures = {executor.submit(plot_file_in_worker, input_path): input_path for input_path in input_paths}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as ex:
+                    # the worker process failed, for example if it ran out of memory
+                    results.append((futures[future], None, f"Worker failed: {ex}"))
+    else:
+        init_worker(settings)
+        for input_path in input_paths:
+            results.append(plot_file_in_worker(input_path, dataset_cache))
+
+    failures = [(input_path, error) for (input_path, output_path, error) in results if error is not None]
+    logger.info(f"Plotted {len(results)-len(failures)} of {len(results)} input files")
+    for (input_path, error) in failures:
+        logger.error(f"Failed to process {input_path}: {error}")
+
+    if args.summary_path:
+        summary = {
+            "succeeded": [{"input_path": input_path, "output_path": output_path}
+                          for (input_path, output_path, error) in results if error is None],
+            "failed": [{"input_path": input_path, "error": error} for (input_path, error) in failures]
+        }
+        with open(args.summary_path, "w") as f:
+            f.write(json.dumps(summary, indent=4))
+
+    return 1 if failures else 0
+
+# settings shared by all plots, in the current process (or worker process), assigned by init_worker
+worker_settings = None
+
+def init_worker(settings):
+    global worker_settings
+    worker_settings = settings
+    logging.basicConfig(level=logging.INFO)
 
+def plot_file_in_worker(input_path, dataset_cache=None):
+    # plot one file, returning (input_path, output_path, error) where error is None if successful
+    logger = logging.getLogger("main")
+    logger.info(f"Processing {input_path}")
+    try:
+        output_path = plot_file(input_path, *worker_settings, dataset_cache=dataset_cache)
+        return (input_path, output_path, None)
+    except Exception as ex:
+        logger.exception(f"Failed to process {input_path}")
+        return (input_path, None, str(ex))
+
+def plot_file(input_path, plan, args, legend_height, output_folder, selectors, iselectors, reprojection_cache=None,
+              dataset_cache=None):
+    if dataset_cache is not None:
+        # the dataset is left open in the cache for later plots
+        return plot_dataset(dataset_cache.open(input_path), input_path, plan, args, legend_height, output_folder,
+                            selectors, iselectors, reprojection_cache)
+    with xr.open_dataset(input_path) as ds:
+        return plot_dataset(ds, input_path, plan, args, legend_height, output_folder, selectors, iselectors,
+                            reprojection_cache)
+
+def get_grid_mapping_crs(ds, variable):
+    # get the CRS described by the CF grid mapping of a variable, or None if it has no grid mapping
+    grid_mapping = ds[variable].encoding.get("grid_mapping", ds[variable].attrs.get("grid_mapping"))
+    if not grid_mapping or grid_mapping not in ds.variables:
+        return None
+    attrs = ds[grid_mapping].attrs
+    if "crs_wkt" in attrs:
+        return attrs["crs_wkt"]
+    if "spatial_ref" in attrs:
+        return attrs["spatial_ref"]
+    try:
+        return pyproj.CRS.from_cf(attrs).to_wkt()
+    except pyproj.exceptions.CRSError:
+        return None
+
+def plot_dataset(ds, input_path, plan, args, legend_height, output_folder, selectors, iselectors,
+                 reprojection_cache=None):
+    flip = args.flip
+    if not flip:
+        # look for y-coordinates to autodetect flipping
+        for cname in ds.coords:
+            coords = ds.coords[cname]
+            if coords.attrs.get("standard_name","") == "projection_y_coordinate":
+                if ds[cname].data[0].item() < ds[cname].data[1].item():
+                    # flip so y coordinates are descending
+                    flip = True
+
+    if len(args.input_variable) == 3:
+        da = xr.concat([ds[args.input_variable[0]],ds[args.input_variable[1]],ds[args.input_variable[2]]],dim="rgb")
+    else:
+        da = ds[args.input_variable[0]]
+
+    source_crs = None
+    if args.target_crs:
+        source_crs = args.source_crs if args.source_crs else get_grid_mapping_crs(ds, args.input_variable[0])
+        if source_crs is None:
+            raise Exception(f"Unable to find the CRS of {input_path}, please specify --source-crs")
+
+    subtexts = []
+    for attr in args.attrs:
+        if attr in ds.attrs:
+            subtexts.append(f"{attr}: {ds.attrs[attr]}")
+
+    if output_folder is not None:
+        input_filename = os.path.split(input_path)[-1]
+        input_fileroot = os.path.splitext(input_filename)[0]
+        output_path = os.path.join(output_folder,input_fileroot+"."+args.output_filetype)
+    else:
+        output_path = args.output_path
+
+    bigplot_args = dict(x=args.x, y=args.y, vmin=args.vmin, vmax=args.vmax, vformat=args.vformat,
+                 cmap_name=args.cmap, cchart=plan.cchart, gamma=args.gamma,
+                 legend_width=args.legend_width, legend_height=legend_height,
+                 title=args.title, subtexts=subtexts, theight=args.title_height, subtheight=args.attr_height,
+                 plot_width=args.plot_width, flip=flip,
+                 selectors=selectors, iselectors=iselectors, tile_size=args.tile_size, plan=plan,
+                 quicklook=args.quicklook, categorical_method=args.categorical_method,
+                 montage=args.montage, montage_columns=args.montage_columns, montage_workers=args.montage_workers,
+                 overview_cache=OverviewCache(args.overview_folder) if (args.overviews or args.overview_folder) else None,
+                 input_path=input_path, overview_key="+".join(args.input_variable), source_crs=source_crs, target_crs=args.target_crs,
+                 reprojection_cache=reprojection_cache)
+    if args.animate:
+        plot = Animation(data_array=da, dimension=args.animate, output_path=output_path,
+                         frame_duration=args.frame_duration, workers=args.frame_workers, **bigplot_args)
+    else:
+        plot = BigPlot(data_array=da, output_path=output_path, **bigplot_args)
+    if not plot.run():
+        raise Exception(f"Unable to plot {input_path}, see the log for details")
+    return output_path
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
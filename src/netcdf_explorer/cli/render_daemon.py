@@ -0,0 +1,223 @@
+# MIT License
+#
+# Copyright (c) 2023-2024 National Centre for Earth Observation
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import json
+import time
+import glob
+import logging
+import tempfile
+import socketserver
+
+import numpy as np
+import xarray as xr
+
+from netcdf_explorer.api.bigplot import BigPlot
+from netcdf_explorer.api.dataset_cache import DatasetCache
+from netcdf_explorer.cli import bigplot, thumbnail
+from netcdf_explorer.cli.thumbnail import Thumbnail
+
+# map from job command to the function accepting the command line arguments
+commands = {
+    "bigplot": bigplot.main,
+    "thumbnail": thumbnail.main
+}
+
+
+class RenderDaemon:
+    """
+    Run bigplot and thumbnail jobs in a long-running process
+
+    Modules, compiled resampling code, fonts, colour maps and recently used input files stay loaded between jobs, so
+    that each job only pays for reading and plotting its input.
+
+    A job is a JSON object {"command": "bigplot" or "thumbnail", "args": [<command line arguments>]} and the
+    result of a job is a JSON object {"status": "succeeded" or "failed", "error": <message or null>, "elapsed": <seconds>}
+    """
+
+    logger = logging.getLogger("render_daemon")
+
+    def __init__(self, max_open_datasets=8):
+        self.dataset_cache = DatasetCache(max_open_datasets)
+
+    def warm_up(self):
+        """
+        Plot a small synthetic input, so that code is compiled before the first job
+        """
+        start = time.time()
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            for dtype in [np.float32, np.float64]:
+                ds = xr.Dataset({"v": xr.DataArray(np.linspace(0, 1, 64, dtype=dtype).reshape(8, 8), dims=("y", "x"))},
+                                coords={"y": np.arange(8, 0, -1), "x": np.arange(8)})
+                Thumbnail(variable="v", cmap="turbo", vmin=0, vmax=1, x_coord="x", y_coord="y",
+                          plot_width=16).generate(ds, os.path.join(tmp_folder, "thumbnail.png"))
+                BigPlot(data_array=ds["v"], x="x", y="y", legend_height=0, plot_width=16, flip=False,
+                        output_path=os.path.join(tmp_folder, "bigplot.png")).run()
+        self.logger.info(f"Warmed up in {time.time()-start:0.2f}s")
+
+    def run_job(self, job):
+        """
+        Run a job
+
+        Arguments:
+            job: dictionary {"command": <command>, "args": [<command line arguments>]}
+
+        Returns:
+            dictionary describing the result of the job
+        """
+        start = time.time()
+        error = None
+        try:
+            command = job.get("command")
+            if command not in commands:
+                raise Exception(f"Unknown command {command}, should be one of {','.join(commands)}")
+            args = job.get("args", [])
+            if not isinstance(args, list):
+                raise Exception("Job args should be a list of command line arguments")
+            exit_code = commands[command]([str(arg) for arg in args], dataset_cache=self.dataset_cache)
+            if exit_code:
+                error = f"{command} failed with exit code {exit_code}"
+        except SystemExit as ex:
+            # raised by argparse when the arguments are invalid, or when a command exits early
+            if ex.code:
+                error = f"{job.get('command')} failed with exit code {ex.code}"
+        except Exception as ex:
+            self.logger.exception("Job failed")
+            error = str(ex)
+        elapsed = time.time() - start
+        status = "failed" if error else "succeeded"
+        self.logger.info(f"Job {status} in {elapsed:0.2f}s")
+        return {"status": status, "error": error, "elapsed": elapsed}
+
+    def serve_spool(self, spool_folder, poll_interval=0.5):
+        """
+        Run jobs from files written to a spool folder
+
+        Each job file <name>.json is renamed to <name>.running while it is run, and the result is then written to
+        <name>.result.json.  Clients should write job files under another name and rename them into place, so that
+        incomplete job files are not read.
+
+        Arguments:
+            spool_folder: the folder to monitor for job files
+            poll_interval: seconds to wait before checking again for job files, when there are no jobs to run
+        """
+        os.makedirs(spool_folder, exist_ok=True)
+        self.logger.info(f"Waiting for jobs in {spool_folder}")
+        while True:
+            job_paths = sorted(path for path in glob.glob(os.path.join(spool_folder, "*.json"))
+                               if not path.endswith(".result.json"))
+            if not job_paths:
+                time.sleep(poll_interval)
+                continue
+            for job_path in job_paths:
+                job_root = job_path[:-len(".json")]
+                running_path = job_root + ".running"
+                try:
+                    os.rename(job_path, running_path)
+                except OSError:
+                    # claimed by another daemon sharing the spool folder
+                    continue
+                self.logger.info(f"Running {job_path}")
+                try:
+                    with open(running_path) as f:
+                        job = json.loads(f.read())
+                except Exception as ex:
+                    job = None
+                    result = {"status": "failed", "error": f"Unable to read job: {ex}", "elapsed": 0}
+                if job is not None:
+                    result = self.run_job(job)
+                # write the result under a temporary name, so that clients do not read an incomplete result
+                with open(job_root + ".result.tmp", "w") as f:
+                    f.write(json.dumps(result))
+                os.rename(job_root + ".result.tmp", job_root + ".result.json")
+                os.remove(running_path)
+
+    def serve_socket(self, socket_path):
+        """
+        Run jobs sent to a Unix domain socket
+
+        Each connection sends one job as a line of JSON, and receives the result as a line of JSON.  Jobs are run
+        one at a time.
+
+        Arguments:
+            socket_path: the path of the socket to create
+        """
+        daemon = self
+
+        class JobHandler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                try:
+                    job = json.loads(self.rfile.readline())
+                    result = daemon.run_job(job)
+                except Exception as ex:
+                    result = {"status": "failed", "error": f"Unable to read job: {ex}", "elapsed": 0}
+                self.wfile.write((json.dumps(result) + "\n").encode("utf-8"))
+
+        if os.path.exists(socket_path):
+            # remove the socket left by a previous daemon
+            os.remove(socket_path)
+        with socketserver.UnixStreamServer(socket_path, JobHandler) as server:
+            self.logger.info(f"Waiting for jobs on {socket_path}")
+            try:
+                server.serve_forever()
+            finally:
+                os.remove(socket_path)
+
+    def close(self):
+        self.dataset_cache.close()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Run bigplot and thumbnail jobs in a long-running process")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--spool-folder", help="folder to monitor for job files")
+    group.add_argument("--socket-path", help="path of a Unix domain socket on which to accept jobs")
+    parser.add_argument("--poll-interval", type=float, default=0.5,
+                        help="seconds between checks for new job files in the spool folder")
+    parser.add_argument("--max-open-datasets", type=int, default=8,
+                        help="number of recently used input files to keep open")
+    parser.add_argument("--no-warm-up", action="store_true",
+                        help="do not plot a synthetic input on start-up to compile code before the first job")
+
+    logging.basicConfig(level=logging.INFO)
+
+    args = parser.parse_args()
+
+    daemon = RenderDaemon(max_open_datasets=args.max_open_datasets)
+    if not args.no_warm_up:
+        daemon.warm_up()
+    try:
+        if args.spool_folder:
+            daemon.serve_spool(args.spool_folder, args.poll_interval)
+        else:
+            daemon.serve_socket(args.socket_path)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == '__main__':
+    main()
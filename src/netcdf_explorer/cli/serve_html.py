@@ -62,6 +62,14 @@ class App:
     def fetch_index():
         return send_from_directory(folder, 'index.html')
 
+    @staticmethod
+    @app.route('/labels.json', methods=['GET'])
+    def fetch_labels():
+        # serve the labels as updated by this session, which have not yet been saved to labels.json
+        if labels is None:
+            abort(404)
+        return jsonify(labels)
+
     @staticmethod
     @app.route('/<string:path>', methods=['GET'])
     def fetch(path):
@@ -78,6 +86,11 @@ class App:
     def fetch_images(path):
         return send_from_directory(folder + "/images", path)
 
+    @staticmethod
+    @app.route('/info/<string:path>', methods=['GET'])
+    def fetch_info(path):
+        return send_from_directory(folder + "/info", path)
+
     @staticmethod
     @app.route('/dependencies/<string:path>', methods=['GET'])
     def fetch_dependencies(path):
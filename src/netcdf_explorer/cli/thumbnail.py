@@ -21,7 +21,9 @@
 # SOFTWARE.
 
 import os
+import sys
 import json
+import functools
 
 import xarray as xr
 
@@ -31,94 +33,196 @@ from datashader import reductions as rd
 
 from PIL import Image
 
-class Thumbnail:
-
-    def __init__(self, variable, cmap, vmin, vmax, x_coord, y_coord, plot_width, background_image_path=None, background_alpha=0.2,
-                 selector={}):
-        self.variable = variable
-        self.background_image_path = background_image_path
-        self.background_alpha = background_alpha
-        self.vmin = vmin
-        self.vmax = vmax
-        self.x_coord = x_coord
-        self.y_coord = y_coord
-        self.plot_width = plot_width
-        self.selector = selector
-
-        self.cmap_colours = []
-
-        cmaps_folder = os.path.join(os.path.split(__file__)[0], "..", "misc", "cmaps")
-
-        # get a consistent lower case based cmap lookup
-        self.cmaps_paths = {}
-        for filename in os.listdir(cmaps_folder):
-            if filename.endswith(".json"):
-                self.cmaps_paths[os.path.splitext(filename)[0].lower()] = filename
-
-        reverse_cmap = False
-        if cmap.endswith("_r"):
-            cmap = cmap[:-2]
-            reverse_cmap = True
-
-        cmap_path = os.path.join(cmaps_folder, self.cmaps_paths[cmap.lower()])
-
-        with open(cmap_path) as f:
-            o = json.loads(f.read())
-            for rgb in o:
-                r = int(255 * rgb[0])
-                g = int(255 * rgb[1])
-                b = int(255 * rgb[2])
-                self.cmap_colours.append(f"#{r:02X}{g:02X}{b:02X}")
-
-        if reverse_cmap:
-            self.cmap_colours.reverse()
-
-    def generate(self, dataset, output_path):
-        da = dataset[self.variable]
-        if (self.selector):
-            da = da.isel(**self.selector)
-        da = da.squeeze()
+from netcdf_explorer.api.bigplot import decimate
+from netcdf_explorer.api.overview_cache import OverviewCache
 
-        if len(da.shape) != 2:
-            raise Exception(f"too many dimensions to plot {da.dims}")
+cmaps_folder = os.path.join(os.path.split(__file__)[0], "..", "misc", "cmaps")
 
-        if dataset[self.y_coord].data[0].item() > dataset[self.y_coord].data[1].item():
-            y_dim = da.dims[0]
-            da = da.isel(**{y_dim: slice(None, None, -1)})
+@functools.lru_cache(maxsize=None)
+def load_cmap_colours(cmap):
+    # load a colour map by case-insensitive name as a tuple of hex colour strings, names ending in _r are reversed
+    # get a consistent lower case based cmap lookup
+    cmaps_paths = {}
+    for filename in os.listdir(cmaps_folder):
+        if filename.endswith(".json"):
+            cmaps_paths[os.path.splitext(filename)[0].lower()] = filename
 
-        h = da.shape[0]
-        w = da.shape[1]
+    reverse_cmap = False
+    if cmap.endswith("_r"):
+        cmap = cmap[:-2]
+        reverse_cmap = True
 
-        plot_height = int(self.plot_width * (h / w))
-        cvs = dsh.Canvas(plot_width=self.plot_width, plot_height=plot_height,
-                         x_range=(float(da[self.x_coord].min()), float(da[self.x_coord].max())),
-                         y_range=(float(da[self.y_coord].min()), float(da[self.y_coord].max())))
+    cmap_path = os.path.join(cmaps_folder, cmaps_paths[cmap.lower()])
 
-        agg = cvs.raster(da.squeeze(), agg=rd.first, interpolate='linear')
+    cmap_colours = []
+    with open(cmap_path) as f:
+        o = json.loads(f.read())
+        for rgb in o:
+            r = int(255 * rgb[0])
+            g = int(255 * rgb[1])
+            b = int(255 * rgb[2])
+            cmap_colours.append(f"#{r:02X}{g:02X}{b:02X}")
 
-        shaded = tf.shade(agg, cmap=self.cmap_colours,
-                          how="linear",
-                          span=(self.vmin, self.vmax))
-
-        p = shaded.to_pil()
-
-        if self.background_image_path:
-            back = Image.open(self.background_image_path)
-            back = back.resize(p.size)
-            p = Image.blend(p, back, self.background_alpha)
-
-        with open(output_path, "wb") as f:
-            p.save(f, format="PNG")
+    if reverse_cmap:
+        cmap_colours.reverse()
+    return tuple(cmap_colours)
 
+class Thumbnail:
+    """
+    Generate thumbnail images for one or more variables, at one or more widths
+
+    Each variable is read once.  The largest thumbnail is rasterised from the variable and each smaller thumbnail is
+    downsampled from the next larger one.  The background image, if any, is opened once and resized once per size,
+    so one Thumbnail object can be reused to generate thumbnails for many input files.
+
+    Arguments:
+        variable: name of a variable, or a list of names
+        cmap: name of the colour map
+        vmin: value at the start of the colour map, or a list of values, one per variable
+        vmax: value at the end of the colour map, or a list of values, one per variable
+        x_coord: name of the x coordinate
+        y_coord: name of the y coordinate
+        plot_width: width of the thumbnail in pixels, or a list of widths
+        background_image_path: optional path to a background image onto which the thumbnails are overlaid
+        background_alpha: alpha transparency for the background image
+        selector: dictionary of dimension selectors applied to each variable
+        quicklook: read only every Nth row and column of each variable, where N is the number of input pixels per
+                   thumbnail pixel for the largest thumbnail, instead of interpolating from every input pixel
+        overview_cache: optional OverviewCache, from which each variable is read at the smallest overview level
+                        that is at least as large as the largest thumbnail
+    """
 
-def main():
+    def __init__(self, variable, cmap, vmin, vmax, x_coord, y_coord, plot_width, background_image_path=None, background_alpha=0.2,
+                 selector={}, quicklook=False, overview_cache=None):
+        self.variables = variable if isinstance(variable, list) else [variable]
+        self.background_image_path = background_image_path
+        self.background_alpha = background_alpha
+        self.vmins = vmin if isinstance(vmin, list) else [vmin] * len(self.variables)
+        self.vmaxs = vmax if isinstance(vmax, list) else [vmax] * len(self.variables)
+        if len(self.vmins) != len(self.variables) or len(self.vmaxs) != len(self.variables):
+            raise Exception("Please specify either one vmin and vmax, or one for each variable")
+        self.x_coord = x_coord
+        self.y_coord = y_coord
+        # generate the largest thumbnail first, smaller thumbnails are downsampled from it
+        self.plot_widths = sorted(set(plot_width if isinstance(plot_width, list) else [plot_width]), reverse=True)
+        self.selector = selector
+        self.quicklook = quicklook
+        self.overview_cache = overview_cache
+
+        self.cmap_colours = list(load_cmap_colours(cmap))
+
+        self.background_image = None
+        self.resized_background_images = {} # (width, height) => resized background image
+
+    def get_background_image(self, size):
+        if self.background_image is None:
+            self.background_image = Image.open(self.background_image_path)
+            self.background_image.load()
+        if size not in self.resized_background_images:
+            self.resized_background_images[size] = self.background_image.resize(size)
+        return self.resized_background_images[size]
+
+    @staticmethod
+    def get_output_path(output_path, variable, width):
+        return output_path.replace("{variable}", variable).replace("{width}", str(width))
+
+    def generate(self, dataset, output_path, input_path=None):
+        """
+        Generate the thumbnails for a dataset
+
+        Arguments:
+            dataset: the xarray.Dataset containing the variables
+            output_path: path of the output png file.  When generating thumbnails for more than one variable or width,
+                         the path should include {variable} and/or {width} which are replaced in each output path.
+            input_path: path of the file from which the dataset was opened, required to use the overview cache
+
+        Returns:
+            list of the paths of the thumbnails written
+        """
+        output_paths = [Thumbnail.get_output_path(output_path, variable, width)
+                        for variable in self.variables for width in self.plot_widths]
+        if len(set(output_paths)) < len(output_paths):
+            raise Exception("output path should include {variable} and/or {width} to distinguish the thumbnails")
+
+        flip = dataset[self.y_coord].data[0].item() > dataset[self.y_coord].data[1].item()
+
+        written_paths = []
+        for (variable, vmin, vmax) in zip(self.variables, self.vmins, self.vmaxs):
+            da = dataset[variable]
+            if (self.selector):
+                da = da.isel(**self.selector)
+            da = da.squeeze()
+
+            if len(da.shape) != 2:
+                raise Exception(f"too many dimensions to plot {da.dims}")
+
+            if flip:
+                y_dim = da.dims[0]
+                da = da.isel(**{y_dim: slice(None, None, -1)})
+
+            h = da.shape[0]
+            w = da.shape[1]
+
+            x_range = (float(da[self.x_coord].min()), float(da[self.x_coord].max()))
+            y_range = (float(da[self.y_coord].min()), float(da[self.y_coord].max()))
+
+            (y_dim, x_dim) = da.dims
+            if self.overview_cache is not None and input_path is not None:
+                key = json.dumps([variable, str(self.selector)])
+                da = self.overview_cache.get_overview(input_path, key, da, x_dim, y_dim,
+                                                      self.plot_widths[0], int(self.plot_widths[0] * (h / w)))
+
+            if self.quicklook:
+                da = decimate(da, x_dim, y_dim, self.plot_widths[0], int(self.plot_widths[0] * (h / w)))
+
+            agg = None
+            for plot_width in self.plot_widths:
+                plot_height = int(plot_width * (h / w))
+                cvs = dsh.Canvas(plot_width=plot_width, plot_height=plot_height, x_range=x_range, y_range=y_range)
+
+                if agg is None:
+                    agg = cvs.raster(da, agg=rd.first, interpolate='linear')
+                else:
+                    # downsample from the previous (larger) thumbnail rather than reading the variable again
+                    agg = cvs.raster(agg, agg=rd.mean, interpolate='linear')
+
+                shaded = tf.shade(agg, cmap=self.cmap_colours,
+                                  how="linear",
+                                  span=(vmin, vmax))
+
+                p = shaded.to_pil()
+
+                if self.background_image_path:
+                    p = Image.blend(p, self.get_background_image(p.size), self.background_alpha)
+
+                path = Thumbnail.get_output_path(output_path, variable, plot_width)
+                with open(path, "wb") as f:
+                    p.save(f, format="PNG")
+                written_paths.append(path)
+        return written_paths
+
+
+def main(argv=None, dataset_cache=None):
+    """
+    Run thumbnail
+
+    Arguments:
+        argv: list of command line arguments, defaults to sys.argv[1:]
+        dataset_cache: optional DatasetCache used to open the input files
+
+    Returns:
+        0 if the thumbnails were generated
+    """
     import argparse
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input-path", help="path of netcdf input file", required=True)
-    parser.add_argument("--output-path", help="path of output png file", required=True)
-    parser.add_argument("--input-variable",
-                        help="name of variable to plot.", required=True)
+    parser.add_argument("--input-path", nargs="+", help="path of netcdf input file(s)", required=True)
+    parser.add_argument("--output-path", required=True,
+                        help="path of output png file.  When plotting more than one input file, variable or width, "
+                             "include {name}, {variable} and/or {width} which are replaced by the input file name "
+                             "(without extension), variable name and width")
+    parser.add_argument("--input-variable", nargs="+",
+                        help="name of variable(s) to plot.", required=True)
     parser.add_argument("--x", help="name of x coord", default="x")
     parser.add_argument("--y", help="name of y coord", default="y")
 
@@ -126,8 +230,10 @@ def main():
                         metavar=("dimension", "min", "max"),
                         action="append")
 
-    parser.add_argument("--vmin", type=float, help="minimum input variable value to use in colour scale", default=0)
-    parser.add_argument("--vmax", type=float, help="maximum input variable value to use in colour scale", default=1)
+    parser.add_argument("--vmin", type=float, nargs="+", default=[0],
+                        help="minimum input variable value to use in colour scale, or one value for each variable")
+    parser.add_argument("--vmax", type=float, nargs="+", default=[1],
+                        help="maximum input variable value to use in colour scale, or one value for each variable")
 
     parser.add_argument("--cmap", help="colour scale to use, should be the  name of a matplotlib color map",
                         default="turbo")
@@ -140,9 +246,17 @@ def main():
                         default=0.2)
 
 
-    parser.add_argument("--plot-width", help="Width of the main image plot, in pixels", type=int, default=1024)
+    parser.add_argument("--quicklook", action="store_true",
+                        help="Read only every Nth row and column of the input, where N is the number of input pixels per output pixel")
+
+    parser.add_argument("--overviews", action="store_true",
+                        help="Build and reuse overview pyramids of the input variables, stored next to the input files")
+    parser.add_argument("--overview-folder", default=None,
+                        help="Build and reuse overview pyramids of the input variables, stored in this folder")
+
+    parser.add_argument("--plot-width", help="Width(s) of the main image plot, in pixels", type=int, nargs="+", default=[1024])
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     iselectors = {}
 
@@ -150,17 +264,33 @@ def main():
         for (dimension, min, max) in args.iselector:
             iselectors[dimension] = range(int(min), int(max) + 1)
 
+    if len(args.input_path) > 1 and "{name}" not in args.output_path:
+        parser.error("--output-path should include {name} when plotting more than one input file")
+
+    # use a single vmin and vmax for all variables, unless one is given for each variable
+    vmin = args.vmin if len(args.vmin) > 1 else args.vmin[0]
+    vmax = args.vmax if len(args.vmax) > 1 else args.vmax[0]
+
     t = Thumbnail(variable=args.input_variable,
-                  vmin=args.vmin, vmax=args.vmax,
+                  vmin=vmin, vmax=vmax,
                   x_coord=args.x, y_coord=args.y,
                   cmap=args.cmap,
                   plot_width=args.plot_width,
                   selector=iselectors,
                   background_image_path=args.background_image_path,
-                  background_alpha=args.background_image_alpha)
-
-    ds = xr.open_dataset(args.input_path)
-    t.generate(ds, args.output_path)
+                  background_alpha=args.background_image_alpha,
+                  quicklook=args.quicklook,
+                  overview_cache=OverviewCache(args.overview_folder) if (args.overviews or args.overview_folder) else None)
+
+    for input_path in args.input_path:
+        name = os.path.splitext(os.path.split(input_path)[-1])[0]
+        output_path = args.output_path.replace("{name}", name)
+        if dataset_cache is not None:
+            t.generate(dataset_cache.open(input_path), output_path, input_path)
+        else:
+            with xr.open_dataset(input_path) as ds:
+                t.generate(ds, output_path, input_path)
+    return 0
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
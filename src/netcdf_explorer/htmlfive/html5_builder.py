@@ -20,6 +20,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import io
 import xml.dom.minidom
 from xml.dom.minidom import getDOMImplementation
 import typing
@@ -31,6 +32,9 @@ class Fragment:
     def get_node(self, builder:"Html5Builder"):
         pass
 
+    def write(self, exporter:"Html5Exporter", indent:int):
+        pass
+
 
 class TextFragment(Fragment):
     """
@@ -43,6 +47,9 @@ class TextFragment(Fragment):
     def get_node(self, builder):
         return builder.doc.createTextNode(self.text)
 
+    def write(self, exporter, indent):
+        exporter.writeText(self.text, indent)
+
 
 class ElementFragment(Fragment):
     """
@@ -97,19 +104,26 @@ class ElementFragment(Fragment):
         self.child_fragments.append(fragment)
         return self
 
-    def get_node(self, builder: "Html5Builder") -> xml.dom.minidom.Node:
-        node = builder.doc.createElement(self.tag)
-        for (name, value) in self.attrs.items():
-            node.setAttribute(name, value)
+    def get_attributes(self) -> typing.Dict[str, str]:
+        attributes = dict(self.attrs)
         if self.style:
             style_value = ""
             for (name, value) in self.style.items():
                 style_value += name + ":" + str(value) + ";"
-            node.setAttribute("style", style_value)
+            attributes["style"] = style_value
+        return attributes
+
+    def get_node(self, builder: "Html5Builder") -> xml.dom.minidom.Node:
+        node = builder.doc.createElement(self.tag)
+        for (name, value) in self.get_attributes().items():
+            node.setAttribute(name, value)
         for fragment in self.child_fragments:
             node.appendChild(fragment.get_node(builder))
         return node
 
+    def write(self, exporter, indent):
+        exporter.writeElement(self.tag, self.get_attributes().items(), self.child_fragments, indent)
+
 
 class RawFragment:
 
@@ -119,6 +133,9 @@ class RawFragment:
     def get_node(self, builder):
         return self.node
 
+    def write(self, exporter, indent):
+        exporter.writeNode(self.node, indent)
+
 class Html5Builder:
     """
     Create and populate an html5 document
@@ -180,14 +197,41 @@ class Html5Builder:
         """
         return self.__body
 
-    def get_html(self) -> str:
+    def get_html(self, compact: bool = False) -> str:
         """
         Get an HTML5 string representation of the document being built
 
+        Arguments:
+            compact: if True, do not indent or add newlines between elements
+
         Returns:
              Html formatted string
         """
-        exporter = Html5Exporter()
+        with io.StringIO() as of:
+            self.write_html(of, compact=compact)
+            return of.getvalue()
+
+    def write_html(self, of: typing.TextIO, compact: bool = False):
+        """
+        Write an HTML5 representation of the document being built to a file-like object
+
+        Fragments are written directly, without building a DOM, unless post build functions have been registered
+
+        Arguments:
+            of: the file-like object to write to
+            compact: if True, do not indent or add newlines between elements
+        """
+        if self.post_build_fns:
+            # post build functions operate on the DOM
+            of.write(self.__get_dom_html(compact))
+            return
+        exporter = Html5Exporter(compact=compact)
+        if self.css:
+            self.__head.add_element("style").add_text(self.css)
+        exporter.exportTo(of, self.root.tagName, self.root.attributes.items(), [self.__head, self.__body])
+
+    def __get_dom_html(self, compact):
+        exporter = Html5Exporter(compact=compact)
         if self.css:
             self.__head.add_element("style").add_text(self.css)
         head_node = self.__head.get_node(self)
@@ -27,18 +27,37 @@ from .html5_common import HTML5_DOCTYPE, require_end_tags, void_elements
 
 class Html5Exporter:
 
-    def __init__(self, indent_spaces: int = 4):
+    def __init__(self, indent_spaces: int = 4, compact: bool = False):
         self.indent_spaces = indent_spaces
+        # in compact mode, no indentation or newlines are written between elements
+        self.compact = compact
 
     def __is_ws(self, txt):
         txt = txt.replace(" ", "").replace("\t", "").replace("\n", "")
         return txt == ""
 
-    def __exportElement(self, ele, indent):
-        self.of.write(indent * " " * self.indent_spaces)
-        self.of.write("<" + ele.tagName)
-        attr_count = 0
-        for (k, v) in ele.attributes.items():
+    def __writeIndent(self, indent):
+        if not self.compact:
+            self.of.write(indent * " " * self.indent_spaces)
+
+    def __writeNewline(self):
+        if not self.compact:
+            self.of.write("\n")
+
+    def writeElement(self, tag, attributes, children, indent, end_line=True):
+        """
+        Write an element
+
+        Arguments:
+            tag: the element's tag name
+            attributes: iterable of (name, value) pairs
+            children: list of minidom nodes or fragments (objects with a write(exporter, indent) method)
+            indent: the indentation level
+            end_line: whether to end the line after the element
+        """
+        self.__writeIndent(indent)
+        self.of.write("<" + tag)
+        for (k, v) in attributes:
 
             if v is None:
                 self.of.write(" %s" % k)
@@ -53,50 +72,69 @@ class Html5Exporter:
                             k, htmlutils.escape(v, quote=False)))  # single quote values containing double quote
                 else:
                     self.of.write(' %s="%s"' % (k, htmlutils.escape(v, quote=False)))
-            attr_count += 1
-        child_count = len(ele.childNodes)
+        child_count = len(children)
 
-        if ele.tagName in require_end_tags or child_count > 0:
+        if tag in require_end_tags or child_count > 0:
             self.of.write(">")
             if child_count:
-                self.of.write("\n")
-                for childNode in ele.childNodes:
-                    if childNode.nodeType == childNode.ELEMENT_NODE:
-                        self.__exportElement(childNode, indent + 1)
-                    elif childNode.nodeType == childNode.TEXT_NODE:
-                        self.__exportText(childNode, indent + 1)
-                    elif childNode.nodeType == childNode.COMMENT_NODE:
-                        self.__exportComment(childNode, indent + 1)
-                self.of.write(" " * indent * self.indent_spaces + "</%s>" % ele.tagName)
-            else:
-                self.of.write("</%s>" % ele.tagName)
+                self.__writeNewline()
+                for child in children:
+                    self.writeNode(child, indent + 1)
+                self.__writeIndent(indent)
+            self.of.write("</%s>" % tag)
         else:
-            if ele.tagName not in void_elements:
+            if tag not in void_elements:
                 self.of.write("/>")
             else:
                 self.of.write(">")
-        self.of.write("\n")
+        if end_line:
+            self.__writeNewline()
 
-    def __exportText(self, tn, indent):
-        txt = tn.data.rstrip(" \n").lstrip(" \n")
+    def writeText(self, data, indent):
+        txt = data.rstrip(" \n").lstrip(" \n")
         if not self.__is_ws(txt):
-            self.of.write(" " * indent * self.indent_spaces)
+            self.__writeIndent(indent)
             # self.of.write(htmlutils.escape(txt))
             self.of.write(txt)
-            self.of.write("\n")
+            self.__writeNewline()
 
-    def __exportComment(self, cn, indent):
-        txt = cn.data.rstrip(" \n").lstrip(" \n")
-        self.of.write(" " * indent * self.indent_spaces)
+    def writeComment(self, data, indent):
+        txt = data.rstrip(" \n").lstrip(" \n")
+        self.__writeIndent(indent)
         self.of.write("<!--")
         self.of.write(txt)
         self.of.write("-->")
-        self.of.write("\n")
+        self.__writeNewline()
+
+    def writeNode(self, node, indent):
+        if isinstance(node, xml.dom.minidom.Node):
+            if node.nodeType == node.ELEMENT_NODE:
+                self.writeElement(node.tagName, node.attributes.items(), node.childNodes, indent)
+            elif node.nodeType == node.TEXT_NODE:
+                self.writeText(node.data, indent)
+            elif node.nodeType == node.COMMENT_NODE:
+                self.writeComment(node.data, indent)
+        else:
+            node.write(self, indent)
+
+    def exportTo(self, of, root_tag, root_attributes, children):
+        """
+        Write an HTML5 document to a file-like object, without building a DOM.  The final newline is omitted.
+
+        Arguments:
+            of: the file-like object to write to
+            root_tag: tag name of the document element
+            root_attributes: iterable of (name, value) pairs for the document element
+            children: list of minidom nodes or fragments to write as children of the document element
+        """
+        self.of = of
+        self.of.write(HTML5_DOCTYPE + "\n")
+        self.writeElement(root_tag, root_attributes, children, 0, end_line=False)
 
     def export(self, doc: xml.dom.minidom.Document) -> str:
 
-        with io.StringIO() as self.of:
-            self.of.write(HTML5_DOCTYPE + "\n")
+        with io.StringIO() as of:
             ele = doc.documentElement
-            self.__exportElement(ele, 0)
-            return self.of.getvalue()
+            self.exportTo(of, ele.tagName, ele.attributes.items(), ele.childNodes)
+            self.__writeNewline()
+            return of.getvalue()
@@ -3,9 +3,47 @@ import os
 import xarray as xr
 import numpy as np
 import json
+import tempfile
+from unittest import mock
+from PIL import Image
 
 import netcdf_explorer.api.bigplot
 from netcdf_explorer.api.html_generator import HTMLGenerator
+from netcdf_explorer.api.expr_parser import ExpressionParser
+from netcdf_explorer.api.expr_compiler import ExpressionCompiler
+from netcdf_explorer.api.derived_band import DerivedBandArray
+from netcdf_explorer.api.timeseries_encoder import TimeseriesEncoder
+from netcdf_explorer.api.layers import compute_stats
+from netcdf_explorer.api.animation import Animation, MAX_FRAME_DURATION, get_apng_delay
+from netcdf_explorer.api.region_aggregator import RegionAggregator
+from netcdf_explorer.api.dataset_cache import DatasetCache
+from netcdf_explorer.cli.render_daemon import RenderDaemon
+
+def create_parser():
+    # create a parser with the operators used by HTMLGenerator for derive_bands
+    parser = ExpressionParser()
+    parser.add_unary_operator("not")
+    for (operator, precedence) in [("*", 5), ("/", 5), ("+", 4), ("-", 4), ("|", 3), ("&", 3), ("==", 2),
+                                   ("and", 1), ("or", 1)]:
+        parser.add_binary_operator(operator, precedence)
+    return parser
+
+def evaluate_reference(parsed_expression, ds):
+    # evaluate a parsed expression directly over whole bands, without folding or sharing subexpressions
+    if "name" in parsed_expression:
+        return ds[parsed_expression["name"]]
+    if "literal" in parsed_expression:
+        return parsed_expression["literal"]
+    args = [evaluate_reference(arg, ds) for arg in parsed_expression["args"]]
+    operator = parsed_expression["operator"]
+    if operator == "not":
+        return np.logical_not(args[0])
+    (a, b) = args
+    if operator in ("&", "|", "and", "or"):
+        (a, b) = (xr.DataArray(a).astype(int), xr.DataArray(b).astype(int))
+    return {"==": lambda: a == b, "&": lambda: a & b, "|": lambda: a | b,
+            "and": lambda: np.logical_and(a, b), "or": lambda: np.logical_or(a, b),
+            "*": lambda: a * b, "/": lambda: a / b, "+": lambda: a + b, "-": lambda: a - b}[operator]()
 
 class Test(unittest.TestCase):
 
@@ -45,3 +83,279 @@ class Test(unittest.TestCase):
         os.system(f'(cd {os.path.split(__file__)[0]}; {cli_test})')
 
 
+
+
+class TestDerivedBands(unittest.TestCase):
+
+    def create_dataset(self):
+        rng = np.random.default_rng(0)
+        return xr.Dataset({"B2": (("time", "y", "x"), rng.random((3, 4, 5))),
+                           "B3": (("time", "y", "x"), rng.random((3, 4, 5))),
+                           "QA": (("time", "y", "x"), rng.integers(0, 16, (3, 4, 5))),
+                           "MASK": (("y", "x"), rng.integers(0, 2, (4, 5)))})
+
+    def test_fast_lex(self):
+        parser = create_parser()
+        for expression in ["B2 * 2.5 + B3", "(B4 - B3) / (B4 + B3)", "QA & 8 == 0", "not (MASK == 1) and B2",
+                           "a.b_c*1e-3", "1.5E10+x", "'single' + \"double\"", "'it''s'", "a==b", "f(a, b)",
+                           "B2 -1", "not not a", "  spaced\tout\n", "a or b|c", ".5*x", ""]:
+            parser.input = expression
+            lex_tokens = parser.lex()
+            parser.input = expression
+            self.assertEqual(parser.fast_lex(), lex_tokens, expression)
+        for expression in ["12abc", "'unterminated"]:
+            parser.input = expression
+            with self.assertRaises(ExpressionParser.ParseError) as lex_error:
+                parser.lex()
+            parser.input = expression
+            with self.assertRaises(ExpressionParser.ParseError) as fast_lex_error:
+                parser.fast_lex()
+            self.assertEqual((fast_lex_error.exception.error_type, fast_lex_error.exception.error_position),
+                             (lex_error.exception.error_type, lex_error.exception.error_position))
+
+    def test_compiled_expressions(self):
+        # compare compiled derived bands with direct evaluation, for folded and shared subexpressions
+        ds = self.create_dataset()
+        parser = create_parser()
+        compiler = ExpressionCompiler()
+        expressions = {
+            "folded": "B2 * (2 + 3) - 1 * 4",
+            "ndvi": "(B3 - B2) / (B3 + B2)",
+            "shared": "(B3 - B2) / (B3 + B2) + MASK * (B3 + B2)",
+            "bits": "(QA & 8 == 0) and MASK",
+            "either": "not (QA | 1 == 1) or MASK == 0",
+            "chained": "ndvi * 2 + shared"
+        }
+        for (band_name, expression) in expressions.items():
+            ds[band_name] = DerivedBandArray.create(ds, parser.parse(expression), compiler)
+        for (band_name, expression) in expressions.items():
+            expected = evaluate_reference(parser.parse(expression), ds).transpose(*ds[band_name].dims)
+            np.testing.assert_allclose(ds[band_name].values, expected.values, err_msg=band_name)
+            np.testing.assert_allclose(ds[band_name].isel(time=2).values, expected.isel(time=2).values,
+                                       err_msg=band_name)
+            np.testing.assert_allclose(ds[band_name].isel(time=[2, 0], x=slice(1, 4)).values,
+                                       expected.isel(time=[2, 0], x=slice(1, 4)).values, err_msg=band_name)
+
+        # literal subexpressions are folded, and identical subexpressions compiled once
+        folded = compiler.fold(parser.parse(expressions["folded"]))
+        self.assertEqual(folded["args"][0]["args"][1], {"literal": 5.0})
+        self.assertEqual(folded["args"][1], {"literal": 4.0})
+        shared_key = ExpressionCompiler.get_key(parser.parse("B3 + B2"))
+        self.assertGreater(compiler.use_counts[shared_key], 1)
+
+    def test_chained_derived_bands(self):
+        # derived bands referencing other derived bands with different dimensions, sharing subexpressions
+        ds = xr.Dataset({"A": (("time", "y", "x"), np.arange(24.0).reshape(2, 3, 4)),
+                         "M": (("y", "x"), np.arange(12.0).reshape(3, 4))})
+        parser = create_parser()
+        compiler = ExpressionCompiler()
+        for (band_name, expression) in [("S", "(M + 1) * 2"), ("T", "(S * 3) + A"), ("U", "(S * 3) + (M + 1) * 2")]:
+            ds[band_name] = DerivedBandArray.create(ds, parser.parse(expression), compiler)
+        s = (ds["M"].values + 1) * 2
+        np.testing.assert_array_equal(ds["T"].values, s * 3 + ds["A"].values)
+        np.testing.assert_array_equal(ds["U"].values, s * 3 + s)
+        np.testing.assert_array_equal(ds["T"].isel(time=1).values, s * 3 + ds["A"].values[1])
+        np.testing.assert_array_equal(ds["S"].values, s)
+
+
+class TestCategoricalMethods(unittest.TestCase):
+
+    def test_orientation(self):
+        # with uniform 2x2 blocks of input pixels, each method gives the same image as "exact", whatever the
+        # direction of the y coordinates and the flip setting
+        rng = np.random.default_rng(0)
+        values = rng.integers(0, 4, (10, 15)).astype(float)
+        values = np.repeat(np.repeat(values, 2, axis=0), 2, axis=1)
+        cchart = {0: "#FF0000", 1: "#00FF00", 2: "#0000FF", 3: "#FFFF00"}
+        for ys in [np.arange(20), np.arange(20)[::-1]]:
+            da = xr.DataArray(values, dims=("y", "x"), coords={"y": ys, "x": np.arange(30)})
+            for flip in [True, False]:
+                images = {}
+                for method in ["exact", "mode", "nearest"]:
+                    bp = netcdf_explorer.api.bigplot.BigPlot(da, x="x", y="y", plot_width=15, flip=flip, cchart=cchart,
+                                                             categorical_method=method, legend_height=0)
+                    images[method] = np.array(bp.render_plot())
+                for method in ["mode", "nearest"]:
+                    np.testing.assert_array_equal(images[method], images["exact"],
+                                                  err_msg=f"{method} ascending={ys[0] < ys[-1]} flip={flip}")
+
+
+class TestTimeseriesEncoder(unittest.TestCase):
+
+    def test_times_are_exact(self):
+        # sub-daily timestamps over several decades are written to the second
+        times = np.datetime64("1990-01-01T00:00:00") + np.arange(0, 35 * 365 * 86400, 6 * 3600 + 1) * np.timedelta64(1, "s")
+        values = np.sin(np.arange(len(times)) / 100.0)
+        with tempfile.TemporaryDirectory() as folder:
+            header_filename = TimeseriesEncoder(min_points=10000).encode(folder, "ts", times, ["v"], {"v": values})
+            with open(os.path.join(folder, header_filename)) as f:
+                header = json.loads(f.read())
+            origin = np.datetime64(header["time_origin"])
+            for level in header["levels"]:
+                with open(os.path.join(folder, level["url"]), "rb") as f:
+                    data = f.read()
+                n = level["length"]
+                seconds = np.frombuffer(data[:8 * n], dtype="<f8")
+                level_values = np.frombuffer(data[8 * n:], dtype="<f4")
+                level_times = origin + np.round(seconds).astype(np.int64) * np.timedelta64(1, "s")
+                self.assertTrue(np.all(np.isin(level_times, times)))
+                self.assertEqual(len(level_values), n)
+            self.assertEqual(header["levels"][-1]["length"], len(times))
+            np.testing.assert_array_equal(level_times, times)
+            np.testing.assert_allclose(level_values, values, rtol=1e-6, atol=1e-6)
+
+
+class TestLayerStats(unittest.TestCase):
+
+    def test_non_finite_stats(self):
+        # statistics which are not finite are written as null, so that stats.json is valid JSON
+        stats = compute_stats(np.array([[1.0, np.inf], [np.nan, -np.inf]]))
+        self.assertEqual((stats["min"], stats["max"], stats["mean"]), (None, None, None))
+        self.assertEqual((stats["valid_fraction"], stats["nan_count"]), (0.75, 1))
+        json.dumps(stats, allow_nan=False)
+        stats = compute_stats(np.array([1.0, 2.0, np.nan, np.inf]))
+        self.assertEqual((stats["min"], stats["max"], stats["mean"]), (1.0, None, None))
+        self.assertEqual(compute_stats(np.array([1, 2, 3]))["mean"], 2.0)
+
+
+class TestAnimation(unittest.TestCase):
+
+    def create_data_array(self):
+        rng = np.random.default_rng(0)
+        return xr.DataArray(rng.random((3, 20, 30)), dims=("time", "y", "x"),
+                            coords={"time": np.arange(3), "y": np.arange(20)[::-1], "x": np.arange(30)})
+
+    def test_animations(self):
+        # write 3 frame animations and read them back with PIL
+        # a duration too long for an APNG frame delay in milliseconds is stored in coarser units
+        da = self.create_data_array()
+        with tempfile.TemporaryDirectory() as folder:
+            for extension in ["png", "webp"]:
+                for frame_duration in [250, 70000]:
+                    output_path = os.path.join(folder, "animation." + extension)
+                    animation = Animation(da, "time", output_path, frame_duration=frame_duration, workers=2, x="x",
+                                          y="y", plot_width=60, legend_height=0)
+                    self.assertTrue(animation.run())
+                    with Image.open(output_path) as im:
+                        self.assertEqual(im.n_frames, 3, extension)
+                        size = im.size
+                        for frame in range(im.n_frames):
+                            im.seek(frame)
+                            im.load()
+                            self.assertEqual(im.size, size, extension)
+                            self.assertEqual(im.info["duration"], frame_duration, extension)
+                    self.assertEqual(size[0], 60 + 2 * 20)
+
+    def test_frame_duration_range(self):
+        with self.assertRaisesRegex(Exception, "Frame duration"):
+            Animation(self.create_data_array(), "time", "animation.png", frame_duration=MAX_FRAME_DURATION + 1)
+        self.assertEqual(get_apng_delay(MAX_FRAME_DURATION), (16777, 1))
+
+    def test_frame_size_mismatch(self):
+        # a frame whose size does not match the first frame fails the animation and removes the partial file
+        da = self.create_data_array()
+        frames = [Image.new("RGBA", (40, 30)), Image.new("RGBA", (40, 30)), Image.new("RGBA", (41, 30))]
+        with tempfile.TemporaryDirectory() as folder:
+            for extension in ["png", "webp"]:
+                output_path = os.path.join(folder, "animation." + extension)
+                animation = Animation(da, "time", output_path, workers=1, x="x", y="y", plot_width=60,
+                                      legend_height=0)
+                with mock.patch("netcdf_explorer.api.bigplot.BigPlot.render", side_effect=list(frames)):
+                    with self.assertRaisesRegex(Exception, "does not match"):
+                        animation.run()
+                self.assertFalse(os.path.exists(output_path), extension)
+
+
+class TestRegionAggregator(unittest.TestCase):
+
+    def test_block_budget(self):
+        # aggregating in small blocks of cases gives the same results as nan-aware numpy reductions
+        rng = np.random.default_rng(0)
+        values = rng.random((7, 6, 5))
+        values[values < 0.1] = np.nan
+        da = xr.DataArray(values, dims=("time", "y", "x"))
+        for overlapping in [False, True]:
+            masks = {"a": xr.DataArray(rng.random((6, 5)) < 0.4, dims=("y", "x"))}
+            masks["b"] = xr.DataArray(~masks["a"].values & (rng.random((6, 5)) < 0.5) | (overlapping & masks["a"].values),
+                                      dims=("y", "x"))
+            for aggregation_fn in ["mean", "min", "max", "median"]:
+                reduce_fn = {"mean": np.nanmean, "min": np.nanmin, "max": np.nanmax, "median": np.nanmedian}[aggregation_fn]
+                for max_block_bytes in [1, 500, 256*1024*1024]:
+                    aggregated = RegionAggregator(masks, "time", max_block_bytes).aggregate(da, aggregation_fn)
+                    for (name, mask) in masks.items():
+                        expected = reduce_fn(values[:, mask.values], axis=1)
+                        np.testing.assert_allclose(aggregated[name], expected, err_msg=f"{name} {aggregation_fn}")
+
+
+def write_dataset(path, value):
+    # write a small dataset holding a single value, replacing any existing file at path
+    ds = xr.Dataset({"v": xr.DataArray(np.full((8, 8), value, dtype=np.float32), dims=("y", "x"))},
+                    coords={"y": np.arange(8, 0, -1), "x": np.arange(8)})
+    ds.to_netcdf(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+class TestDatasetCache(unittest.TestCase):
+
+    def test_reopen_modified(self):
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            path = os.path.join(tmp_folder, "input.nc")
+            write_dataset(path, 1)
+            cache = DatasetCache()
+            ds = cache.open(path)
+            self.assertIs(cache.open(path), ds)
+            write_dataset(path, 2)
+            # make sure the modification time changes, however coarse the file system's timestamps
+            stat = os.stat(path)
+            os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            reopened = cache.open(path)
+            self.assertIsNot(reopened, ds)
+            self.assertEqual(float(reopened["v"].max()), 2)
+            cache.close()
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            paths = [os.path.join(tmp_folder, f"input_{idx}.nc") for idx in range(3)]
+            for (idx, path) in enumerate(paths):
+                write_dataset(path, idx)
+            cache = DatasetCache(max_size=2)
+            datasets = [cache.open(path) for path in paths[:2]]
+            # using the first dataset again makes the second the least recently used
+            self.assertIs(cache.open(paths[0]), datasets[0])
+            cache.open(paths[2])
+            self.assertEqual(list(cache.datasets), [os.path.abspath(paths[0]), os.path.abspath(paths[2])])
+            self.assertIs(cache.open(paths[0]), datasets[0])
+            self.assertIsNot(cache.open(paths[1]), datasets[1])
+            self.assertEqual(len(cache.datasets), 2)
+            cache.close()
+
+
+class TestRenderDaemon(unittest.TestCase):
+
+    def test_run_job(self):
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            input_path = os.path.join(tmp_folder, "input.nc")
+            output_path = os.path.join(tmp_folder, "thumbnail.png")
+            write_dataset(input_path, 0.5)
+            daemon = RenderDaemon()
+            result = daemon.run_job({"command": "thumbnail",
+                                     "args": ["--input-path", input_path, "--input-variable", "v",
+                                              "--output-path", output_path, "--plot-width", 16]})
+            self.assertEqual(result["status"], "succeeded")
+            self.assertIsNone(result["error"])
+            self.assertTrue(os.path.exists(output_path))
+            self.assertIn(os.path.abspath(input_path), daemon.dataset_cache.datasets)
+            daemon.close()
+
+    def test_failed_jobs(self):
+        daemon = RenderDaemon()
+        result = daemon.run_job({"command": "unknown", "args": []})
+        self.assertEqual(result["status"], "failed")
+        self.assertIn("Unknown command unknown", result["error"])
+
+        # argparse exits when required arguments are missing
+        with mock.patch("sys.stderr"):
+            result = daemon.run_job({"command": "bigplot", "args": ["--output-path", "out.png"]})
+        self.assertEqual(result["status"], "failed")
+        self.assertEqual(result["error"], "bigplot failed with exit code 2")
+        daemon.close()